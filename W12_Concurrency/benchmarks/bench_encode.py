@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Lines/sec of parsing and serializing lines of memc_load: parse_appsinstalled + get_packed (a UserApps
+message per line) against encode_lines (batch encoder which writes the wire format directly).
+The speedup depends on the protobuf backend (pure python, upb or cpp), it is printed as well.
+
+    python benchmarks/bench_encode.py --lines 500000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import memc_load
+
+try:
+    from google.protobuf.internal import api_implementation
+    PROTOBUF_BACKEND = api_implementation.Type()
+except ImportError:
+    PROTOBUF_BACKEND = 'unknown'
+
+
+def generate_lines(lines, seed=0):
+    rnd = random.Random(seed)
+    return ['%s\t%032x\t%.6f\t%.6f\t%s' % (
+        rnd.choice(['idfa', 'gaid', 'adid', 'dvid']), rnd.getrandbits(128), rnd.uniform(-90, 90),
+        rnd.uniform(-180, 180), ','.join(str(rnd.randint(1, 10000)) for _ in range(rnd.randint(1, 20))))
+        for _ in range(lines)]
+
+
+def per_line(lines):
+    return [memc_load.get_packed(memc_load.parse_appsinstalled(line)) for line in lines]
+
+
+def batch(lines):
+    return memc_load.encode_lines(lines)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=500000)
+    parser.add_argument('--block', type=int, default=10000, help='lines per encode_lines call')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lines = generate_lines(args.lines)
+    blocks = [lines[i:i + args.block] for i in range(0, len(lines), args.block)]
+    print('protobuf backend: %s' % PROTOBUF_BACKEND)
+    results = {}
+    for name, func in (('parse_appsinstalled + get_packed', per_line), ('encode_lines', batch)):
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for block in blocks:
+                func(block)
+            best = min(best, time.perf_counter() - start)
+        results[name] = args.lines / best
+        print('%-34s %12.0f lines/sec' % (name, results[name]))
+    print('speedup x%.1f' % (results['encode_lines'] / results['parse_appsinstalled + get_packed']))
+
+
+if __name__ == '__main__':
+    main()
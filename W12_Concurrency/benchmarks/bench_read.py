@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Lines/sec of reading and parsing a gz file of memc_load: gzip.open(fn, 'rt') (the first version)
+against gzip_reader in every mode (pigz/gzip process, background thread, inline blocks).
+
+    python benchmarks/bench_read.py --lines 2000000
+"""
+
+import os
+import sys
+import gzip
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import gzip_reader
+import memc_load
+
+
+def write_tsv(path, lines):
+    random.seed(0)
+    with gzip.open(path, 'wt') as file:
+        for i in range(lines):
+            file.write('%s\t%032x\t%.6f\t%.6f\t%s\n' % (
+                random.choice(['idfa', 'gaid', 'adid', 'dvid']), random.getrandbits(128),
+                random.uniform(-90, 90), random.uniform(-180, 180),
+                ','.join(str(random.randint(1, 10000)) for _ in range(random.randint(1, 20)))))
+
+
+def parse(lines):
+    count = 0
+    for line in lines:
+        line = line.strip()
+        if line and memc_load.parse_appsinstalled(line):
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'appsinstalled.tsv.gz')
+        write_tsv(path, args.lines)
+        cases = [('gzip.open rt', lambda: gzip.open(path, 'rt'))]
+        for mode in gzip_reader.MODES[1:]:
+            if mode != 'subprocess' or gzip_reader.decompress_command(path):
+                cases.append(('gzip_reader ' + mode,
+                              lambda mode=mode: gzip_reader.gzip_lines(path, mode=mode, encoding='utf-8')))
+        for name, open_lines in cases:
+            for what, func in (('read', lambda: sum(1 for _ in open_lines())), ('read+parse', lambda: parse(open_lines()))):
+                best = float('inf')
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    func()
+                    best = min(best, time.perf_counter() - start)
+                print('%-24s %-10s %12.0f lines/sec' % (name, what, args.lines / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Lines/sec of process_file against local fake memcached servers with the given round trip latency:
+one connection with fixed batches of 100 rows (the first version) against server pools with several
+connections and the batch size adapted to the round trip time, and the asyncio backend with one connection
+and 4 pipelined batches. No real memcached is needed.
+
+    python benchmarks/bench_write.py --lines 200000 --latency 0.01
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import memc_load
+from bench_read import write_tsv
+from tests.fake_memcached import FakeMemcached
+
+CASES = (('1 connection, batch 100', ['--connections', '1', '--fixed-batch']),
+         ('4 connections, batch 100', ['--connections', '4', '--fixed-batch']),
+         ('1 connection, adaptive', ['--connections', '1']),
+         ('4 connections, adaptive', ['--connections', '4']),
+         ('asyncio 1x4, batch 100', ['--backend', 'asyncio', '--connections', '1', '--fixed-batch']),
+         ('asyncio 1x4, adaptive', ['--backend', 'asyncio', '--connections', '1']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--latency', type=float, default=0.01, help='round trip of the fake memcached, seconds')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'appsinstalled.tsv.gz')
+        write_tsv(path, args.lines)
+        for name, case_args in CASES:
+            servers = [FakeMemcached(latency=args.latency).start() for _ in range(3)]
+            options, _ = memc_load.build_parser().parse_args(
+                ['--idfa', servers[0].address, '--gaid', servers[0].address,
+                 '--adid', servers[1].address, '--dvid', servers[2].address] + case_args)
+            start = time.perf_counter()
+            memc_load.process_file(options, path)
+            elapsed = time.perf_counter() - start
+            sizes = ' '.join(str(pool.sizer.size) for pool in memc_load.server_pools.values())
+            memc_load.close_server_pools()
+            stored = sum(len(server.data) for server in servers)
+            round_trips = sum(server.round_trips for server in servers)
+            for server in servers:
+                server.stop()
+            print('%-26s %10.0f lines/sec  stored %d  round trips %d  batch sizes %s'
+                  % (name, args.lines / elapsed, stored, round_trips, sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+""" Ketama consistent hash ring for memc_load: keys of one device type are spread over a list of memcached nodes.
+
+Points of the ring are compatible with the original ketama (libketama, spymemcached KETAMA, uhashring): every node
+gets 160 points, md5 of 'host:port-i' for i in 0..39 gives 4 points (little-endian uint32 of every 4 bytes of the
+digest). A key goes to the first point clockwise from the first 4 bytes of md5(key). Adding or removing a node moves
+only the keys of its points, the rest of keys stay where they are.
+"""
+
+import bisect
+import hashlib
+
+POINTS_PER_HASH = 4
+POINTS_PER_NODE = 160
+
+
+def parse_nodes(value):
+    """ 'host port,host port' or 'host:port,host:port' -> ['host port', ...] in the format of memc_load addresses """
+    nodes = []
+    for node in str(value).split(','):
+        node = node.strip()
+        if not node:
+            continue
+        host, _, port = node.replace(':', ' ').rpartition(' ')
+        if not host.strip() or not port.isdigit():
+            raise ValueError("Wrong memcached address: %s" % node)
+        nodes.append('%s %d' % (host.strip(), int(port)))
+    if not nodes:
+        raise ValueError("Empty list of memcached addresses: %s" % value)
+    return nodes
+
+
+def key_hash(key):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    digest = hashlib.md5(key).digest()
+    return int.from_bytes(digest[:4], 'little')
+
+
+class HashRing(object):
+    """ Ring of memcached nodes ('host port' strings). get_node(key) is the node of the key """
+
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        points = []
+        for node in self.nodes:
+            host, port = node.split()
+            for i in range(POINTS_PER_NODE // POINTS_PER_HASH):
+                digest = hashlib.md5(('%s:%s-%d' % (host, port, i)).encode('utf-8')).digest()
+                for h in range(POINTS_PER_HASH):
+                    points.append((int.from_bytes(digest[h * 4:h * 4 + 4], 'little'), node))
+        points.sort()
+        self.points = [point for point, _ in points]
+        self.point_nodes = [node for _, node in points]
+
+    def get_node(self, key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        index = bisect.bisect_left(self.points, key_hash(key))
+        if index == len(self.points):
+            index = 0
+        return self.point_nodes[index]
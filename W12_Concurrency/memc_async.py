@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+""" asyncio writer backend of memc_load (--backend asyncio).
+
+Speaks the memcached text protocol directly. Every server has `connections` connections and every connection has
+up to `pipeline` batches in flight: set commands of the next batch are written without waiting for the replies
+to the previous one, replies are matched to batches in the order of writing. Keys which are not stored are retried
+with exponential backoff and jitter. The event loop runs in a background thread of the worker process, the parser
+hands batches to it through a bounded asyncio.Queue (put blocks while the queue is full).
+"""
+
+import os
+import re
+import time
+import random
+import asyncio
+import logging
+import threading
+import collections
+
+import metrics
+import throttle
+
+RETRIES = 5
+# delay before the n-th retry is BACKOFF_BASE * 2 ** (n - 1) seconds (at most BACKOFF_MAX) with jitter
+BACKOFF_BASE = 0.05
+BACKOFF_MAX = 2.0
+PIPELINE_DEPTH = 4
+TIMEOUT = 1
+# keys are checked like python-memcached check_key does: memcached answers a set of a longer key or a key with
+# spaces or control characters by error lines, which would be matched to the next batches in the pipeline
+KEY_MAX_LENGTH = 250
+VALID_KEY_RE = re.compile(b'[\x21-\x7e\x80-\xff]+$')
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """ Event loop of this process, it is started in a daemon thread at the first use
+    (and again in a forked worker: the thread of the parent's loop is not there)
+    """
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+
+def run_sync(coro):
+    """ Run the coroutine in the loop of this process and wait for the result """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def valid_key(key):
+    """ True if the key (str) can be sent in the set command """
+    key = key.encode('utf-8')
+    return len(key) <= KEY_MAX_LENGTH and VALID_KEY_RE.match(key) is not None
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """ Delay before the retry number `attempt` (1, 2, ...): exponential, capped, random in [delay / 2, delay] """
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class Connection(object):
+    """ Pipelined connection to one memcached server. Connected at the first use and again after an error """
+
+    def __init__(self, host, port, pipeline=PIPELINE_DEPTH, timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = self.writer = None
+        self.reader_task = None
+        # [future, number of replies expected, keys, failed keys] of batches in the order of writing
+        self.pending = collections.deque()
+        self.slots = asyncio.Semaphore(pipeline)
+        self.connect_lock = asyncio.Lock()
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        async with self.connect_lock:
+            if self.connected:
+                return
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                              self.timeout)
+            self.reader_task = asyncio.ensure_future(self.read_replies(self.reader))
+
+    async def set_multi(self, items):
+        """ Store (key, value) pairs by pipelined set commands. Return keys which are not stored,
+        invalid keys are not sent and returned as not stored.
+        Raise OSError or asyncio.TimeoutError if the connection fails (the connection is closed then)
+        """
+        valid = [item for item in items if valid_key(item[0])]
+        invalid = [key for key, _ in items if not valid_key(key)] if len(valid) < len(items) else []
+        if not valid:
+            return invalid
+        items = valid
+        async with self.slots:
+            if not self.connected:
+                await self.connect()
+            keys = [key for key, _ in items]
+            future = asyncio.get_running_loop().create_future()
+            # no await between append and write: replies are in the order of pending batches
+            self.pending.append([future, len(keys), keys, []])
+            writer = self.writer
+            writer.write(b''.join(b'set %s 0 0 %d\r\n%s\r\n' % (key.encode('utf-8'), len(value), value)
+                                  for key, value in items))
+            try:
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                return invalid + await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                # replies of the other batches can't be matched any more (unless it is reconnected already)
+                if self.writer is writer:
+                    self.fail(e)
+                raise
+
+    async def read_replies(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionError("Connection closed by %s:%s" % (self.host, self.port))
+                if not self.pending:
+                    raise ConnectionError("Unexpected reply from %s:%s: %r" % (self.host, self.port, line))
+                batch = self.pending[0]
+                future, expected, keys, failed = batch
+                if line != b'STORED\r\n':
+                    failed.append(keys[len(keys) - expected])
+                batch[1] -= 1
+                if not batch[1]:
+                    self.pending.popleft()
+                    if not future.done():
+                        future.set_result(failed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.fail(e)
+
+    def fail(self, error):
+        """ Close the connection, batches in flight get the error """
+        while self.pending:
+            future = self.pending.popleft()[0]
+            if not future.done():
+                future.set_exception(error if isinstance(error, (OSError, asyncio.TimeoutError)) else
+                                     ConnectionError(str(error)))
+                # the error is raised by set_multi which has timed out or failed itself
+                future.exception()
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = self.reader = None
+        if self.reader_task is not None and self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()
+        self.reader_task = None
+
+    async def close(self):
+        self.fail(ConnectionError("Connection is closed"))
+
+
+class AsyncServerPool(object):
+    """ Writer of one memcached address on the asyncio loop of the process, the same interface as
+    memc_load.ServerPool: put(batch, result) from the parser thread, sizer, close()
+    """
+
+    def __init__(self, memc_addr, connections, queue_depth, dry_run, sizer, pipeline=PIPELINE_DEPTH,
+                 retries=RETRIES, writer_throttle=None):
+        self.memc_addr = memc_addr
+        self.dry_run = dry_run
+        self.sizer = sizer
+        self.retries = retries
+        self.throttle = writer_throttle or throttle.AsyncThrottle()
+        self.metrics = metrics.get_registry().server(memc_addr)
+        self.loop = get_loop()
+        host, port = memc_addr.split()
+        run_sync(self.start(host, int(port), connections, queue_depth, pipeline))
+        self.metrics.queues.append(self.queue.qsize)
+        if self.throttle.limit is not None:
+            self.metrics.limits.append(self.throttle.limit_value)
+
+    async def start(self, host, port, connections, queue_depth, pipeline):
+        self.queue = asyncio.Queue(maxsize=queue_depth)
+        self.connections = [Connection(host, port, pipeline) for _ in range(connections)]
+        self.tasks = [asyncio.ensure_future(self.worker(connection))
+                      for connection in self.connections for _ in range(pipeline)]
+
+    def put(self, packed_batch, result):
+        """ Hand the batch to writers, blocks while the queue is full """
+        result.add_pending()
+        asyncio.run_coroutine_threadsafe(self.queue.put((packed_batch, result)), self.loop).result()
+
+    async def worker(self, connection):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            packed_batch, result = item
+            started = await self.throttle.acquire(len(packed_batch))
+            try:
+                rows, errors = await self.write_batch(connection, packed_batch)
+            except Exception as e:
+                logging.exception("Cannot write to memc %s: %s" % (self.memc_addr, e))
+                rows = errors = len(packed_batch)
+            await self.throttle.release(started, errors)
+            self.metrics.batch(rows, errors, sum(len(key) + len(packed) for key, packed in packed_batch))
+            result.done(rows, errors)
+
+    async def write_batch(self, connection, packed_batch):
+        """ Write the batch, retry keys which are not stored. Return [number of rows, rows which are not set] """
+        items = list(dict(packed_batch).items())
+        if self.dry_run:
+            for key, packed in items:
+                logging.debug("%s - %s -> %s" % (self.memc_addr, key, str(packed).replace("\n", " ")))
+            return [len(items), 0]
+
+        # invalid keys are never stored, they are not retried
+        notset = [item for item in items if valid_key(item[0])]
+        invalid = len(items) - len(notset)
+        if invalid:
+            logging.error("%d invalid keys in the batch to memc %s" % (invalid, self.memc_addr))
+        if not notset:
+            return [len(items), invalid]
+        for attempt in range(1, self.retries + 1):
+            start = time.time()
+            try:
+                failed = set(await connection.set_multi(notset))
+                self.metrics.round_trip(time.time() - start)
+                if attempt == 1:
+                    self.sizer.update(len(notset), time.time() - start)
+                notset = [item for item in notset if item[0] in failed]
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.info("Cannot write to memc %s: %s" % (self.memc_addr, e))
+            if not notset:
+                break
+            if attempt < self.retries:
+                logging.info("Attempt {} of {}".format(attempt, self.retries))
+                self.metrics.retry()
+                await asyncio.sleep(backoff_delay(attempt, BACKOFF_BASE, BACKOFF_MAX))
+        return [len(items), len(notset) + invalid]
+
+    async def stop(self):
+        for _ in self.tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self.tasks)
+        for connection in self.connections:
+            await connection.close()
+
+    def close(self):
+        run_sync(self.stop())
+        self.metrics.queues.remove(self.queue.qsize)
+        if self.throttle.limit is not None:
+            self.metrics.limits.remove(self.throttle.limit_value)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
-import gzip
 import sys
+import json
+import time
 import glob
+import struct
 import logging
 import collections
 from optparse import OptionParser
@@ -16,7 +18,18 @@ import appsinstalled_pb2
 import memcache
 import threading
 import multiprocessing as mp
+import multiprocessing.util
 import queue
+# gz files are decompressed by pigz/gzip process or by a background thread in parallel with parsing
+import gzip_reader
+# --backend asyncio: pipelined text protocol writers on the event loop
+import memc_async
+# keys of a device type are spread over its list of nodes by the consistent hash ring
+import ketama
+# per-server metrics of writers: --metrics-file, --metrics-port
+import metrics
+# per-node rate limit and adaptive concurrency of writers: --rate, --adaptive-concurrency
+import throttle
 
 logging.basicConfig(filename=None, level=logging.INFO,
                     format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
@@ -28,6 +41,29 @@ INSERTION_RETRIES = 5
 WORKER_BATCH_SIZE = 100
 READ_LOG_SIZE = 200000
 WRITE_LOG_SIZE = 10000
+# max number of batches waiting in every queue of the pipeline: blocks of lines for the parser and
+# batches of records for every memcached writer. A full queue stops the previous stage (backpressure)
+QUEUE_DEPTH = 8
+# writer threads (connections) per memcached address in every worker process, shared by all its files
+CONNECTIONS_PER_SERVER = 4
+# batch size is adapted to keep the round trip of set_multi about TARGET_BATCH_RTT seconds
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 5000
+TARGET_BATCH_RTT = 0.05
+RTT_SMOOTHING = 0.3
+BACKENDS = ('thread', 'asyncio')
+# --split-files: blocks of lines shipped to workers, the reader waits when this number of blocks per worker is queued
+SPLIT_BLOCKS_PER_WORKER = 2
+# seconds between saves of the progress of a file to its state file (.<file name>.state next to the file)
+CHECKPOINT_INTERVAL = 5
+
+# UserApps wire format for encode_lines: apps as a packed varint field 1, lat and lon as 64-bit fields 2 and 3
+APPS_TAG = b'\x0a'
+LAT_TAG = b'\x11'
+LON_TAG = b'\x19'
+MAX_APP_ID = 2 ** 32 - 1
+# varints of app ids (by the raw text) kept by encode_lines, app ids repeat a lot
+APP_VARINTS_CACHE_SIZE = 100000
 
 AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
 
@@ -37,45 +73,60 @@ lock = threading.Lock()
 def dot_rename(path):
     head, fn = os.path.split(path)
     # atomic in most cases
-    # t = str(int(time.time()))+'.'
-    # os.rename(path, os.path.join(head, t+fn))
-    # os.rename(path, os.path.join(head, "." + fn))
+    os.rename(path, os.path.join(head, "." + fn))
 
 
-def get_packed (appsinstalled):
+def get_packed(appsinstalled):
+    """ (key, serialized UserApps) pair of the record """
     ua = appsinstalled_pb2.UserApps()
     ua.lat = appsinstalled.lat
     ua.lon = appsinstalled.lon
     key = "%s:%s" % (appsinstalled.dev_type, appsinstalled.dev_id)
     ua.apps.extend(appsinstalled.apps)
     packed = ua.SerializeToString()
-    return {key: packed}
+    return key, packed
 
 
-def insert_appsinstalled(memc, packed_dict, dry_run=False):
-
+def insert_appsinstalled(memc, packed_batch, dry_run=False, server_metrics=None):
+    """ Write the batch (list of (key, packed) pairs) by set_multi, keys which are not set are retried.
+    Invalid keys (see memc_async.valid_key) are not sent: python-memcached would fail the whole set_multi
+    for one of them. They are not set, as with the asyncio backend.
+    Round trips and retries are counted by server_metrics if it is set.
+    Return [number of rows, number of rows which are not set]
+    """
     memc_addr = memc.servers[0].address
+    packed_dict = dict(packed_batch)
 
     if dry_run:
         for key in packed_dict.keys():
             logging.debug("%s - %s -> %s" % (memc_addr, key, str(packed_dict[key]).replace("\n", " ")))
+        return [len(packed_dict), 0]
     else:
         set_counter = 1
-        notset_keys = list(packed_dict.keys())
-        total_rows = len(notset_keys)
+        total_rows = len(packed_dict)
+        # invalid keys are never stored, they are not retried
+        notset_keys = [key for key in packed_dict if memc_async.valid_key(key)]
+        invalid = total_rows - len(notset_keys)
+        if invalid:
+            logging.error("%d invalid keys in the batch to memc %s" % (invalid, memc_addr))
         while (set_counter <= INSERTION_RETRIES) and (len(notset_keys) > 0):
             try:
                 filtered_packed_dict = {key: packed_dict[key] for key in notset_keys}
+                start = time.time()
                 notset_keys = memc.set_multi(filtered_packed_dict)
+                if server_metrics is not None:
+                    server_metrics.round_trip(time.time() - start)
 
                 if len(notset_keys) > 0:
                     logging.info("Attempt {} of {}".format(set_counter, INSERTION_RETRIES))
                     set_counter += 1
+                    if server_metrics is not None and set_counter <= INSERTION_RETRIES:
+                        server_metrics.retry()
 
             except Exception as e:
                 logging.exception("Cannot write to memc %s: %s" % (memc_addr, e))
-                return [total_rows, len(notset_keys)]
-        return [total_rows, len(notset_keys)]
+                return [total_rows, len(notset_keys) + invalid]
+        return [total_rows, len(notset_keys) + invalid]
 
 
 def parse_appsinstalled(line):
@@ -88,7 +139,7 @@ def parse_appsinstalled(line):
     try:
         apps = [int(a.strip()) for a in raw_apps.split(",")]
     except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isidigit()]
+        apps = [int(a.strip()) for a in raw_apps.split(",") if a.strip().isdigit()]
         logging.info("Not all user apps are digits: `%s`" % line)
     try:
         lat, lon = float(lat), float(lon)
@@ -97,128 +148,742 @@ def parse_appsinstalled(line):
     return AppsInstalled(dev_type, dev_id, lat, lon, apps)
 
 
-def do_work(memc_addr, input_q, result_q, dry_run):
-    w_process = w_error = 0
-    insertion_counter = 1
-    addr, port = memc_addr.split()
-    memc = memcache.Client([(str(addr), int(port))], socket_timeout=CONNECTION_TIMEOUT, dead_retry=CONNECTION_TIMEOUT)
-    while True:
-        packed_dict = input_q.get()
-        if packed_dict == 'end':
-            result_q.put([w_process, w_error])
-            logging.info('Finally processed {} rows in address {}'.format((w_process + w_error), memc_addr))
-            input_q.task_done()
-            return
-        packed_dict_res = insert_appsinstalled(memc, packed_dict, dry_run)
-        w_process += packed_dict_res[0]
-        w_error += packed_dict_res[1]
-        if (w_process + w_error) >= insertion_counter*WRITE_LOG_SIZE:
-            logging.info('Processed {} rows in address {}'.format((w_process + w_error), memc_addr))
-            insertion_counter += 1
-        input_q.task_done()
+pack_double = struct.Struct('<d').pack
+app_varints = {}
+
+
+def varint(value):
+    """ Protobuf base 128 varint of the non-negative int """
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+# tag and length of the apps field shorter than 128 bytes (one byte varint)
+apps_prefixes = [APPS_TAG + varint(length) for length in range(128)]
+
+
+def encode_apps(raw_apps, line):
+    """ Varints of app ids of the comma separated list. Not digits and ids out of uint32 are skipped """
+    out = bytearray()
+    skipped = False
+    for raw_app in raw_apps.split(","):
+        encoded = app_varints.get(raw_app)
+        if encoded is None:
+            app = raw_app.strip()
+            if not app.isdigit() or int(app) > MAX_APP_ID:
+                skipped = True
+                continue
+            encoded = varint(int(app))
+            if len(app_varints) < APP_VARINTS_CACHE_SIZE:
+                app_varints[raw_app] = encoded
+        out += encoded
+    if skipped:
+        logging.info("Not all user apps are digits: `%s`" % line)
+    return out
 
 
-def process_lines_in_files(fname, fd, device_memc, lines_batch_dict, workers_queue_dict):
+def encode_lines(lines):
+    """ Parse and serialize a batch of lines at once, the fast path of parse_appsinstalled + get_packed.
+    UserApps is written directly without message objects: apps as one packed varint field (parsers of repeated
+    uint32 accept both packed and unpacked encoding), varints of app ids are cached by the raw text, so a line
+    of cached ids is one join without the per-app int(). Lines with invalid coordinates are errors
+    (get_packed can't pack them)
+
+    Args:
+        lines: lines of the file (str)
+
+    Returns:
+        list of (dev_type, key, packed) and the number of lines which can't be parsed
+    """
+    records = []
     errors = 0
-    a = 0
-    for line in fd:
+    cache = app_varints
+    for line in lines:
         line = line.strip()
         if not line:
             continue
-        appsinstalled = parse_appsinstalled(line)
-        packed_with_key = get_packed(appsinstalled)
-
-        if not appsinstalled:
+        line_parts = line.split("\t")
+        if len(line_parts) != 5:
+            errors += 1
+            continue
+        dev_type, dev_id, lat, lon, raw_apps = line_parts
+        if not dev_type or not dev_id:
             errors += 1
             continue
-        memc_addr = device_memc.get(appsinstalled.dev_type)
-        if not memc_addr:
+        try:
+            lat, lon = pack_double(float(lat)), pack_double(float(lon))
+        except ValueError:
+            logging.info("Invalid geo coords: `%s`" % line)
             errors += 1
-            logging.error("Unknown device type: %s" % appsinstalled.dev_type)
             continue
+        try:
+            apps = b''.join([cache[raw_app] for raw_app in raw_apps.split(",")])
+        except KeyError:
+            apps = encode_apps(raw_apps, line)
+
+        if not apps:
+            packed = b''.join((LAT_TAG, lat, LON_TAG, lon))
+        else:
+            apps_prefix = apps_prefixes[len(apps)] if len(apps) < 128 else APPS_TAG + varint(len(apps))
+            packed = b''.join((apps_prefix, apps, LAT_TAG, lat, LON_TAG, lon))
+        records.append((dev_type, "%s:%s" % (dev_type, dev_id), packed))
+    return records, errors
+
+
+class BatchSizer(object):
+    """ Batch size for one memcached address adapted to the measured round trip of set_multi. The round trip
+    is smoothed (EWMA), the size is doubled while full batches are written faster than target_rtt / 2 and halved
+    when the round trip is longer than target_rtt. The parser reads size, writer threads call update
+    """
+
+    def __init__(self, size=WORKER_BATCH_SIZE, min_size=MIN_BATCH_SIZE, max_size=MAX_BATCH_SIZE,
+                 target_rtt=TARGET_BATCH_RTT):
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size, size)
+        self.size = size
+        self.target_rtt = target_rtt
+        self.rtt = None
+        self.lock = threading.Lock()
+
+    def update(self, rows, rtt):
+        with self.lock:
+            self.rtt = rtt if self.rtt is None else RTT_SMOOTHING * rtt + (1 - RTT_SMOOTHING) * self.rtt
+            if self.rtt > self.target_rtt:
+                self.size = max(self.min_size, self.size // 2)
+                # the next batches are smaller, don't halve them again for the old round trips
+                self.rtt = None
+            elif self.rtt < self.target_rtt / 2 and rows >= self.size:
+                self.size = min(self.max_size, self.size * 2)
+
+
+class WriteResult(object):
+    """ Rows written to one memcached address (node) for one file. Writers report every batch by done(),
+    wait() returns when all batches put for the file are written and logs throughput and errors of the node
+    """
+
+    def __init__(self, memc_addr):
+        self.memc_addr = memc_addr
+        self.processed = self.errors = self.pending = self.batches = 0
+        self.insertion_counter = 1
+        self.start = time.time()
+        self.seconds = 0
+        self.cond = threading.Condition()
+
+    def add_pending(self):
+        with self.cond:
+            self.pending += 1
+
+    def done(self, rows, errors):
+        with self.cond:
+            self.processed += rows
+            self.errors += errors
+            self.pending -= 1
+            self.batches += 1
+            if self.processed >= self.insertion_counter * WRITE_LOG_SIZE:
+                logging.info('Processed {} rows in address {}'.format(self.processed, self.memc_addr))
+                self.insertion_counter += 1
+            if not self.pending:
+                self.seconds = time.time() - self.start
+                self.cond.notify_all()
+
+    @property
+    def rows_per_sec(self):
+        return self.processed / self.seconds if self.seconds else 0
+
+    def wait(self, log=True):
+        with self.cond:
+            while self.pending:
+                self.cond.wait()
+        if log:
+            logging.info('Finally processed {} rows in address {}: {} batches, {} rows not set, '
+                         '{:.0f} rows/sec'.format(self.processed, self.memc_addr, self.batches, self.errors,
+                                                  self.rows_per_sec))
+        return self.processed, self.errors
+
+
+def state_path(fn):
+    """ State file of the checkpoint of the file: hidden and next to it, so glob patterns don't match it """
+    head, fname = os.path.split(fn)
+    return os.path.join(head, '.%s.state' % fname)
+
+
+class Checkpoint(object):
+    """ Progress of loading one file, saved to its small JSON state file. Lines are loaded by blocks, a block is
+    acknowledged when the parser has put all its batches (close_block) and writers have reported every one of them
+    by done(). The state keeps the number of lines of acknowledged blocks from the start of the file with their
+    processed rows and errors, so a restarted run skips these lines and the error rate still covers the whole file.
+    The state of a changed file (size or mtime) is ignored
+    """
+
+    def __init__(self, fn, interval=CHECKPOINT_INTERVAL):
+        self.path = state_path(fn)
+        stat = os.stat(fn)
+        self.file_id = [stat.st_size, int(stat.st_mtime)]
+        self.interval = interval
+        self.lines = self.processed = self.errors = 0
+        # block number -> [lines, batches not written yet, rows, errors, all batches put]
+        self.blocks = {}
+        self.next_block = self.first_block = 0
+        self.lock = threading.Lock()
+        self.load()
+        self.saved_lines = self.lines
+        self.saved_at = time.time()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state['file'] != self.file_id:
+                logging.info('File %s has changed, checkpoint is ignored' % self.path)
+                return
+            self.lines, self.processed, self.errors = state['lines'], state['processed'], state['errors']
+        except (OSError, ValueError, KeyError):
+            return
+        logging.info('Checkpoint {}: {} lines are loaded, {} rows, {} errors'.format(
+            self.path, self.lines, self.processed, self.errors))
+
+    def start_block(self, lines):
+        """ Register the next block of `lines` lines, return its number """
+        with self.lock:
+            block = self.next_block
+            self.next_block += 1
+            self.blocks[block] = [lines, 0, 0, 0, False]
+        return block
+
+    def add_pending(self, block):
+        with self.lock:
+            self.blocks[block][1] += 1
+
+    def done(self, block, rows, errors):
+        with self.lock:
+            state = self.blocks[block]
+            state[1] -= 1
+            state[2] += rows
+            state[3] += errors
+            self.acknowledge()
+
+    def close_block(self, block, errors=0):
+        """ All batches of the block are put, `errors` lines of the block are not parsed """
+        with self.lock:
+            state = self.blocks[block]
+            state[3] += errors
+            state[4] = True
+            self.acknowledge()
+
+    def acknowledge(self):
+        # under the lock: add the finished blocks following the acknowledged ones to the state
+        while self.first_block in self.blocks:
+            lines, pending, rows, errors, closed = self.blocks[self.first_block]
+            if pending or not closed:
+                return
+            del self.blocks[self.first_block]
+            self.first_block += 1
+            self.lines += lines
+            self.processed += rows
+            self.errors += errors
+
+    def maybe_save(self):
+        """ Save the state if the interval has passed since the last save """
+        if time.time() - self.saved_at >= self.interval:
+            self.save()
+
+    def save(self):
+        """ Write the state by the temporary file and rename, a crash never leaves a broken state file """
+        self.saved_at = time.time()
+        with self.lock:
+            state = {'file': self.file_id, 'lines': self.lines, 'processed': self.processed, 'errors': self.errors}
+        if state['lines'] == self.saved_lines:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+        self.saved_lines = state['lines']
 
-        lines_batch_dict.get(appsinstalled.dev_type).update(packed_with_key)
+    def remove(self):
+        """ The file is finished: the next run loads it from the start """
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
 
-        if len(lines_batch_dict.get(appsinstalled.dev_type)) >= WORKER_BATCH_SIZE:
-            appsinstalled_dict = lines_batch_dict.get(appsinstalled.dev_type)
-            workers_queue_dict.get(appsinstalled.dev_type).queue_in.put(appsinstalled_dict)
-            lines_batch_dict[appsinstalled.dev_type] = {}
 
-        a += 1
-        if a % READ_LOG_SIZE == 0:
-            logging.info('Read {} rows in file {}'.format(a, fname))
+class BlockResult(object):
+    """ WriteResult of a node for the batches of one block of a checkpointed file: batches are reported to both """
 
-    return lines_batch_dict, errors
+    def __init__(self, result, checkpoint, block):
+        self.result = result
+        self.checkpoint = checkpoint
+        self.block = block
 
+    def add_pending(self):
+        self.result.add_pending()
+        self.checkpoint.add_pending(self.block)
 
-def process_file(options, fn):
-    device_memc = {
-        "idfa": options.idfa,
-        "gaid": options.gaid,
-        "adid": options.adid,
-        "dvid": options.dvid,
-    }
+    def done(self, rows, errors):
+        self.result.done(rows, errors)
+        self.checkpoint.done(self.block, rows, errors)
 
-    processed = 0
-    workers_queue_dict = {}
-    WorkersQueueObj = collections.namedtuple('WorkersQueueObj', 'name queue_in queue_out')
-    lines_batch_dict = {}
 
-    for key in device_memc.keys():
-        # create queue for writing rows in memcache and queue to store the results of writing
-        wo = WorkersQueueObj(name=key, queue_in=queue.Queue(), queue_out=queue.Queue())
-        workers_queue_dict[key] = wo
-        lines_batch_dict[key] = dict()
+def get_checkpoint(options, fn):
+    """ Checkpoint of the file, None with --dry (nothing is stored) or --checkpoint-interval 0 """
+    if options.dry or options.checkpoint_interval <= 0:
+        return None
+    return Checkpoint(fn, options.checkpoint_interval)
 
-        # launch thread for every thread
-        t = threading.Thread(target=do_work, args=(device_memc.get(key), wo.queue_in, wo.queue_out, options.dry))
-        t.daemon = True
-        t.start()
 
-    head, fname = os.path.split(fn)
-    logging.info('Processing %s' % fname)
-    fd = gzip.open(fn, 'rt')
+def batch_bytes(packed_batch):
+    """ Bytes of keys and values of the batch """
+    return sum(len(key) + len(packed) for key, packed in packed_batch)
+
+
+def do_work(memc_addr, input_q, sizer, dry_run, server_metrics=None, writer_throttle=None):
+    """ Writer thread of ServerPool: keeps its own connection to memc_addr and writes batches
+    from the shared queue until None. The round trip of every batch is reported to the sizer,
+    rows and bytes to the metrics of the address. With the throttle a batch waits for its tokens
+    and a free slot, its time and rows not set drive the concurrency limit
+    """
+    if server_metrics is None:
+        server_metrics = metrics.get_registry().server(memc_addr)
+    addr, port = memc_addr.split()
+    # a (host, port) tuple would be taken by python-memcached as (server, weight)
+    memc = memcache.Client(["%s:%d" % (addr, int(port))], socket_timeout=CONNECTION_TIMEOUT,
+                           dead_retry=CONNECTION_TIMEOUT)
+    while True:
+        item = input_q.get()
+        if item is None:
+            input_q.task_done()
+            return
+        packed_batch, result = item
+        if writer_throttle is not None:
+            started = writer_throttle.acquire(len(packed_batch))
+        try:
+            start = time.time()
+            rows, errors = insert_appsinstalled(memc, packed_batch, dry_run, server_metrics)
+            sizer.update(len(packed_batch), time.time() - start)
+        except Exception as e:
+            logging.exception("Cannot write to memc %s: %s" % (memc_addr, e))
+            rows = errors = len(packed_batch)
+        if writer_throttle is not None:
+            writer_throttle.release(started, errors)
+        server_metrics.batch(rows, errors, batch_bytes(packed_batch))
+        result.done(rows, errors)
+        input_q.task_done()
 
-    lines_batch_dict, errors = process_lines_in_files(fname, fd, device_memc, lines_batch_dict, workers_queue_dict)
 
-    for key in lines_batch_dict.keys():
-        appsinstalled_dict = lines_batch_dict.get(key)
-        if len(appsinstalled_dict.keys()):
-            workers_queue_dict.get(key).queue_in.put(appsinstalled_dict)
-            lines_batch_dict[key] = {}
-        workers_queue_dict.get(key).queue_in.put('end')
+class ServerPool(object):
+    """ Connections to one memcached address shared by all files of the worker process. `connections` writer
+    threads take batches from one bounded queue. python-memcached clients are thread-local, so every thread
+    has its own client and there are up to `connections` set_multi in flight to the server (fewer with
+    the adaptive concurrency of the throttle)
+    """
+
+    def __init__(self, memc_addr, connections=CONNECTIONS_PER_SERVER, queue_depth=QUEUE_DEPTH, dry_run=False,
+                 sizer=None, writer_throttle=None):
+        self.memc_addr = memc_addr
+        self.queue_in = queue.Queue(maxsize=queue_depth)
+        self.sizer = sizer or BatchSizer()
+        self.throttle = writer_throttle
+        self.metrics = metrics.get_registry().server(memc_addr)
+        self.metrics.queues.append(self.queue_in.qsize)
+        if self.throttle is not None and self.throttle.limit is not None:
+            self.metrics.limits.append(self.throttle.limit_value)
+        self.threads = []
+        for _ in range(connections):
+            t = threading.Thread(target=do_work, args=(memc_addr, self.queue_in, self.sizer, dry_run, self.metrics,
+                                                       self.throttle))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def put(self, packed_batch, result):
+        """ Hand the batch to writers, blocks while the queue is full """
+        result.add_pending()
+        self.queue_in.put((packed_batch, result))
+
+    def close(self):
+        for _ in self.threads:
+            self.queue_in.put(None)
+        for t in self.threads:
+            t.join()
+        self.metrics.queues.remove(self.queue_in.qsize)
+        if self.throttle is not None and self.throttle.limit is not None:
+            self.metrics.limits.remove(self.throttle.limit_value)
+
+
+# number of worker processes loading a file (or a block of --split-files) now, shared by the pool of main.
+# --rate of a node is divided among them. None in a process which is not a worker of main: the whole rate
+active_writers = None
+
+
+def init_worker(writers, reports_q=None, metrics_interval=metrics.REPORT_INTERVAL):
+    """ Initializer of worker processes: the shared counter of active writers, the metrics reporter and
+    the finalizer which closes server pools when the worker exits
+    """
+    global active_writers
+    active_writers = writers
+    if reports_q is not None:
+        metrics.start_reporter(reports_q, metrics_interval)
+    # before the finalizer of the metrics queue (exitpriority 10), so the last report is sent
+    mp.util.Finalize(None, close_worker, exitpriority=20)
+
+
+def close_worker():
+    """ Finalizer of worker processes: write batches left in the queues of server pools, close them and send
+    the last metrics
+    """
+    close_server_pools()
+    metrics.report()
+
+
+def writer_shares():
+    """ Number of worker processes writing now (at least 1): this process gets 1 / shares of --rate """
+    if active_writers is None:
+        return 1
+    return max(1, active_writers.value)
+
+
+def count_writer(delta):
+    """ This worker starts (1) or finishes (-1) writing a file or a block """
+    if active_writers is not None:
+        with active_writers.get_lock():
+            active_writers.value += delta
+
+
+# ServerPool by (process id, memcached address, dry run). Pools of the parent process are not valid
+# in a forked worker (their threads are not there)
+server_pools = {}
+
+
+def get_server_pool(memc_addr, options):
+    """ ServerPool (AsyncServerPool with --backend asyncio) of the address, created at the first use
+    in the process and kept for the next files
+    """
+    key = (os.getpid(), memc_addr, options.dry)
+    pool = server_pools.get(key)
+    if pool is None:
+        if options.adaptive_batch:
+            sizer = BatchSizer(options.batch_size)
+        else:
+            sizer = BatchSizer(options.batch_size, options.batch_size, options.batch_size)
+        # the rate is divided among the worker processes which are writing now, every one of them writes to every node
+        if options.backend == 'asyncio':
+            limit = int(options.connections) * int(options.pipeline) if options.adaptive_concurrency else None
+            pool = memc_async.AsyncServerPool(
+                memc_addr, int(options.connections), int(options.queue_depth), options.dry, sizer,
+                int(options.pipeline),
+                writer_throttle=throttle.AsyncThrottle(options.rate, limit, options.max_rtt, writer_shares))
+        else:
+            limit = int(options.connections) if options.adaptive_concurrency else None
+            pool = ServerPool(memc_addr, int(options.connections), int(options.queue_depth), options.dry, sizer,
+                              throttle.Throttle(options.rate, limit, options.max_rtt, writer_shares))
+        server_pools[key] = pool
+    return pool
+
+
+def close_server_pools():
+    """ Stop writer threads and close connections of all pools of this process """
+    for key in [key for key in server_pools if key[0] == os.getpid()]:
+        server_pools.pop(key).close()
+    server_pools.clear()
+
+
+def put_until_stopped(q, item, stop):
+    """ Put the item on the bounded queue, give up if the consumer has stopped. Return True if the item is put """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def block_lines(block):
+    """ Number of lines in the block of bytes, only the last block of the file may have no newline at the end """
+    return block.count(b'\n') + (not block.endswith(b'\n'))
+
+
+def skip_lines(blocks, lines):
+    """ Blocks of bytes (ending at line boundaries) without the first `lines` lines """
+    for block in blocks:
+        if lines:
+            count = block_lines(block)
+            if count <= lines:
+                lines -= count
+                continue
+            pos = 0
+            for _ in range(lines):
+                pos = block.index(b'\n', pos) + 1
+            block = block[pos:]
+            lines = 0
+        yield block
+
+
+def read_line_blocks(fn, blocks_q, stop, block_size=gzip_reader.BLOCK_SIZE, skip=0):
+    """ Reader stage: put blocks of lines (lists of str) of the gz file on the bounded queue, the first `skip` lines
+    are loaded already. None marks the end of the file, an exception is passed to the parser as is
+    """
+    try:
+        for block in skip_lines(gzip_reader.gzip_blocks(fn, block_size), skip):
+            lines = block.decode('utf-8').split('\n')
+            if not lines[-1]:
+                lines.pop()
+            if not put_until_stopped(blocks_q, lines, stop):
+                return
+        put_until_stopped(blocks_q, None, stop)
+    except Exception as e:
+        put_until_stopped(blocks_q, e, stop)
 
-    for value in workers_queue_dict.values():
-        w_line_process = value.queue_out.get()
-        processed += w_line_process[0]
-        errors += w_line_process[1]
 
-    if not processed:
-        fd.close()
-        return fn
+def iter_line_blocks(blocks_q):
+    """ Blocks of lines from the reader stage """
+    while True:
+        block = blocks_q.get()
+        if block is None:
+            return
+        if isinstance(block, Exception):
+            raise block
+        yield block
+
+
+def process_lines_in_files(fname, line_blocks, device_memc, pools, results, checkpoint=None):
+    """ Parser stage: parse and serialize blocks of lines by encode_lines, collect records into batches per
+    memcached node (lists of (key, packed) pairs) and hand full batches to the server pools. The node of the key
+    is chosen by the HashRing of the device type. The size of batches is set by the pool's BatchSizer. put() blocks
+    while the pool's queue is full, so a slow memcached stops the parser and the reader instead of growing the queue.
+    With the checkpoint batches don't span blocks: the rest of every block is put at its end.
+    Return the number of lines which can't be parsed
+    """
+    errors = 0
+    a = 0
+    registry = metrics.get_registry()
+    batches = {memc_addr: [] for memc_addr in pools}
+    block_results = results
+    for lines in line_blocks:
+        if checkpoint is not None:
+            block = checkpoint.start_block(len(lines))
+            block_results = {memc_addr: BlockResult(result, checkpoint, block) for memc_addr, result in results.items()}
+        records, block_errors = encode_lines(lines)
+        for dev_type, key, packed in records:
+            ring = device_memc.get(dev_type)
+            if not ring:
+                block_errors += 1
+                logging.error("Unknown device type: %s" % dev_type)
+                continue
+
+            memc_addr = ring.get_node(key)
+            batch = batches[memc_addr]
+            batch.append((key, packed))
+            if len(batch) >= pools[memc_addr].sizer.size:
+                pools[memc_addr].put(batch, block_results[memc_addr])
+                batches[memc_addr] = []
+
+            a += 1
+            if a % READ_LOG_SIZE == 0:
+                logging.info('Read {} rows in file {}'.format(a, fname))
+
+        errors += block_errors
+        registry.parsed(len(lines), block_errors)
+        if checkpoint is not None:
+            put_batches(pools, batches, block_results)
+            checkpoint.close_block(block, block_errors)
+            checkpoint.maybe_save()
+
+    put_batches(pools, batches, block_results)
+    return errors
+
+
+def put_batches(pools, batches, results):
+    """ Put the rest of batches to the pools and empty them """
+    for memc_addr, batch in batches.items():
+        if batch:
+            pools[memc_addr].put(batch, results[memc_addr])
+            batches[memc_addr] = []
+
+
+def device_rings(options):
+    """ HashRing of memcached nodes of every device type. Options are lists of nodes: 'host port,host port' """
+    return {
+        "idfa": ketama.HashRing(ketama.parse_nodes(options.idfa)),
+        "gaid": ketama.HashRing(ketama.parse_nodes(options.gaid)),
+        "adid": ketama.HashRing(ketama.parse_nodes(options.adid)),
+        "dvid": ketama.HashRing(ketama.parse_nodes(options.dvid)),
+    }
+
+
+def check_error_rate(processed, errors):
+    """ Log the error rate of the file (errors of all rows and lines). Return True if the load is successful:
+    a file of only wrong lines is failed, so it is not renamed and is loaded again
+    """
+    if not processed and not errors:
+        return True
 
-    err_rate = float(errors) / processed
+    err_rate = float(errors) / (processed + errors)
     if err_rate < NORMAL_ERR_RATE:
         logging.info("Acceptable error rate (%s). Successfull load" % err_rate)
-    else:
-        logging.error("High error rate (%s > %s). Failed load" % (err_rate, NORMAL_ERR_RATE))
-    fd.close()
-    return fn
+        return True
+    logging.error("High error rate (%s > %s). Failed load" % (err_rate, NORMAL_ERR_RATE))
+    return False
+
+
+def load_line_blocks(options, fname, line_blocks, log_nodes=True, checkpoint=None):
+    """ Parse, serialize and write blocks of lines to memcached nodes by the server pools of this process.
+    Return after all batches are written
+
+    Returns:
+        number of rows processed by writers and the number of errors (wrong lines and rows which are not set)
+    """
+    device_memc = device_rings(options)
+    processed = write_errors = 0
+    # device types with the same nodes share the pools
+    nodes = sorted(set(node for ring in device_memc.values() for node in ring.nodes))
+    pools = {memc_addr: get_server_pool(memc_addr, options) for memc_addr in nodes}
+    results = {memc_addr: WriteResult(memc_addr) for memc_addr in pools}
+    try:
+        errors = process_lines_in_files(fname, line_blocks, device_memc, pools, results, checkpoint)
+    finally:
+        # batches already put are written anyway
+        for result in results.values():
+            w_processed, w_errors = result.wait(log_nodes)
+            processed += w_processed
+            write_errors += w_errors
+    return processed, errors + write_errors
+
+
+def process_file(options, fn):
+    """ Load one file by the pipeline: reader thread -> parser/serializer (this thread) -> writer threads
+    of the ServerPool of every memcached node. Pools are kept for the next files of the process.
+    Lines acknowledged by the checkpoint of an interrupted run are skipped, the checkpoint is saved if the load fails
+    and removed when the file is finished. Return fn if the error rate is acceptable, None otherwise
+    """
+    head, fname = os.path.split(fn)
+    logging.info('Processing %s' % fname)
+    checkpoint = get_checkpoint(options, fn)
+    skip = checkpoint.lines if checkpoint else 0
+    blocks_q = queue.Queue(maxsize=int(options.queue_depth))
+    stop = threading.Event()
+    reader = threading.Thread(target=read_line_blocks, args=(fn, blocks_q, stop, int(options.block_size), skip))
+    reader.daemon = True
+    reader.start()
+
+    count_writer(1)
+    try:
+        processed, errors = load_line_blocks(options, fname, iter_line_blocks(blocks_q), checkpoint=checkpoint)
+    except Exception:
+        if checkpoint is not None:
+            checkpoint.save()
+        raise
+    finally:
+        count_writer(-1)
+        stop.set()
+        reader.join()
+        metrics.report()
+    if checkpoint is not None:
+        # all blocks are acknowledged: rows and errors of the whole file, including the interrupted runs
+        processed, errors = checkpoint.processed, checkpoint.errors
+        checkpoint.remove()
+    return fn if check_error_rate(processed, errors) else None
+
+
+def process_block(options, fname, block):
+    """ Task of --split-files mode in the worker process: load one block of lines (bytes ending at a line
+    boundary) of the file. Return the number of processed rows and errors
+    """
+    count_writer(1)
+    try:
+        return load_line_blocks(options, fname, [block.decode('utf-8').split('\n')], log_nodes=False)
+    finally:
+        count_writer(-1)
+        metrics.report()
+
+
+def process_file_split(options, pool, fn):
+    """ --split-files mode: this process decompresses the file and ships blocks of lines to the worker pool,
+    so one large file is parsed, serialized and written by all workers. At most SPLIT_BLOCKS_PER_WORKER blocks
+    per worker are in flight (pool.imap would read the whole file ahead). Results of blocks are summed into
+    the error rate of the file. A block is acknowledged by the checkpoint when its task returns.
+    Return fn if the error rate is acceptable, None otherwise
+    """
+    head, fname = os.path.split(fn)
+    logging.info('Processing %s by blocks' % fname)
+    checkpoint = get_checkpoint(options, fn)
+    max_in_flight = SPLIT_BLOCKS_PER_WORKER * int(options.w)
+    in_flight = collections.deque()
+    processed = errors = blocks = 0
+    if checkpoint is not None:
+        processed, errors = checkpoint.processed, checkpoint.errors
+
+    def collect():
+        task, block = in_flight.popleft()
+        b_processed, b_errors = task.get()
+        if checkpoint is not None:
+            checkpoint.done(block, b_processed, b_errors)
+            checkpoint.maybe_save()
+        return b_processed, b_errors
+
+    try:
+        for block in skip_lines(gzip_reader.gzip_blocks(fn, int(options.block_size)),
+                                checkpoint.lines if checkpoint else 0):
+            if len(in_flight) >= max_in_flight:
+                b_processed, b_errors = collect()
+                processed += b_processed
+                errors += b_errors
+            number = None
+            if checkpoint is not None:
+                number = checkpoint.start_block(block_lines(block))
+                checkpoint.add_pending(number)
+                checkpoint.close_block(number)
+            in_flight.append((pool.apply_async(process_block, (options, fname, block)), number))
+            blocks += 1
+        while in_flight:
+            b_processed, b_errors = collect()
+            processed += b_processed
+            errors += b_errors
+    except Exception:
+        if checkpoint is not None:
+            checkpoint.save()
+        raise
+    if checkpoint is not None:
+        checkpoint.remove()
+    logging.info('Processed {} rows of {} in {} blocks'.format(processed, fname, blocks))
+    return fn if check_error_rate(processed, errors) else None
 
 
 def main(options):
 
     logging.info("Memc loader started with options: %s" % options)
     files_to_process = glob.iglob(options.pattern)
+    exporter = reports_q = None
+    if options.metrics_file or options.metrics_port is not None:
+        reports_q = mp.Queue()
+        exporter = metrics.Exporter(reports_q, options.metrics_file, options.metrics_port,
+                                    options.metrics_interval).start()
 
     try:
-        with mp.Pool(int(options.w)) as p:
-            for x in p.imap(partial(process_file, options), files_to_process):
-                dot_rename(x)
+        with mp.Pool(int(options.w), init_worker, (mp.Value('i', 0), reports_q, options.metrics_interval)) as p:
+            if options.split_files:
+                loaded = (process_file_split(options, p, fn) for fn in files_to_process)
+            else:
+                loaded = p.imap(partial(process_file, options), files_to_process)
+            for x in loaded:
+                # a dry run stores nothing, the file is left for the real one
+                if x and not options.dry:
+                    dot_rename(x)
+            # workers exit by themselves, so their last metrics are sent
+            p.close()
+            p.join()
 
     except Exception as e:
         logging.exception("Unexpected error: %s" % e)
         sys.exit(1)
+    finally:
+        if exporter is not None:
+            exporter.stop()
 
 
 def prototest():
@@ -237,18 +902,57 @@ def prototest():
         assert ua == unpacked
 
 
-if __name__ == '__main__':
+def build_parser():
     op = OptionParser()
     op.add_option("-t", "--test", action="store_true", default=False)
     op.add_option("-l", "--log", action="store", default=None)
     op.add_option("--dry", action="store_true", default=False)
     op.add_option("--pattern", action="store", default="./data/*.tsv.gz")
+    # every device type takes a comma separated list of nodes, keys are spread by the ketama hash ring
     op.add_option("--idfa", action="store", default="127.0.0.1 11212")
     op.add_option("--gaid", action="store", default="127.0.0.1 11212")
     op.add_option("--adid", action="store", default="127.0.0.1 11213")
     op.add_option("--dvid", action="store", default="127.0.0.1 11214")
     op.add_option('-w', help='Number of workers', default=None)
-    (opts, args) = op.parse_args()
+    op.add_option("--queue-depth", action="store", type="int", default=QUEUE_DEPTH,
+                  help='Max number of batches waiting in every queue of the pipeline')
+    op.add_option("--connections", action="store", type="int", default=CONNECTIONS_PER_SERVER,
+                  help='Connections to every memcached address in every worker process')
+    op.add_option("--batch-size", action="store", type="int", default=WORKER_BATCH_SIZE,
+                  help='Initial number of rows in set_multi')
+    op.add_option("--fixed-batch", action="store_false", dest="adaptive_batch", default=True,
+                  help="Don't adapt the batch size to the round trip time")
+    op.add_option("--backend", action="store", type="choice", choices=BACKENDS, default='thread',
+                  help="Writers: 'thread' - python-memcached client per thread (do_work), "
+                       "'asyncio' - pipelined text protocol with exponential backoff of retries")
+    op.add_option("--pipeline", action="store", type="int", default=memc_async.PIPELINE_DEPTH,
+                  help='Batches in flight on every connection of the asyncio backend')
+    op.add_option("--split-files", action="store_true", default=False,
+                  help='Read files one by one in the main process and ship blocks of lines to all workers')
+    op.add_option("--block-size", action="store", type="int", default=gzip_reader.BLOCK_SIZE,
+                  help='Bytes in a block of lines: the unit of --split-files tasks and of checkpoints')
+    op.add_option("--checkpoint-interval", action="store", type="float", default=CHECKPOINT_INTERVAL,
+                  help='Seconds between saves of the progress of a file, a restarted run skips loaded lines. '
+                       '0 - no checkpoints')
+    op.add_option("--metrics-file", action="store", default=None,
+                  help='JSON file of per-server metrics of all workers, rewritten every --metrics-interval seconds')
+    op.add_option("--metrics-port", action="store", type="int", default=None,
+                  help='Serve metrics in the Prometheus text format on 127.0.0.1:port/metrics')
+    op.add_option("--metrics-interval", action="store", type="float", default=metrics.REPORT_INTERVAL,
+                  help='Seconds between metrics reports of workers')
+    op.add_option("--rate", action="store", type="float", default=0,
+                  help='Max rows per second written to every memcached node by all workers, 0 - no limit. '
+                       'It is divided among the workers which are loading files at the moment')
+    op.add_option("--adaptive-concurrency", action="store_true", default=False,
+                  help='Adapt the number of batches in flight to every node (AIMD): halve it when a batch is '
+                       'slower than --max-rtt or has rows not set, grow it by one per round otherwise')
+    op.add_option("--max-rtt", action="store", type="float", default=throttle.MAX_RTT,
+                  help='Seconds of writing a batch taken as the sign of a loaded node by --adaptive-concurrency')
+    return op
+
+
+if __name__ == '__main__':
+    (opts, args) = build_parser().parse_args()
     if not opts.w:
         # assume we have two virtual cores per one physical. Spread process across virtual cores is inefficient, so we
         # use only physical cores
@@ -261,4 +965,4 @@ if __name__ == '__main__':
         prototest()
         sys.exit(0)
 
-    main(opts)
\ No newline at end of file
+    main(opts)
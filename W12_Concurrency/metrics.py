@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+""" Metrics of memc_load writers (--metrics-file, --metrics-port).
+
+Every process counts rows set and not set, batches, bytes written and retries of every memcached address,
+a histogram of set_multi round trips, the depth of the writers' queues, the concurrency limit of writers
+and parse errors in its Registry. Worker
+processes send snapshots of their registries to the main process every interval seconds and at the end of every
+file (start_reporter is the initializer of the pool). The Exporter of the main process sums the latest snapshot
+of every process, writes it to a JSON file and serves it in the Prometheus text format on 127.0.0.1:port/metrics.
+"""
+
+import os
+import json
+import time
+import queue
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds (seconds) of the buckets of the round trip histogram, the last bucket is +Inf
+RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+REPORT_INTERVAL = 1.0
+COUNTERS = ('sets', 'not_set', 'batches', 'bytes', 'retries')
+# name, type, help of the Prometheus metrics of every address
+SERVER_METRICS = (
+    ('sets', 'counter', 'Rows stored'),
+    ('not_set', 'counter', 'Rows not stored after all retries'),
+    ('batches', 'counter', 'Batches written'),
+    ('bytes', 'counter', 'Bytes of keys and values written'),
+    ('retries', 'counter', 'Retries of set_multi'),
+    ('queue_depth', 'gauge', 'Batches waiting for writers'),
+    ('concurrency_limit', 'gauge', 'Batches in flight allowed by the adaptive concurrency, 0 - no limit'),
+    ('sets_per_sec', 'gauge', 'Rows stored per second during the last interval'),
+)
+
+
+class ServerMetrics(object):
+    """ Metrics of one memcached address in this process. Writers of all pools of the address update it,
+    `queues` are qsize functions of the pools' queues, `limits` - functions of their concurrency limits
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.rtt_buckets = [0] * (len(RTT_BUCKETS) + 1)
+        self.rtt_sum = 0.0
+        self.queues = []
+        self.limits = []
+
+    def batch(self, rows, not_set, nbytes):
+        with self.lock:
+            self.counters['sets'] += rows - not_set
+            self.counters['not_set'] += not_set
+            self.counters['batches'] += 1
+            self.counters['bytes'] += nbytes
+
+    def retry(self):
+        with self.lock:
+            self.counters['retries'] += 1
+
+    def round_trip(self, seconds):
+        bucket = bisect.bisect_left(RTT_BUCKETS, seconds)
+        with self.lock:
+            self.rtt_buckets[bucket] += 1
+            self.rtt_sum += seconds
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = dict(self.counters, rtt_buckets=list(self.rtt_buckets), rtt_sum=self.rtt_sum)
+        snapshot['queue_depth'] = sum(qsize() for qsize in self.queues)
+        snapshot['concurrency_limit'] = sum(limit() for limit in self.limits)
+        return snapshot
+
+
+class Registry(object):
+    """ Metrics of this process: ServerMetrics by address, lines read and lines which can't be parsed """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.servers = {}
+        self.lines = self.parse_errors = 0
+
+    def server(self, memc_addr):
+        with self.lock:
+            if memc_addr not in self.servers:
+                self.servers[memc_addr] = ServerMetrics()
+            return self.servers[memc_addr]
+
+    def parsed(self, lines, errors):
+        with self.lock:
+            self.lines += lines
+            self.parse_errors += errors
+
+    def snapshot(self):
+        with self.lock:
+            servers = list(self.servers.items())
+            snapshot = {'pid': os.getpid(), 'lines': self.lines, 'parse_errors': self.parse_errors}
+        snapshot['servers'] = {memc_addr: server.snapshot() for memc_addr, server in servers}
+        return snapshot
+
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+_reports_q = None
+_reports_pid = None
+
+
+def get_registry():
+    """ Registry of this process (a forked worker starts with the new one, not with the copy of the parent's) """
+    global _registry, _registry_pid
+    with _registry_lock:
+        if _registry is None or _registry_pid != os.getpid():
+            _registry = Registry()
+            _registry_pid = os.getpid()
+    return _registry
+
+
+def start_reporter(reports_q, interval=REPORT_INTERVAL):
+    """ Initializer of worker processes: send snapshots of the registry to the main process every interval seconds """
+    global _reports_q, _reports_pid
+    _reports_q = reports_q
+    _reports_pid = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(interval)
+            report()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def report():
+    """ Send the snapshot of this process now, nothing if the process has no reporter """
+    if _reports_q is not None and _reports_pid == os.getpid():
+        _reports_q.put(get_registry().snapshot())
+
+
+def merge(snapshots):
+    """ Sum of process snapshots: counters, histograms and queue depths of every address """
+    merged = {'processes': len(snapshots), 'lines': 0, 'parse_errors': 0, 'servers': {}}
+    for snapshot in snapshots:
+        merged['lines'] += snapshot['lines']
+        merged['parse_errors'] += snapshot['parse_errors']
+        for memc_addr, server in snapshot['servers'].items():
+            total = merged['servers'].get(memc_addr)
+            if total is None:
+                merged['servers'][memc_addr] = dict(server, rtt_buckets=list(server['rtt_buckets']))
+                continue
+            for name in COUNTERS + ('queue_depth', 'concurrency_limit', 'rtt_sum'):
+                total[name] += server[name]
+            total['rtt_buckets'] = [a + b for a, b in zip(total['rtt_buckets'], server['rtt_buckets'])]
+    return merged
+
+
+def histogram(server):
+    """ Cumulative counts of round trips by the upper bound of the bucket (the Prometheus `le`) """
+    counts, total = [], 0
+    for bound, count in zip([str(bound) for bound in RTT_BUCKETS] + ['+Inf'], server['rtt_buckets']):
+        total += count
+        counts.append((bound, total))
+    return counts
+
+
+def to_json(merged):
+    servers = {}
+    for memc_addr, server in merged['servers'].items():
+        values = {name: server[name] for name, _, _ in SERVER_METRICS}
+        counts = histogram(server)
+        values['rtt'] = {'le': dict(counts), 'sum': server['rtt_sum'], 'count': counts[-1][1]}
+        servers[memc_addr] = values
+    return dict(merged, servers=servers)
+
+
+def to_prometheus(merged):
+    """ Metrics in the Prometheus text exposition format, the address is the `server` label """
+    lines = []
+
+    def add(name, kind, help_text, samples):
+        lines.append('# HELP memc_load_%s %s' % (name, help_text))
+        lines.append('# TYPE memc_load_%s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            lines.append('memc_load_%s%s%s %s' % (name, suffix, labels, value))
+
+    add('lines_total', 'counter', 'Lines read', [('', '', merged['lines'])])
+    add('parse_errors_total', 'counter', 'Lines which can not be parsed', [('', '', merged['parse_errors'])])
+    servers = sorted(merged['servers'].items())
+    for name, kind, help_text in SERVER_METRICS:
+        add(name + '_total' if kind == 'counter' else name, kind, help_text,
+            [('', '{server="%s"}' % memc_addr, server[name]) for memc_addr, server in servers])
+    samples = []
+    for memc_addr, server in servers:
+        counts = histogram(server)
+        samples.extend(('_bucket', '{server="%s",le="%s"}' % (memc_addr, bound), count) for bound, count in counts)
+        samples.append(('_sum', '{server="%s"}' % memc_addr, server['rtt_sum']))
+        samples.append(('_count', '{server="%s"}' % memc_addr, counts[-1][1]))
+    add('batch_rtt_seconds', 'histogram', 'Round trips of set_multi', samples)
+    return '\n'.join(lines) + '\n'
+
+
+class Exporter(object):
+    """ Main process: collects snapshots of worker processes from reports_q and exports their sum every interval
+    seconds to the JSON file at `path` and/or by the HTTP endpoint on `port` (0 - any free port)
+    """
+
+    def __init__(self, reports_q, path=None, port=None, interval=REPORT_INTERVAL):
+        self.reports_q = reports_q
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.last = None
+        self.last_sets = {}
+        self.rates = {}
+        self.thread = self.http = None
+
+    def start(self):
+        if self.port is not None:
+            exporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = to_prometheus(exporter.merged()).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.http = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            self.port = self.http.server_address[1]
+            threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.collect(self.interval)
+            self.export()
+
+    def collect(self, timeout):
+        """ Take snapshots from the queue for `timeout` seconds, keep the latest one of every process """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                snapshot = self.reports_q.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                return
+            with self.lock:
+                self.snapshots[snapshot['pid']] = snapshot
+
+    def merged(self):
+        with self.lock:
+            snapshots = dict(self.snapshots)
+            rates = dict(self.rates)
+        merged = merge(list(snapshots.values()))
+        for memc_addr, server in merged['servers'].items():
+            server['sets_per_sec'] = rates.get(memc_addr, 0.0)
+        return merged
+
+    def export(self):
+        """ Update rates of sets and write the JSON file """
+        merged = self.merged()
+        now = time.time()
+        with self.lock:
+            if self.last is not None and now > self.last:
+                self.rates = {memc_addr: (server['sets'] - self.last_sets.get(memc_addr, 0)) / (now - self.last)
+                              for memc_addr, server in merged['servers'].items()}
+            self.last = now
+            self.last_sets = {memc_addr: server['sets'] for memc_addr, server in merged['servers'].items()}
+        if self.path:
+            merged = dict(merged, time=now)
+            for memc_addr, server in merged['servers'].items():
+                server['sets_per_sec'] = self.rates.get(memc_addr, 0.0)
+            tmp = self.path + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(to_json(merged), f, indent=2, sort_keys=True)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logging.error("Cannot write metrics to %s: %s" % (self.path, e))
+
+    def stop(self):
+        """ Take the last snapshots of finished workers and export them """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.collect(0.1)
+        self.export()
+        if self.http is not None:
+            self.http.shutdown()
+            self.http.server_close()
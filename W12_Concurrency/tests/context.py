@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import memc_load
+import ketama
+import appsinstalled_pb2
+import metrics
+import throttle
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+""" Local stand-in of memcached for tests and benchmarks of memc_load.
+
+Speaks the part of the text protocol used by python-memcached: set (with noreply), get, delete, version, quit.
+Values are kept in a dict. Every read from a connection is answered after `latency` seconds, so pipelined
+commands of one set_multi pay the round trip once, like with the real server. `not_stored` is the share of
+set commands answered with NOT_STORED (the value is not kept), `not_stored_first` - the number of the first sets
+of every key answered with NOT_STORED. Like memcached, a set command with a key of spaces or longer than
+KEY_MAX_LENGTH gets an error and its data block is taken as the next command (which gets ERROR).
+"""
+
+import random
+import socket
+import threading
+import socketserver
+
+KEY_MAX_LENGTH = 250
+
+
+class FakeMemcached(object):
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, not_stored=0.0, not_stored_first=0, seed=0):
+        self.latency = latency
+        self.not_stored = not_stored
+        self.not_stored_first = not_stored_first
+        self.attempts = {}
+        self.random = random.Random(seed)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.sets = 0
+        self.round_trips = 0
+        fake = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                with fake.lock:
+                    fake.connections += 1
+                fake.serve(self.request)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    @property
+    def address(self):
+        """ Address in the format of memc_load options """
+        return '%s %d' % (self.host, self.port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def serve(self, sock):
+        buffer = b''
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            replies = []
+            while True:
+                consumed, reply = self.command(buffer)
+                if not consumed:
+                    break
+                buffer = buffer[consumed:]
+                if reply is None:
+                    return
+                replies.append(reply)
+            if replies:
+                if self.latency:
+                    threading.Event().wait(self.latency)
+                with self.lock:
+                    self.round_trips += 1
+                try:
+                    sock.sendall(b''.join(replies))
+                except OSError:
+                    return
+
+    def command(self, buffer):
+        """ Execute the first complete command of the buffer. Return the number of bytes consumed (0 if the command
+        is not complete yet) and the reply (b'' for noreply, None to close the connection)
+        """
+        end = buffer.find(b'\r\n')
+        if end < 0:
+            return 0, b''
+        parts = buffer[:end].split()
+        consumed = end + 2
+        if not parts:
+            return consumed, b'ERROR\r\n'
+        name = parts[0]
+        if name in (b'set', b'add', b'replace'):
+            if len(parts) not in (5, 6) or not parts[4].isdigit():
+                return consumed, b'ERROR\r\n'
+            if len(parts[1]) > KEY_MAX_LENGTH:
+                return consumed, b'CLIENT_ERROR bad command line format\r\n'
+            key, flags, length = parts[1], parts[2], int(parts[4])
+            noreply = parts[-1] == b'noreply'
+            if len(buffer) < consumed + length + 2:
+                return 0, b''
+            value = buffer[consumed:consumed + length]
+            consumed += length + 2
+            with self.lock:
+                self.sets += 1
+                stored = not (self.not_stored and self.random.random() < self.not_stored)
+                if self.not_stored_first:
+                    attempts = self.attempts[key] = self.attempts.get(key, 0) + 1
+                    stored = stored and attempts > self.not_stored_first
+                if stored:
+                    self.data[key] = (flags, value)
+            if noreply:
+                return consumed, b''
+            return consumed, b'STORED\r\n' if stored else b'NOT_STORED\r\n'
+        if name in (b'get', b'gets'):
+            reply = []
+            with self.lock:
+                for key in parts[1:]:
+                    if key in self.data:
+                        flags, value = self.data[key]
+                        reply.append(b'VALUE %s %s %d\r\n%s\r\n' % (key, flags, len(value), value))
+            return consumed, b''.join(reply) + b'END\r\n'
+        if name == b'delete':
+            with self.lock:
+                found = self.data.pop(parts[1], None) is not None
+            return consumed, b'DELETED\r\n' if found else b'NOT_FOUND\r\n'
+        if name == b'version':
+            return consumed, b'VERSION fake\r\n'
+        if name == b'quit':
+            return consumed, None
+        return consumed, b'ERROR\r\n'
+
+    def get(self, key):
+        """ Stored value of the key (str or bytes) or None """
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        item = self.data.get(key)
+        return item[1] if item else None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+from .context import memc_load
+from .fake_memcached import FakeMemcached
+from .test_memc_load import write_tsv
+import os
+import json
+import glob
+import shutil
+import logging
+import tempfile
+
+logging.disable(logging.CRITICAL)
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    """ Procedure:
+        1. Start fake memcached servers, create a gz file of small blocks in a temp dir
+        2. Load it by process_file, the parser fails in the middle of the file
+        3. Clear the servers and load the file again
+        ---------
+        Verification:
+        4. The state file keeps the lines of acknowledged blocks, all of them are stored by the failed run
+        5. The restarted run stores only the lines after the checkpoint, the state file is removed at the end
+        6. The state of a changed file is ignored, skip_lines cuts blocks at line boundaries
+        7. dot_rename hides the loaded file from the glob pattern
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = [FakeMemcached().start(), FakeMemcached().start()]
+        self.options, _ = memc_load.build_parser().parse_args(
+            ['--idfa', self.servers[0].address, '--gaid', self.servers[0].address,
+             '--adid', self.servers[1].address, '--dvid', self.servers[1].address,
+             '--block-size', '16384', '--checkpoint-interval', '0.001'])
+        self.path = os.path.join(self.dir, 'a.tsv.gz')
+        self.keys = list(write_tsv(self.path, 5000))
+
+    def stored_keys(self):
+        return set(key.decode() for server in self.servers for key in server.data)
+
+    def test_resume(self):
+        encode_lines = memc_load.encode_lines
+        calls = []
+
+        def failing_encode_lines(lines):
+            calls.append(len(lines))
+            if len(calls) == 6:
+                raise RuntimeError('crash')
+            return encode_lines(lines)
+
+        with mock.patch.object(memc_load, 'encode_lines', failing_encode_lines):
+            with self.assertRaises(RuntimeError):
+                memc_load.process_file(self.options, self.path)
+        with open(memc_load.state_path(self.path)) as f:
+            state = json.load(f)
+        self.assertEqual(sum(calls[:5]), state['lines'])
+        self.assertEqual((state['lines'], 0), (state['processed'], state['errors']))
+        self.assertEqual(set(self.keys[:state['lines']]), self.stored_keys())
+
+        for server in self.servers:
+            server.data.clear()
+        self.assertEqual(self.path, memc_load.process_file(self.options, self.path))
+        self.assertEqual(set(self.keys[state['lines']:]), self.stored_keys())
+        self.assertFalse(os.path.exists(memc_load.state_path(self.path)))
+
+    def test_changed_file(self):
+        with open(memc_load.state_path(self.path), 'w') as f:
+            json.dump({'file': [1, 1], 'lines': 4000, 'processed': 4000, 'errors': 0}, f)
+        self.assertEqual(self.path, memc_load.process_file(self.options, self.path))
+        self.assertEqual(set(self.keys), self.stored_keys())
+
+    def test_skip_lines(self):
+        blocks = [b'1\n2\n3\n', b'4\n', b'5\n6\n7']
+        lines = b''.join(blocks).split(b'\n')
+        for skip in range(9):
+            rest = b''.join(memc_load.skip_lines(blocks, skip))
+            self.assertEqual(lines[skip:], rest.split(b'\n') if rest else [])
+        self.assertEqual([3, 1, 3], [memc_load.block_lines(block) for block in blocks])
+
+    def test_dot_rename(self):
+        memc_load.dot_rename(self.path)
+        self.assertEqual([], glob.glob(os.path.join(self.dir, '*.tsv.gz')))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, '.a.tsv.gz')))
+
+    def tearDown(self):
+        memc_load.close_server_pools()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
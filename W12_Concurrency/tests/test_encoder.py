@@ -0,0 +1,65 @@
+import unittest
+from .context import memc_load, appsinstalled_pb2
+import random
+import logging
+
+logging.disable(logging.CRITICAL)
+
+
+def unpack(packed):
+    ua = appsinstalled_pb2.UserApps()
+    ua.ParseFromString(packed)
+    return ua
+
+
+class TestEncoder(unittest.TestCase):
+
+    """ Procedure:
+        1. Generate lines with random coordinates and app ids (including large ids and spaces around ids)
+        2. Encode them by encode_lines and by parse_appsinstalled + get_packed
+        ---------
+        Verification:
+        3. Keys are the same, every value parses to the same UserApps message
+        4. Wrong lines (not 5 fields, empty device id, invalid coordinates) are counted as errors,
+        apps which are not uint32 are skipped
+    """
+
+    def test_same_messages(self):
+        rnd = random.Random(1)
+        lines = []
+        for i in range(2000):
+            apps = [rnd.choice((rnd.randint(0, 127), rnd.randint(128, 20000), rnd.randint(2 ** 20, 2 ** 32 - 1)))
+                    for _ in range(rnd.randint(1, 80))]
+            lines.append('%s\t%08x\t%s\t%s\t%s\n' % (rnd.choice(('idfa', 'gaid', 'adid', 'dvid')), i,
+                                                     rnd.uniform(-90, 90), rnd.uniform(-180, 180),
+                                                     ','.join(' %d' % app if i % 7 == 0 else str(app) for app in apps)))
+        records, errors = memc_load.encode_lines(lines)
+        self.assertEqual(0, errors)
+        self.assertEqual(len(lines), len(records))
+        for line, (dev_type, key, packed) in zip(lines, records):
+            expected_key, expected = memc_load.get_packed(memc_load.parse_appsinstalled(line))
+            self.assertEqual((expected_key, line.split('\t')[0]), (key, dev_type))
+            self.assertEqual(unpack(expected), unpack(packed))
+
+    def test_wrong_lines(self):
+        records, errors = memc_load.encode_lines(['idfa\tabc\t1.5\t2.5',
+                                                  'idfa\t\t1.5\t2.5\t1,2',
+                                                  'idfa\tabc\tnorth\t2.5\t1,2',
+                                                  'idfa\tabc\t1.5\t2.5\t1,2\textra',
+                                                  '',
+                                                  'gaid\tdef\t1.5\t2.5\t1,x,%d,3' % 2 ** 32,
+                                                  'adid\tghi\t-1\t0\t,'])
+        self.assertEqual(4, errors)
+        self.assertEqual(['gaid:def', 'adid:ghi'], [key for _, key, _ in records])
+        self.assertEqual([1, 3], list(unpack(records[0][2]).apps))
+        ua = unpack(records[1][2])
+        self.assertEqual(([], -1.0, 0.0), (list(ua.apps), ua.lat, ua.lon))
+
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 16383, 16384, 2 ** 32 - 1):
+            ua = unpack(memc_load.APPS_TAG + memc_load.varint(len(memc_load.varint(value))) + memc_load.varint(value))
+            self.assertEqual([value], list(ua.apps))
+
+
+if __name__ == '__main__':
+    unittest.main()
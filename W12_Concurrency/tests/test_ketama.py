@@ -0,0 +1,122 @@
+import unittest
+from .context import memc_load, ketama
+from .fake_memcached import FakeMemcached
+from .test_memc_load import write_tsv
+import os
+import shutil
+import logging
+import tempfile
+from collections import Counter
+
+logging.disable(logging.CRITICAL)
+
+# reference values of a ketama client: uhashring 2.5, HashRing(KETAMA_SERVERS, hash_fn='ketama')
+KETAMA_SERVERS = ['10.0.0.1:11211', '10.0.0.2:11211', '10.0.0.3:11212']
+# points of md5('10.0.0.1:11211-0') and md5('10.0.0.3:11212-39')
+KETAMA_NODE_POINTS = {
+    '10.0.0.1 11211': [1644766326, 266575842, 1549369152, 2004188753],
+    '10.0.0.3 11212': [2281152215, 2157892675, 242174498, 3934702953],
+}
+KETAMA_FIRST_POINTS = [(3706987, '10.0.0.3 11212'), (6707921, '10.0.0.3 11212'), (7234733, '10.0.0.2 11211'),
+                       (12697329, '10.0.0.2 11211'), (39361663, '10.0.0.2 11211')]
+KETAMA_KEYS = {
+    # key: (hash, node)
+    'idfa:1rfw452y52g2gq4g': (3350211614, '10.0.0.2 11211'),
+    'gaid:7rfw452y52g2gq4g': (2788262997, '10.0.0.1 11211'),
+    'foo': (3675831724, '10.0.0.2 11211'),
+    'bar': (421377335, '10.0.0.1 11211'),
+    'test': (3446378249, '10.0.0.3 11212'),
+    'memcached': (1357326829, '10.0.0.3 11212'),
+    'idfa:00000000': (3163411291, '10.0.0.1 11211'),
+    'adid:ffffffff': (3263914088, '10.0.0.1 11211'),
+    'dvid:12345': (4064062539, '10.0.0.3 11212'),
+    'key-42': (2735195844, '10.0.0.2 11211'),
+}
+
+
+class TestKetama(unittest.TestCase):
+
+    """ Procedure:
+        1. Build hash rings of 1-5 nodes, map 20000 keys
+        2. Start three fake memcached servers, load a file with idfa keys spread over them
+        ---------
+        Verification:
+        3. Node lists are parsed in both address formats, keys are spread evenly
+        4. Adding or removing a node moves only keys of that node
+        5. Every key is stored on the node of the ring, every node gets its share
+        6. Points, key hashes and nodes of keys are the same as of a ketama client (uhashring)
+    """
+
+    def setUp(self):
+        self.keys = ['idfa:%08x' % i for i in range(20000)]
+        self.nodes = ['10.0.0.%d 11211' % i for i in range(1, 6)]
+
+    def test_parse_nodes(self):
+        self.assertEqual(['127.0.0.1 11211', '10.0.0.2 11212'],
+                         ketama.parse_nodes('127.0.0.1 11211, 10.0.0.2:11212'))
+        for value in ('', '127.0.0.1', '127.0.0.1 port'):
+            with self.assertRaises(ValueError):
+                ketama.parse_nodes(value)
+
+    def test_distribution(self):
+        ring = ketama.HashRing(self.nodes)
+        counts = Counter(ring.get_node(key) for key in self.keys)
+        self.assertEqual(set(self.nodes), set(counts))
+        for count in counts.values():
+            self.assertLess(abs(count - 4000), 4000 * 0.25)
+        self.assertEqual(ring.get_node(self.keys[0]), ketama.HashRing(list(reversed(self.nodes))).get_node(self.keys[0]))
+        self.assertEqual(self.nodes[0], ketama.HashRing(self.nodes[:1]).get_node(self.keys[0]))
+
+    def test_node_changes(self):
+        ring = ketama.HashRing(self.nodes[:4])
+        before = {key: ring.get_node(key) for key in self.keys}
+        removed = ketama.HashRing(self.nodes[:3])
+        added = ketama.HashRing(self.nodes)
+        for key, node in before.items():
+            if node != self.nodes[3]:
+                self.assertEqual(node, removed.get_node(key))
+            new_node = added.get_node(key)
+            self.assertIn(new_node, (node, self.nodes[4]))
+        moved = sum(added.get_node(key) != node for key, node in before.items())
+        self.assertLess(moved, len(self.keys) * 0.3)
+
+    def test_ketama_compatible(self):
+        ring = ketama.HashRing(ketama.parse_nodes(','.join(KETAMA_SERVERS)))
+        self.assertEqual(480, len(ring.points))
+        for node, points in KETAMA_NODE_POINTS.items():
+            for point in points:
+                self.assertEqual(node, ring.point_nodes[ring.points.index(point)])
+        self.assertEqual(KETAMA_FIRST_POINTS, list(zip(ring.points[:5], ring.point_nodes[:5])))
+        for key, (key_hash, node) in KETAMA_KEYS.items():
+            self.assertEqual(key_hash, ketama.key_hash(key))
+            self.assertEqual(node, ring.get_node(key))
+
+    def test_load_to_ring(self):
+        tmp = tempfile.mkdtemp()
+        servers = [FakeMemcached().start() for _ in range(3)]
+        try:
+            addresses = ','.join(server.address for server in servers)
+            options, _ = memc_load.build_parser().parse_args(
+                ['--idfa', addresses, '--gaid', addresses, '--adid', servers[0].address, '--dvid', servers[1].address])
+            path = os.path.join(tmp, 'a.tsv.gz')
+            records = write_tsv(path, 3000)
+            memc_load.process_file(options, path)
+
+            ring = ketama.HashRing([server.address for server in servers])
+            for key in records:
+                if key.startswith(('idfa', 'gaid')):
+                    node = ring.get_node(key)
+                    for server in servers:
+                        self.assertEqual(server.address == node, server.get(key) is not None)
+            for server in servers:
+                self.assertGreater(len(server.data), 200)
+            self.assertEqual(3000, sum(len(server.data) for server in servers))
+        finally:
+            memc_load.close_server_pools()
+            for server in servers:
+                server.stop()
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
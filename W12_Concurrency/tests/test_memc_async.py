@@ -0,0 +1,115 @@
+import unittest
+from .context import memc_load, appsinstalled_pb2
+from .fake_memcached import FakeMemcached, free_port
+from .test_memc_load import write_tsv
+import os
+import shutil
+import asyncio
+import logging
+import tempfile
+
+logging.disable(logging.CRITICAL)
+
+
+class TestMemcAsync(unittest.TestCase):
+
+    """ Procedure:
+        1. Start fake memcached servers, one of them answers NOT_STORED to the first two sets of every key
+        2. Load gz files by process_file with --backend asyncio
+        ---------
+        Verification:
+        3. Every valid line is stored, keys which are not stored are retried
+        4. Pipelined batches on one connection get their own replies, invalid keys are not sent
+        and are returned as not stored
+        5. Unavailable server doesn't stop the load of other servers, backoff delays grow exponentially
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = [FakeMemcached().start(), FakeMemcached(not_stored_first=2).start()]
+        self.options, _ = memc_load.build_parser().parse_args(
+            ['--idfa', self.servers[0].address, '--gaid', self.servers[0].address,
+             '--adid', self.servers[1].address, '--dvid', self.servers[1].address,
+             '--backend', 'asyncio', '--connections', '2', '--pipeline', '3'])
+        self.backoff_base = memc_load.memc_async.BACKOFF_BASE
+        memc_load.memc_async.BACKOFF_BASE = 0.001
+
+    def check_stored(self, records):
+        for key, (lat, lon, apps) in records.items():
+            server = self.servers[0] if key.startswith(('idfa', 'gaid')) else self.servers[1]
+            ua = appsinstalled_pb2.UserApps()
+            ua.ParseFromString(server.get(key))
+            self.assertEqual((lat, lon, apps), (ua.lat, ua.lon, list(ua.apps)))
+
+    def test_process_file(self):
+        records = {}
+        for i in range(2):
+            path = os.path.join(self.dir, 'f%03d.tsv.gz' % i)
+            records.update(write_tsv(path, 2000, seed=i, bad_lines=1))
+            memc_load.process_file(self.options, path)
+        self.check_stored(records)
+        self.assertEqual(4000, sum(len(server.data) for server in self.servers))
+        # every key of the second server is set three times
+        self.assertEqual(3 * 2000, self.servers[1].sets)
+        self.assertLessEqual(self.servers[0].connections, 2)
+
+    def test_pipelined_connection(self):
+        connection_args = (self.servers[0].host, self.servers[0].port)
+
+        async def write():
+            connection = memc_load.memc_async.Connection(*connection_args, pipeline=4)
+            batches = [[('k%d:%d' % (b, i), b'v%d' % i) for i in range(50)] for b in range(8)]
+            failed = await asyncio.gather(*[connection.set_multi(batch) for batch in batches])
+            await connection.close()
+            return failed
+
+        self.assertEqual([[]] * 8, asyncio.run(write()))
+        self.assertEqual(400, len(self.servers[0].data))
+        self.assertEqual(b'v7', self.servers[0].get('k5:7'))
+
+    def test_invalid_keys(self):
+        connection_args = (self.servers[0].host, self.servers[0].port)
+        bad_keys = ['idfa:bad id', 'idfa:' + 'x' * 250, 'idfa:tab\tid']
+
+        async def write():
+            connection = memc_load.memc_async.Connection(*connection_args, pipeline=4)
+            batches = [[('k%d:%d' % (b, i), b'v%d' % i) for i in range(50)] for b in range(6)]
+            batches[2][10:10] = [(key, b'bad') for key in bad_keys]
+            failed = await asyncio.gather(*[connection.set_multi(batch) for batch in batches])
+            await connection.close()
+            return failed
+
+        failed = asyncio.run(write())
+        self.assertEqual([[], [], bad_keys, [], [], []], failed)
+        self.assertEqual(300, len(self.servers[0].data))
+
+        # a wrong dev_id inside a batch is one error of the load, the rest of rows are stored
+        lines = ['idfa\t%08x\t1.5\t2.5\t1,2' % i for i in range(500)]
+        lines[250] = 'idfa\tbad id\t1.5\t2.5\t1,2'
+        processed, errors = memc_load.load_line_blocks(self.options, 'lines', [lines], log_nodes=False)
+        self.assertEqual((500, 1), (processed, errors))
+        self.assertEqual(300 + 499, len(self.servers[0].data))
+
+    def test_unavailable_server(self):
+        path = os.path.join(self.dir, 'a.tsv.gz')
+        records = write_tsv(path, 400)
+        self.options.adid = self.options.dvid = '127.0.0.1 %d' % free_port()
+        memc_load.process_file(self.options, path)
+        self.check_stored({key: value for key, value in records.items() if key.startswith(('idfa', 'gaid'))})
+
+    def test_backoff_delay(self):
+        delays = [memc_load.memc_async.backoff_delay(attempt, 0.1, 1.0) for attempt in range(1, 7)]
+        for attempt, delay in enumerate(delays, 1):
+            limit = min(1.0, 0.1 * 2 ** (attempt - 1))
+            self.assertTrue(limit / 2 <= delay <= limit)
+
+    def tearDown(self):
+        memc_load.memc_async.BACKOFF_BASE = self.backoff_base
+        memc_load.close_server_pools()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import unittest
+from .context import memc_load, appsinstalled_pb2
+from .fake_memcached import FakeMemcached, free_port
+import os
+import gzip
+import random
+import shutil
+import logging
+import tempfile
+import multiprocessing as mp
+
+logging.disable(logging.CRITICAL)
+
+DEV_TYPES = ('idfa', 'gaid', 'adid', 'dvid')
+
+
+def write_tsv(path, lines, seed=0, bad_lines=0):
+    """ Write gz file of lines in memc_load format, return {key: (lat, lon, apps)} of valid lines """
+    rnd = random.Random(seed)
+    records = {}
+    with gzip.open(path, 'wt') as file:
+        for i in range(lines):
+            dev_type, dev_id = DEV_TYPES[i % 4], '%s%08x' % (os.path.basename(path)[:4], i)
+            lat, lon = round(rnd.uniform(-90, 90), 2), round(rnd.uniform(-180, 180), 2)
+            apps = [rnd.randint(1, 10000) for _ in range(rnd.randint(1, 10))]
+            file.write('%s\t%s\t%s\t%s\t%s\n' % (dev_type, dev_id, lat, lon, ','.join(map(str, apps))))
+            records['%s:%s' % (dev_type, dev_id)] = (lat, lon, apps)
+        for i in range(bad_lines):
+            file.write('bad line %d\n' % i)
+    return records
+
+
+def put_batches(options, memc_addr):
+    """ Task of a worker process: put batches to the server pool and return without waiting for them """
+    pool = memc_load.get_server_pool(memc_addr, options)
+    result = memc_load.WriteResult(memc_addr)
+    for i in range(10):
+        pool.put([('idfa:%d-%d' % (i, j), b'v') for j in range(10)], result)
+
+
+class TestMemcLoad(unittest.TestCase):
+
+    """ Procedure:
+        1. Start fake memcached servers: one for idfa and gaid, one for adid and dvid
+        2. Create gz files in a temp dir and load them by process_file
+        ---------
+        Verification:
+        3. Every valid line is stored with the key dev_type:dev_id and the value is UserApps of the line
+        4. Server pools are shared by files: the number of connections doesn't grow with the number of files,
+        batches left in the queues of pools are written when the worker process exits
+        5. The batch size grows while round trips are fast and shrinks when they are slow
+        6. Invalid keys in a batch are not set, other rows of the batch are stored
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = [FakeMemcached().start(), FakeMemcached().start()]
+        self.options, _ = memc_load.build_parser().parse_args(
+            ['--idfa', self.servers[0].address, '--gaid', self.servers[0].address,
+             '--adid', self.servers[1].address, '--dvid', self.servers[1].address, '--connections', '3'])
+
+    def check_stored(self, records):
+        for key, (lat, lon, apps) in records.items():
+            server = self.servers[0] if key.startswith(('idfa', 'gaid')) else self.servers[1]
+            value = server.get(key)
+            self.assertIsNotNone(value, key)
+            ua = appsinstalled_pb2.UserApps()
+            ua.ParseFromString(value)
+            self.assertEqual((lat, lon, apps), (ua.lat, ua.lon, list(ua.apps)))
+
+    def test_process_file(self):
+        path = os.path.join(self.dir, 'a.tsv.gz')
+        records = write_tsv(path, 3000, bad_lines=3)
+        self.assertEqual(path, memc_load.process_file(self.options, path))
+        self.check_stored(records)
+        self.assertEqual(3000, sum(len(server.data) for server in self.servers))
+
+    def test_pool_shared_by_files(self):
+        records = {}
+        for i in range(4):
+            path = os.path.join(self.dir, 'f%03d.tsv.gz' % i)
+            records.update(write_tsv(path, 500, seed=i))
+            memc_load.process_file(self.options, path)
+        self.check_stored(records)
+        for server in self.servers:
+            self.assertLessEqual(server.connections, 3)
+        self.assertEqual(2, len(memc_load.server_pools))
+
+    def test_worker_exit(self):
+        slow = FakeMemcached(latency=0.02).start()
+        try:
+            self.options.connections = 1
+            pool = mp.Pool(1, memc_load.init_worker, (mp.Value('i', 0),))
+            pool.apply(put_batches, (self.options, slow.address))
+            pool.close()
+            pool.join()
+            self.assertEqual(100, len(slow.data))
+        finally:
+            slow.stop()
+
+    def test_dry_run(self):
+        path = os.path.join(self.dir, 'a.tsv.gz')
+        write_tsv(path, 200)
+        self.options.dry = True
+        memc_load.process_file(self.options, path)
+        self.assertEqual(0, sum(len(server.data) for server in self.servers))
+
+    def test_invalid_keys(self):
+        # wrong dev_ids inside a batch are errors of their rows only, the rest of rows are stored
+        lines = ['idfa\t%08x\t1.5\t2.5\t1,2' % i for i in range(500)]
+        lines[100] = 'idfa\tbad\x01id\t1.5\t2.5\t1,2'
+        lines[250] = 'idfa\t%s\t1.5\t2.5\t1,2' % ('x' * 250)
+        processed, errors = memc_load.load_line_blocks(self.options, 'lines', [lines], log_nodes=False)
+        self.assertEqual((500, 2), (processed, errors))
+        self.assertEqual(498, len(self.servers[0].data))
+
+    def test_unavailable_server(self):
+        path = os.path.join(self.dir, 'a.tsv.gz')
+        records = write_tsv(path, 400)
+        self.options.adid = self.options.dvid = '127.0.0.1 %d' % free_port()
+        memc_load.process_file(self.options, path)
+        self.check_stored({key: value for key, value in records.items() if key.startswith(('idfa', 'gaid'))})
+
+    def test_batch_sizer(self):
+        sizer = memc_load.BatchSizer(100, 10, 1000, target_rtt=0.05)
+        for _ in range(10):
+            sizer.update(sizer.size, 0.001)
+        self.assertEqual(1000, sizer.size)
+        for _ in range(10):
+            sizer.update(sizer.size, 0.2)
+        self.assertEqual(10, sizer.size)
+        # partial batches (the tail of a file) don't grow the size
+        sizer.update(5, 0.001)
+        self.assertEqual(10, sizer.size)
+
+        fixed = memc_load.BatchSizer(100, 100, 100)
+        fixed.update(100, 0.001)
+        fixed.update(100, 1)
+        self.assertEqual(100, fixed.size)
+
+    def tearDown(self):
+        memc_load.close_server_pools()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+from .context import memc_load, metrics
+from .fake_memcached import FakeMemcached
+from .test_memc_load import write_tsv
+import os
+import json
+import queue
+import shutil
+import logging
+import tempfile
+import urllib.request
+
+logging.disable(logging.CRITICAL)
+
+
+class TestMetrics(unittest.TestCase):
+
+    """ Procedure:
+        1. Start fake memcached servers, the second one answers NOT_STORED to the first set of every key
+        2. Load gz files by process_file with both backends and by main with 2 worker processes
+        ---------
+        Verification:
+        3. Rows set, batches, bytes, retries and round trips of every server and parse errors are counted
+        4. Snapshots of processes are summed, the histogram is cumulative in JSON and Prometheus text
+        5. The metrics file of main covers rows of all workers, the HTTP endpoint serves Prometheus text
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = [FakeMemcached().start(), FakeMemcached(not_stored_first=1).start()]
+        self.args = ['--idfa', self.servers[0].address, '--gaid', self.servers[0].address,
+                     '--adid', self.servers[1].address, '--dvid', self.servers[1].address]
+
+    def load(self, *args):
+        options, _ = memc_load.build_parser().parse_args(self.args + list(args))
+        path = os.path.join(self.dir, 'a.tsv.gz')
+        write_tsv(path, 2000, bad_lines=5)
+        before = metrics.get_registry().snapshot()
+        memc_load.process_file(options, path)
+        after = metrics.get_registry().snapshot()
+        diff = {name: after[name] - before[name] for name in ('lines', 'parse_errors')}
+        for memc_addr, server in after['servers'].items():
+            old = before['servers'].get(memc_addr, dict.fromkeys(metrics.COUNTERS, 0))
+            diff[memc_addr] = {name: server[name] - old[name] for name in metrics.COUNTERS}
+            diff[memc_addr]['round_trips'] = sum(server['rtt_buckets']) - sum(old.get('rtt_buckets', []))
+        return diff
+
+    def check_load(self, diff):
+        self.assertEqual((2005, 5), (diff['lines'], diff['parse_errors']))
+        first, second = diff[self.servers[0].address], diff[self.servers[1].address]
+        self.assertEqual((1000, 0, 0), (first['sets'], first['not_set'], first['retries']))
+        self.assertEqual(first['batches'], first['round_trips'])
+        self.assertGreater(first['bytes'], 1000 * 20)
+        # every batch of the second server is retried once
+        self.assertEqual((1000, 0), (second['sets'], second['not_set']))
+        self.assertEqual(second['batches'], second['retries'])
+        self.assertEqual(2 * second['batches'], second['round_trips'])
+
+    def test_thread_backend(self):
+        self.check_load(self.load())
+
+    def test_asyncio_backend(self):
+        self.check_load(self.load('--backend', 'asyncio'))
+
+    def test_merge(self):
+        server = metrics.ServerMetrics()
+        for seconds in (0.0005, 0.001, 0.003, 10):
+            server.round_trip(seconds)
+        server.batch(10, 2, 100)
+        snapshot = {'pid': 1, 'lines': 12, 'parse_errors': 1, 'servers': {'a 1': server.snapshot()}}
+        merged = metrics.merge([snapshot, dict(snapshot, pid=2)])
+        self.assertEqual((2, 24, 2), (merged['processes'], merged['lines'], merged['parse_errors']))
+        self.assertEqual((16, 4, 2, 200), tuple(merged['servers']['a 1'][name]
+                                                for name in ('sets', 'not_set', 'batches', 'bytes')))
+        merged['servers']['a 1']['sets_per_sec'] = 0.0
+        rtt = metrics.to_json(merged)['servers']['a 1']['rtt']
+        self.assertEqual((4, 4, 6, 8), (rtt['le']['0.001'], rtt['le']['0.0025'], rtt['le']['0.005'], rtt['count']))
+        text = metrics.to_prometheus(merged)
+        self.assertIn('memc_load_sets_total{server="a 1"} 16', text)
+        self.assertIn('memc_load_batch_rtt_seconds_bucket{server="a 1",le="+Inf"} 8', text)
+
+    def test_exporter(self):
+        reports_q = queue.Queue()
+        server = metrics.ServerMetrics()
+        server.batch(5, 0, 50)
+        reports_q.put({'pid': -1, 'lines': 5, 'parse_errors': 0, 'servers': {'a 1': server.snapshot()}})
+        path = os.path.join(self.dir, 'metrics.json')
+        exporter = metrics.Exporter(reports_q, path, 0, interval=0.05).start()
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % exporter.port) as response:
+                self.assertIn('memc_load_sets_total{server="a 1"} 5', response.read().decode('utf-8'))
+        finally:
+            exporter.stop()
+        with open(path) as f:
+            self.assertEqual(5, json.load(f)['servers']['a 1']['sets'])
+
+    def test_main(self):
+        for i in range(3):
+            write_tsv(os.path.join(self.dir, '%d.tsv.gz' % i), 1000, seed=i)
+        path = os.path.join(self.dir, 'metrics.json')
+        options, _ = memc_load.build_parser().parse_args(
+            self.args + ['--pattern', os.path.join(self.dir, '*.tsv.gz'), '-w', '2', '--metrics-file', path])
+        memc_load.main(options)
+        with open(path) as f:
+            exported = json.load(f)
+        self.assertEqual(3000, sum(server['sets'] for server in exported['servers'].values()))
+        self.assertGreaterEqual(exported['processes'], 1)
+
+    def tearDown(self):
+        memc_load.close_server_pools()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
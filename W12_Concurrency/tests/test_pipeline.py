@@ -0,0 +1,90 @@
+import unittest
+from unittest import mock
+from .context import memc_load
+from .fake_memcached import FakeMemcached
+from .test_memc_load import write_tsv
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+logging.disable(logging.CRITICAL)
+
+
+class TestPipeline(unittest.TestCase):
+
+    """ Procedure:
+        1. Start slow fake memcached servers, create a gz file of small blocks with wrong lines in a temp dir
+        2. Load it by process_file with --queue-depth 2 and one connection per server (both backends),
+        sample the depth of the block queue and of the queues of server pools while the file is loaded
+        ---------
+        Verification:
+        3. The block queue gets full (the reader is blocked), no queue is ever deeper than --queue-depth
+        4. Every row is stored, the error rate is checked with all rows processed and wrong lines as errors
+    """
+
+    queue_depth = 2
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = [FakeMemcached(latency=0.01).start(), FakeMemcached(latency=0.01).start()]
+        self.path = os.path.join(self.dir, 'a.tsv.gz')
+        self.records = write_tsv(self.path, 4000, bad_lines=5)
+
+    def load(self, *args):
+        options, _ = memc_load.build_parser().parse_args(
+            ['--idfa', self.servers[0].address, '--gaid', self.servers[0].address,
+             '--adid', self.servers[1].address, '--dvid', self.servers[1].address,
+             '--queue-depth', str(self.queue_depth), '--connections', '1', '--block-size', '4096',
+             '--batch-size', '50', '--fixed-batch'] + list(args))
+        read_line_blocks = memc_load.read_line_blocks
+        blocks_queues = []
+        depths = []
+        stop = threading.Event()
+
+        def reader(fn, blocks_q, *reader_args):
+            blocks_queues.append(blocks_q)
+            read_line_blocks(fn, blocks_q, *reader_args)
+
+        def sample():
+            while not stop.is_set():
+                pools = list(memc_load.server_pools.values())
+                if blocks_queues:
+                    depths.append((blocks_queues[0].qsize(),
+                                   [sum(qsize() for qsize in pool.metrics.queues) for pool in pools]))
+                time.sleep(0.001)
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        try:
+            with mock.patch.object(memc_load, 'read_line_blocks', reader), \
+                    mock.patch.object(memc_load, 'check_error_rate', wraps=memc_load.check_error_rate) as check:
+                self.assertEqual(self.path, memc_load.process_file(options, self.path))
+        finally:
+            stop.set()
+            sampler.join()
+
+        self.assertIn(self.queue_depth, [blocks for blocks, _ in depths])
+        self.assertLessEqual(max(blocks for blocks, _ in depths), self.queue_depth)
+        self.assertLessEqual(max(max(pools or [0]) for _, pools in depths), self.queue_depth)
+        check.assert_called_once_with(len(self.records), 5)
+        self.assertEqual(len(self.records), sum(len(server.data) for server in self.servers))
+        self.assertEqual(set(self.records), set(key.decode() for server in self.servers for key in server.data))
+
+    def test_thread_backend(self):
+        self.load()
+
+    def test_asyncio_backend(self):
+        self.load('--backend', 'asyncio', '--pipeline', '1')
+
+    def tearDown(self):
+        memc_load.close_server_pools()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
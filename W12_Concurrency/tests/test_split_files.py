@@ -0,0 +1,67 @@
+import unittest
+from .context import memc_load
+from .fake_memcached import FakeMemcached
+from .test_memc_load import write_tsv
+import os
+import shutil
+import logging
+import tempfile
+import multiprocessing as mp
+
+logging.disable(logging.CRITICAL)
+
+
+class TestSplitFiles(unittest.TestCase):
+
+    """ Procedure:
+        1. Start fake memcached servers, create gz files in a temp dir
+        2. Load every file by blocks of lines in a pool of 3 worker processes (--split-files mode)
+        ---------
+        Verification:
+        3. Every valid line is stored, blocks are processed by different workers
+        4. Errors of all blocks make the error rate of the file: the file with many wrong lines is failed,
+        the file of only wrong lines is failed in both modes
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = [FakeMemcached().start(), FakeMemcached().start()]
+        self.options, _ = memc_load.build_parser().parse_args(
+            ['--idfa', self.servers[0].address, '--gaid', self.servers[0].address,
+             '--adid', self.servers[1].address, '--dvid', self.servers[1].address,
+             '--split-files', '-w', '3', '--block-size', '16384'])
+        self.pool = mp.Pool(3)
+
+    def test_split_file(self):
+        path = os.path.join(self.dir, 'a.tsv.gz')
+        records = write_tsv(path, 5000, bad_lines=10)
+        self.assertEqual(path, memc_load.process_file_split(self.options, self.pool, path))
+        self.assertEqual(len(records), sum(len(server.data) for server in self.servers))
+        self.assertEqual(len(records), sum(server.sets for server in self.servers))
+        # every worker has its own connections
+        self.assertGreater(self.servers[0].connections, 1)
+
+    def test_error_rate(self):
+        path = os.path.join(self.dir, 'a.tsv.gz')
+        write_tsv(path, 3000, bad_lines=100)
+        self.assertIsNone(memc_load.process_file_split(self.options, self.pool, path))
+        self.assertEqual(3000, sum(len(server.data) for server in self.servers))
+
+    def test_only_wrong_lines(self):
+        path = os.path.join(self.dir, 'a.tsv.gz')
+        write_tsv(path, 0, bad_lines=50)
+        self.assertIsNone(memc_load.process_file_split(self.options, self.pool, path))
+        self.assertIsNone(memc_load.process_file(self.options, path))
+        self.assertTrue(memc_load.check_error_rate(0, 0))
+
+    def tearDown(self):
+        memc_load.close_server_pools()
+        self.pool.terminate()
+        self.pool.join()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
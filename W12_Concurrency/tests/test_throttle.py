@@ -0,0 +1,160 @@
+import unittest
+from .context import memc_load, throttle
+from .fake_memcached import FakeMemcached
+from .test_memc_load import write_tsv
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import multiprocessing
+
+logging.disable(logging.CRITICAL)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestThrottle(unittest.TestCase):
+
+    """ Procedure:
+        1. Take tokens from a bucket and update AIMD limits by a fake clock
+        2. Write batches by threads through a throttle with the concurrency limit
+        3. Load a file to fake memcached servers with --rate and with --adaptive-concurrency (both backends),
+        the servers answer slower than --max-rtt
+        ---------
+        Verification:
+        4. The bucket allows bursts of `burst` rows, then rows wait for `rows / rate` seconds,
+        the rate shared by processes is divided among the active ones
+        5. The limit grows by one per round of good batches, a slow or failed round halves it once, limits are kept
+        6. No more batches are in flight than the limit
+        7. The rate limited load takes at least rows / rate seconds, slow servers drop the limit to 1,
+        every row is stored
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = []
+
+    def test_token_bucket(self):
+        clock = Clock()
+        bucket = throttle.TokenBucket(100, burst=10, clock=clock)
+        self.assertEqual(0, bucket.reserve(10))
+        self.assertAlmostEqual(0.1, bucket.reserve(10))
+        self.assertAlmostEqual(0.2, bucket.reserve(10))
+        clock.now = 1.0
+        # the debt is paid, the bucket is full again but not more
+        self.assertEqual(0, bucket.reserve(10))
+        self.assertAlmostEqual(0.01, bucket.reserve(1))
+
+    def test_shared_rate(self):
+        clock = Clock()
+        shares = [2]
+        bucket = throttle.TokenBucket(200, burst=20, clock=clock, shares=lambda: shares[0])
+        # half of the rate and of the burst
+        self.assertEqual(0, bucket.reserve(10))
+        self.assertAlmostEqual(0.1, bucket.reserve(10))
+        shares[0] = 1
+        clock.now = 1.0
+        self.assertEqual(0, bucket.reserve(20))
+
+        writers = multiprocessing.Value('i', 0)
+        try:
+            self.assertEqual(1, memc_load.writer_shares())
+            memc_load.active_writers = writers
+            memc_load.count_writer(1)
+            memc_load.count_writer(1)
+            self.assertEqual(2, memc_load.writer_shares())
+            memc_load.count_writer(-1)
+            memc_load.count_writer(-1)
+            self.assertEqual(1, memc_load.writer_shares())
+        finally:
+            memc_load.active_writers = None
+
+    def test_aimd_limit(self):
+        clock = Clock()
+        limit = throttle.AIMDLimit(4, max_limit=8, max_rtt=0.1, clock=clock)
+        # about one round of 4 batches
+        for _ in range(5):
+            limit.update(0, 0.01, 0)
+        self.assertEqual(5, limit.value)
+        clock.now = 1.0
+        limit.update(0.5, 0.2, 0)
+        # batches started before the decrease don't decrease it again
+        limit.update(0.6, 0.01, 3)
+        self.assertEqual(2, limit.value)
+        limit.update(1.5, 0.01, 3)
+        limit.update(2.5, 0.5, 0)
+        self.assertEqual(1, limit.value)
+        for _ in range(100):
+            limit.update(3, 0.01, 0)
+        self.assertEqual(8, limit.value)
+
+    def test_concurrency(self):
+        writer_throttle = throttle.Throttle(limit=2)
+        in_flight = []
+        lock = threading.Lock()
+
+        def write():
+            for _ in range(5):
+                started = writer_throttle.acquire(10)
+                with lock:
+                    in_flight.append(writer_throttle.in_flight)
+                time.sleep(0.001)
+                writer_throttle.release(started, 0)
+
+        threads = [threading.Thread(target=write) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(30, len(in_flight))
+        self.assertLessEqual(max(in_flight), 2)
+        self.assertEqual(0, writer_throttle.in_flight)
+
+    def load(self, latency, *args):
+        self.servers = [FakeMemcached(latency=latency).start(), FakeMemcached(latency=latency).start()]
+        options, _ = memc_load.build_parser().parse_args(
+            ['--idfa', self.servers[0].address, '--gaid', self.servers[0].address,
+             '--adid', self.servers[1].address, '--dvid', self.servers[1].address] + list(args))
+        path = os.path.join(self.dir, 'a.tsv.gz')
+        records = write_tsv(path, 2000)
+        start = time.time()
+        self.assertEqual(path, memc_load.process_file(options, path))
+        seconds = time.time() - start
+        self.assertEqual(len(records), sum(len(server.data) for server in self.servers))
+        return seconds, options
+
+    def test_rate(self):
+        # 1000 rows per node, 100 of them in the first burst
+        seconds, _ = self.load(0, '--rate', '2000')
+        self.assertGreater(seconds, 0.4)
+
+    def check_adaptive_concurrency(self, *args):
+        _, options = self.load(0.02, '--adaptive-concurrency', '--max-rtt', '0.01', '--batch-size', '50',
+                               '--fixed-batch', *args)
+        for server in self.servers:
+            pool = memc_load.get_server_pool(server.address, options)
+            self.assertEqual(1, pool.throttle.limit.value)
+
+    def test_adaptive_concurrency(self):
+        self.check_adaptive_concurrency()
+
+    def test_adaptive_concurrency_asyncio(self):
+        self.check_adaptive_concurrency('--backend', 'asyncio', '--pipeline', '1')
+
+    def tearDown(self):
+        memc_load.close_server_pools()
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
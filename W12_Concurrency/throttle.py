@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+""" Rate limit and adaptive concurrency of memc_load writers of one memcached node (--rate, --adaptive-concurrency).
+
+TokenBucket limits rows per second written to the node: a batch takes tokens for its rows and waits until
+the bucket has refilled its debt, so bursts are at most `burst` rows. The rate may be shared by processes:
+every one of them gets rate / shares(), where shares() is the number of processes writing now.
+AIMDLimit is the number of batches in flight to the node: it grows by one per round of batches which are written
+in time and without failed keys and is halved by a batch which is slower than max_rtt or has rows not set (after
+the retries of set_multi, which make the batch slower as well). Throttle (writer threads) and AsyncThrottle
+(asyncio writers) combine both. Waiting writers hold the pool's queue full, so the parser and the reader slow
+down with them.
+"""
+
+import time
+import asyncio
+import threading
+
+# round trip of set_multi which is taken as the sign of a loaded server
+MAX_RTT = 0.25
+# the bucket keeps tokens for this share of a second of the rate
+BURST_SECONDS = 0.1
+DECREASE_FACTOR = 0.5
+
+
+class TokenBucket(object):
+    """ Token bucket of `rate` rows per second, up to `burst` rows at once, both divided by shares() if it is set.
+    Thread-safe
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, shares=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1.0, self.rate * BURST_SECONDS)
+        self.tokens = self.burst
+        self.clock = clock
+        self.shares = shares
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, rows):
+        """ Take tokens for rows, the bucket may go into debt. Return seconds to wait before writing them """
+        with self.lock:
+            share = self.shares() if self.shares is not None else 1
+            rate, burst = self.rate / share, max(1.0, self.burst / share)
+            now = self.clock()
+            self.tokens = min(burst, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= rows
+            return -self.tokens / rate if self.tokens < 0 else 0.0
+
+
+class AIMDLimit(object):
+    """ Limit of batches in flight: additive increase, multiplicative decrease. A slow or failed batch decreases
+    the limit once per round: batches started before the last decrease don't decrease it again. Thread-safe
+    """
+
+    def __init__(self, limit, min_limit=1, max_limit=None, max_rtt=MAX_RTT, decrease=DECREASE_FACTOR,
+                 clock=time.monotonic):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit or limit
+        self.max_rtt = max_rtt
+        self.decrease = decrease
+        self.clock = clock
+        self.decreased_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def value(self):
+        return int(self.limit)
+
+    def update(self, started, rtt, failed):
+        """ Result of the batch started at `started` (by the clock): its round trip and the number of failed keys """
+        with self.lock:
+            if rtt > self.max_rtt or failed:
+                if self.decreased_at is None or started >= self.decreased_at:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.decreased_at = self.clock()
+            else:
+                # about one more batch per round of `limit` batches
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+
+class Throttle(object):
+    """ Rate limit (rate rows/sec shared by `shares()` processes, 0 - no limit) and adaptive concurrency (`limit`
+    batches in flight at most, None - no limit) of writer threads of one node. A writer calls acquire before
+    the batch and release after it
+    """
+
+    def __init__(self, rate=0, limit=None, max_rtt=MAX_RTT, shares=None):
+        self.bucket = TokenBucket(rate, shares=shares) if rate else None
+        self.limit = AIMDLimit(limit, max_rtt=max_rtt) if limit else None
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    def limit_value(self):
+        return self.limit.value
+
+    def acquire(self, rows):
+        """ Wait for tokens of rows and for a free slot. Return the start time of the batch """
+        if self.bucket is not None:
+            delay = self.bucket.reserve(rows)
+            if delay:
+                time.sleep(delay)
+        if self.limit is not None:
+            with self.cond:
+                while self.in_flight >= self.limit.value:
+                    self.cond.wait()
+                self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, failed):
+        if self.limit is not None:
+            with self.cond:
+                self.in_flight -= 1
+                self.limit.update(started, time.monotonic() - started, failed)
+                self.cond.notify_all()
+
+
+class AsyncThrottle(Throttle):
+    """ Throttle of asyncio writers: the same bucket and limit, waiting doesn't block the event loop """
+
+    def __init__(self, rate=0, limit=None, max_rtt=MAX_RTT, shares=None):
+        super(AsyncThrottle, self).__init__(rate, limit, max_rtt, shares)
+        # created in the event loop at the first use
+        self.cond = None
+
+    async def acquire(self, rows):
+        if self.bucket is not None:
+            delay = self.bucket.reserve(rows)
+            if delay:
+                await asyncio.sleep(delay)
+        if self.limit is not None:
+            if self.cond is None:
+                self.cond = asyncio.Condition()
+            async with self.cond:
+                await self.cond.wait_for(lambda: self.in_flight < self.limit.value)
+                self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started, failed):
+        if self.limit is not None:
+            async with self.cond:
+                self.in_flight -= 1
+                self.limit.update(started, time.monotonic() - started, failed)
+                self.cond.notify_all()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Compare the report built by the log parser with the columnar cache: the first run parses the log and saves
+the columns, re-runs with other REPORT_SIZE / REPORT_TOP load the memory-mapped columns and group them by url.
+Reports from the cache are checked to be the same as the reports of the parser.
+
+    python benchmarks/bench_columns.py --lines 2000000
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import log_analyzer
+from loggen import write_log
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--urls', type=int, default=10000)
+    parser.add_argument('--report-sizes', default='0,100,1000')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+        columns_dir = os.path.join(tmp, 'columns')
+        write_log(path, args.lines, args.urls)
+
+        _, export_time = timed(lambda: log_analyzer.aggregate_columns(path, 1, columns_dir))
+        print('%-28s %8.2f s' % ('parse + export columns', export_time))
+        for report_size in [int(size) for size in args.report_sizes.split(',')]:
+            report, parse_time = timed(lambda: log_analyzer.create_report(path, 1, report_size))
+            cached, cache_time = timed(lambda: log_analyzer.build_report(
+                log_analyzer.aggregate_columns(path, 1, columns_dir), report_size))
+            assert report == cached
+            print('REPORT_SIZE=%-8d parse %8.2f s   from columns %8.2f s   x%.1f'
+                  % (report_size, parse_time, cache_time, parse_time / cache_time))
+
+
+if __name__ == '__main__':
+    main()
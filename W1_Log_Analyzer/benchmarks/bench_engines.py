@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Compare python and numpy engines of log_analyzer on a synthetic log: the whole create_report and the statistic
+alone (aggregate of the parsed log -> report rows). Reports of both engines are checked to be the same.
+
+    python benchmarks/bench_engines.py --lines 10000000
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import log_analyzer
+import columnar
+from loggen import write_log
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def python_statistic(path):
+    aggregate = log_analyzer.aggregate_log(path, 1)
+    return lambda: log_analyzer.build_report(aggregate, 0)
+
+
+def numpy_statistic(path):
+    url_id, request_time, urls, total_lines = columnar.parse_url_times(log_analyzer.read_log_lines(path))
+    columns = columnar.Columns(url_id, request_time, None, None, urls, total_lines)
+    return lambda: log_analyzer.build_report(log_analyzer.ColumnsAggregate(columns), 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=10000000)
+    parser.add_argument('--urls', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+        write_log(path, args.lines, args.urls)
+
+        reports = {}
+        times = {}
+        for engine, statistic in (('python', python_statistic), ('numpy', numpy_statistic)):
+            reports[engine], times[engine, 'report'] = timed(
+                lambda: log_analyzer.create_report(path, 1, 0, engine=engine))
+            _, times[engine, 'statistic'] = timed(statistic(path))
+            print('%-8s create_report %8.2f s (%10.0f lines/sec)   statistic %8.2f s'
+                  % (engine, times[engine, 'report'], args.lines / times[engine, 'report'],
+                     times[engine, 'statistic']))
+        assert reports['python'] == reports['numpy']
+        print('speedup  create_report x%.2f   statistic x%.2f'
+              % (times['python', 'report'] / times['numpy', 'report'],
+                 times['python', 'statistic'] / times['numpy', 'statistic']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Compare find_last_log over a directory with many rotated logs: os.listdir with regex compiled for every
+entry (the first version), os.scandir with the precompiled regex and the cached result of the previous run.
+
+    python benchmarks/bench_find_last_log.py --files 100000
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import log_analyzer
+
+
+def listdir_find_last_log(log_dir):
+    mask = 'nginx-access-ui.log-'
+    last_log = None
+    last_log_date = 0
+    for dir_file in os.listdir(log_dir):
+        if dir_file.startswith(mask):
+            log_temp = re.search(mask + r'(\d{4}\d{2}\d{2})\.?', dir_file)
+            if log_temp is not None:
+                if int(log_temp.group(1)) > last_log_date:
+                    last_log = dir_file
+                    last_log_date = int(log_temp.group(1))
+    return last_log, last_log_date
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as cache_dir:
+        first_day = date(1800, 1, 1)
+        for i in range(args.files):
+            day = (first_day + timedelta(days=i)).strftime('%Y%m%d')
+            open(os.path.join(log_dir, 'nginx-access-ui.log-%s%s' % (day, '.gz' if i % 2 else '')), 'w').close()
+        past = time.time() - 60
+        os.utime(log_dir, (past, past))
+
+        cases = (('listdir + re.search', lambda: listdir_find_last_log(log_dir)),
+                 ('scandir', lambda: log_analyzer.find_last_log(log_dir)),
+                 ('cached', lambda: log_analyzer.find_last_log(log_dir, cache_dir)))
+        for name, func in cases:
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                func()
+                best = min(best, time.perf_counter() - start)
+            print('%-20s %10.2f ms' % (name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
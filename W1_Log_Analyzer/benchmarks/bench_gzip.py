@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Lines/sec of reading a gz log: iteration over gzip.open() (the previous read_log_lines) against gzip_reader
+in every mode (pigz/gzip process, background thread, inline blocks), and create_report of the gz log.
+Decompression is overlapped with parsing only when there is a spare CPU core.
+
+    python benchmarks/bench_gzip.py --lines 2000000
+"""
+
+import os
+import sys
+import gzip
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import log_analyzer
+import gzip_reader
+from loggen import write_log
+
+
+def best_time(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--urls', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        plain_path = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+        path = plain_path + '.gz'
+        write_log(plain_path, args.lines, args.urls)
+        with open(plain_path, 'rb') as plain, gzip.open(path, 'wb') as packed:
+            shutil.copyfileobj(plain, packed)
+
+        def read_gzip_open():
+            with gzip.open(path, 'rb') as file:
+                for _ in file:
+                    pass
+
+        cases = [('gzip.open', read_gzip_open)]
+        for mode in gzip_reader.MODES[1:]:
+            if mode != 'subprocess' or gzip_reader.decompress_command(path):
+                cases.append(('gzip_reader ' + mode,
+                              lambda mode=mode: sum(1 for _ in gzip_reader.gzip_lines(path, mode=mode))))
+        cases.append(('create_report (auto)', lambda: log_analyzer.create_report(path, 1, 0)))
+        for name, func in cases:
+            print('%-24s %12.0f lines/sec' % (name, args.lines / best_time(func, args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
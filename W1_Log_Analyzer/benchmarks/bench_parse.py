@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Compare lines/sec of the text-mode line.split() parser with the memory-mapped bytes parser of log_analyzer:
+parse_log generator alone and the whole create_report (parsing, aggregation and statistic).
+
+    python benchmarks/bench_parse.py --lines 2000000
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+from statistics import median
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import log_analyzer
+from loggen import write_log
+
+
+def split_parser(path):
+    # parser from the first version of log_analyzer: text mode and split of the whole line
+    total = 0
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            splitted = line.split()
+            url = splitted[6].strip('"')
+            response_time = float(splitted[-1])
+            total += 1
+    return total
+
+
+def split_report(path):
+    # first version of create_report: lists of strings per url converted to float for every statistic
+    time_log = {}
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            splitted = line.split()
+            time_log.setdefault(splitted[6].strip('"'), []).append(splitted[-1])
+    report = []
+    for url, times in time_log.items():
+        time_sum = sum([float(x) for x in times])
+        time_max = max([float(x) for x in times])
+        time_med = median([float(x) for x in times])
+        report.append((url, time_sum, time_max, time_med))
+    return report
+
+
+def bytes_parser(path):
+    return sum(1 for _ in log_analyzer.parse_log(path, 1))
+
+
+def bytes_report(path):
+    return log_analyzer.create_report(path, 1, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--urls', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+        write_log(path, args.lines, args.urls)
+        for name, func in (('split parse', split_parser), ('mmap parse', bytes_parser),
+                           ('split report', split_report), ('mmap report', bytes_report)):
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                func(path)
+                best = min(best, time.perf_counter() - start)
+            print('%-16s %12.0f lines/sec' % (name, args.lines / best))
+
+
+if __name__ == '__main__':
+    main()
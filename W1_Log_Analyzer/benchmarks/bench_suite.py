@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Benchmark suite of log_analyzer: parse_log, create_report and generate_html_report on logs generated by loggen
+(1M, 10M and 50M lines by default). Every task runs in a fresh process, so its peak RSS is measured alone (pages of the memory-mapped plain log are
+counted in RSS too). Throughput (lines/sec of the log, rows/sec for html) and peak memory are printed and saved
+as json to compare parser or aggregation changes.
+
+    python benchmarks/bench_suite.py --sizes 1M,10M,50M --log-dir /tmp/loggen --output bench_results.json
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import platform
+import resource
+import argparse
+import tempfile
+import multiprocessing as mp
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, SCRIPT_DIR)
+
+import loggen
+
+TASKS = ('parse_log', 'create_report', 'generate_html_report')
+
+
+def run_task(task, path, work_dir, settings, results):
+    """ Body of the task process: time the task and report its peak RSS """
+    # report.html template is looked up in the current directory
+    os.chdir(SCRIPT_DIR)
+    import log_analyzer
+    report_path = os.path.join(work_dir, 'report.pickle')
+    if task == 'generate_html_report':
+        with open(report_path, 'rb') as file:
+            report = pickle.load(file)
+
+    start = time.perf_counter()
+    if task == 'parse_log':
+        for _ in log_analyzer.parse_log(path, 1):
+            pass
+    elif task == 'create_report':
+        report = log_analyzer.create_report(path, 1, settings['report_size'], settings['median_mode'],
+                                            workers=settings['workers'], engine=settings['engine'])
+    else:
+        log_analyzer.generate_html_report(report, work_dir, 'report_bench.html')
+    seconds = time.perf_counter() - start
+
+    if task == 'create_report':
+        with open(report_path, 'wb') as file:
+            pickle.dump(report, file, protocol=pickle.HIGHEST_PROTOCOL)
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    result = {"seconds": seconds, "peak_rss_mb": round(max(usage, children_usage) / 1024.0, 1)}
+    if task == 'generate_html_report':
+        result["rows_per_sec"] = round(len(report) / seconds)
+    results.put(result)
+
+
+def measure(task, path, work_dir, settings):
+    context = mp.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_task, args=(task, path, work_dir, settings, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1M,10M,50M', help='comma separated numbers of lines')
+    parser.add_argument('--urls', type=int, default=10000)
+    parser.add_argument('--zipf', type=float, default=1.0)
+    parser.add_argument('--malformed', type=float, default=0.001)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gz', action='store_true', help='benchmark gzipped logs')
+    parser.add_argument('--tasks', default=','.join(TASKS))
+    parser.add_argument('--report-size', type=int, default=0)
+    parser.add_argument('--median-mode', default='exact')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--engine', default='python')
+    parser.add_argument('--log-dir', help='keep generated logs here and reuse them in the next runs')
+    parser.add_argument('--output', help='json file for results')
+    args = parser.parse_args()
+
+    settings = {"report_size": args.report_size, "median_mode": args.median_mode, "workers": args.workers,
+                "engine": args.engine}
+    tasks = [task for task in args.tasks.split(',') if task]
+    if 'generate_html_report' in tasks and 'create_report' not in tasks:
+        parser.error("generate_html_report needs the report of create_report task")
+    results = {"params": dict(vars(args)), "python": platform.python_version(), "cpus": os.cpu_count(),
+               "timestamp": time.asctime(), "results": []}
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        log_dir = args.log_dir or work_dir
+        os.makedirs(log_dir, exist_ok=True)
+        for size in [loggen.parse_count(size) for size in args.sizes.split(',')]:
+            name = 'nginx-access-ui.log-%d-u%d-z%g-m%g-s%d%s' % (size, args.urls, args.zipf, args.malformed,
+                                                                 args.seed, '.gz' if args.gz else '')
+            path = os.path.join(log_dir, name)
+            if not os.path.isfile(path):
+                start = time.perf_counter()
+                temp_path = os.path.join(log_dir, 'temp_' + name)
+                loggen.write_log(temp_path, size, args.urls, args.zipf, args.malformed, args.seed, gz=args.gz)
+                os.rename(temp_path, path)
+                print('generated %s in %.1f s' % (name, time.perf_counter() - start))
+            file_mb = os.path.getsize(path) / 1024.0 / 1024.0
+
+            for task in TASKS:
+                if task not in tasks:
+                    continue
+                result = measure(task, path, work_dir, settings)
+                result.update(lines=size, task=task, file_mb=round(file_mb, 1))
+                if task == 'generate_html_report':
+                    throughput = '%12d rows/sec' % result['rows_per_sec']
+                else:
+                    result.update(lines_per_sec=round(size / result['seconds']),
+                                  mb_per_sec=round(file_mb / result['seconds'], 1))
+                    throughput = '%12d lines/sec %8.1f MB/sec' % (result['lines_per_sec'], result['mb_per_sec'])
+                results["results"].append(result)
+                print('%10d lines  %-22s %8.2f s %-34s peak RSS %8.1f MB'
+                      % (size, task, result['seconds'], throughput, result['peak_rss_mb']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Reproducible generator of nginx logs in ui_short format for benchmarks.
+
+Urls are drawn from `urls` distinct urls by Zipf law with exponent `zipf` (0 - uniform), every url has its own
+mean request time, statuses, methods and sizes vary. `malformed` is the share of broken lines (truncated lines,
+garbage, '-' instead of request time). The same parameters and seed give the same file.
+
+    python benchmarks/loggen.py ./log/nginx-access-ui.log-20170630.gz --lines 10000000 --urls 50000 --zipf 1.1
+"""
+
+import os
+import gzip
+import random
+import argparse
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+BATCH_SIZE = 10000
+URL_TEMPLATES = ('/api/v2/banner/%d',
+                 '/api/v2/group/%d/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+                 '/api/1/photogenic_banners/list/?server_name=WIN7RB%d',
+                 '/api/v2/slot/%d/groups',
+                 '/export/appinstall_raw/%d/',
+                 '/api/v2/internal/banner/%d/info')
+STATUSES = (200, 200, 200, 200, 200, 200, 200, 200, 304, 404, 499, 500)
+METHODS = ('GET', 'GET', 'GET', 'GET', 'POST')
+USER_AGENTS = ('Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115',
+               'python-requests/2.13.0',
+               '-')
+LINE = ('%s -  - [%s] "%s %s HTTP/1.1" %d %d "-" "%s" "-" "%d-%d-4708-%d" "dc7161be3" %.3f\n')
+
+
+def parse_count(value):
+    """ '10M' -> 10000000, '500K' -> 500000 """
+    value = str(value).strip().upper()
+    for suffix, multiplier in (('K', 10 ** 3), ('M', 10 ** 6), ('G', 10 ** 9)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * multiplier)
+    return int(value)
+
+
+def generate_lines(lines, urls=10000, zipf=1.0, malformed=0.0, seed=0, day=datetime(2017, 6, 29)):
+    """ Yield batches of log lines (lists of str with newlines), lines are spread evenly over the day """
+    rnd = random.Random(seed)
+    names = [URL_TEMPLATES[i % len(URL_TEMPLATES)] % i for i in range(urls)]
+    rnd.shuffle(names)
+    cum_weights = list(accumulate(1.0 / rank ** zipf for rank in range(1, urls + 1)))
+    # mean request time of the url: most are fast, some are slow
+    means = [rnd.lognormvariate(-2, 1) for _ in range(urls)]
+    ips = ['%d.%d.%d.%d' % (rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254))
+           for _ in range(1000)]
+    start = int(day.timestamp())
+    time_local = {}
+
+    written = 0
+    while written < lines:
+        size = min(BATCH_SIZE, lines - written)
+        picks = rnd.choices(range(urls), cum_weights=cum_weights, k=size)
+        batch = []
+        for i, url in enumerate(picks, written):
+            second = start + i * 86400 // lines
+            stamp = time_local.get(second)
+            if stamp is None:
+                time_local.clear()
+                stamp = (day + timedelta(seconds=second - start)).strftime('%d/%b/%Y:%H:%M:%S +0300')
+                time_local[second] = stamp
+            line = LINE % (rnd.choice(ips), stamp, rnd.choice(METHODS), names[url], rnd.choice(STATUSES),
+                           rnd.randint(0, 100000), rnd.choice(USER_AGENTS), second, i, rnd.getrandbits(24),
+                           rnd.expovariate(1 / means[url]))
+            if malformed and rnd.random() < malformed:
+                kind = rnd.randint(0, 2)
+                if kind == 0:
+                    line = line[:rnd.randint(1, 60)].rstrip('\n') + '\n'
+                elif kind == 1:
+                    line = '%x\n' % rnd.getrandbits(64)
+                else:
+                    line = line.rsplit(' ', 1)[0] + ' -\n'
+            batch.append(line)
+        written += size
+        yield batch
+
+
+def write_log(path, lines, urls=10000, zipf=1.0, malformed=0.0, seed=0, gz=None):
+    """ Write generated log to path. It is gzipped if gz is true, None - if the name ends with .gz """
+    if gz is None:
+        gz = path.endswith('.gz')
+    opener = gzip.open if gz else open
+    with opener(path, 'wt', encoding='utf-8') as file:
+        for batch in generate_lines(lines, urls, zipf, malformed, seed):
+            file.writelines(batch)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='output log, gzipped if the name ends with .gz')
+    parser.add_argument('--lines', default='1M', help='number of lines, K and M suffixes are allowed')
+    parser.add_argument('--urls', type=int, default=10000, help='number of distinct urls')
+    parser.add_argument('--zipf', type=float, default=1.0, help='Zipf exponent of url popularity, 0 - uniform')
+    parser.add_argument('--malformed', type=float, default=0.0, help='share of broken lines')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    os.makedirs(os.path.dirname(os.path.abspath(args.path)), exist_ok=True)
+    write_log(args.path, parse_count(args.lines), args.urls, args.zipf, args.malformed, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+""" Columnar export of parsed nginx logs for log_analyzer.
+
+Parsed lines are kept as NumPy columns: url_id (index in the url dictionary), request_time, status and
+timestamp (unix time of $time_local). Columns are saved as .npy files in a directory with the url dictionary
+(urls.json) and meta.json, so they can be memory-mapped and grouped by url without parsing the log again.
+Group-by is vectorized: np.bincount for counts and sums, one sort by (url_id, request_time) for
+max, medians and percentiles. Sums are accumulated in the file order, so they are the same as in the
+pure Python aggregate. The same group-by is the numpy engine of log_analyzer (parse_url_times + UrlGroups).
+"""
+
+import os
+import sys
+import json
+import shutil
+from array import array
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+COLUMNS_VERSION = 1
+COLUMN_TYPES = (('url_id', 'I', 'uint32'),
+                ('request_time', 'd', 'float64'),
+                ('status', 'H', 'uint16'),
+                ('timestamp', 'q', 'int64'))
+TIME_LOCAL_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for columnar export (pip install numpy)")
+
+
+class Columns(object):
+    """ Parsed log as columns. urls is the url dictionary: url_id -> url in the order of the first appearance """
+
+    def __init__(self, url_id, request_time, status, timestamp, urls, total_lines):
+        self.url_id = url_id
+        self.request_time = request_time
+        self.status = status
+        self.timestamp = timestamp
+        self.urls = urls
+        self.total_lines = total_lines
+
+    def __len__(self):
+        return len(self.request_time)
+
+
+def parse_time_local(value):
+    """ '29/Jun/2017:03:50:22 +0300' -> unix time, 0 if the value has a wrong format """
+    try:
+        return int(datetime.strptime(value, TIME_LOCAL_FORMAT).timestamp())
+    except ValueError:
+        return 0
+
+
+def parse_columns(lines):
+    """ Parse raw (bytes) log lines into columns. Url and request time are taken the same way as
+    log_analyzer.parse_line does, lines without them are counted as malformed. Status and timestamp
+    are 0 if they can't be parsed
+
+    Args:
+        lines: iterable of raw log lines
+
+    Returns:
+        Columns
+    """
+    require_numpy()
+    url_ids, request_times, statuses, timestamps = (array(code) for _, code, _ in COLUMN_TYPES)
+    urls = []
+    url_index = {}
+    raw_index = {}
+    time_cache = {}
+    total_lines = 0
+    for line in lines:
+        total_lines += 1
+        try:
+            fields = line.split(None, 9)
+            raw_url = fields[6]
+            response_time = float(line.rsplit(None, 1)[1])
+            url_id = raw_index.get(raw_url)
+            if url_id is None:
+                url = sys.intern(raw_url.strip(b'"').decode('utf-8'))
+                url_id = url_index.get(url)
+                if url_id is None:
+                    url_id = url_index[url] = len(urls)
+                    urls.append(url)
+                raw_index[raw_url] = url_id
+        except:
+            continue
+        url_ids.append(url_id)
+        request_times.append(response_time)
+
+        try:
+            status = int(fields[8])
+        except (IndexError, ValueError):
+            status = 0
+        statuses.append(status if 0 <= status < 65536 else 0)
+
+        time_local = fields[3] + b' ' + fields[4]
+        timestamp = time_cache.get(time_local)
+        if timestamp is None:
+            timestamp = time_cache[time_local] = parse_time_local(time_local.strip(b'[]').decode('ascii', 'replace'))
+        timestamps.append(timestamp)
+
+    columns = [np.frombuffer(column, dtype=dtype) if len(column) else np.empty(0, dtype=dtype)
+               for column, (_, _, dtype) in zip((url_ids, request_times, statuses, timestamps), COLUMN_TYPES)]
+    return Columns(*columns, urls=urls, total_lines=total_lines)
+
+
+def parse_url_times(lines):
+    """ Lean version of parse_columns for the numpy engine: only url ids and request times are kept
+
+    Args:
+        lines: iterable of raw log lines
+
+    Returns:
+        url_id (uint32) and request_time (float64) arrays, the url dictionary and the number of lines
+    """
+    require_numpy()
+    url_ids = array('I')
+    request_times = array('d')
+    add_url_id = url_ids.append
+    add_request_time = request_times.append
+    urls = []
+    url_index = {}
+    raw_index = {}
+    total_lines = 0
+    for line in lines:
+        total_lines += 1
+        try:
+            raw_url = line.split(None, 7)[6]
+            response_time = float(line.rsplit(None, 1)[1])
+            url_id = raw_index.get(raw_url)
+            if url_id is None:
+                url = sys.intern(raw_url.strip(b'"').decode('utf-8'))
+                url_id = url_index.get(url)
+                if url_id is None:
+                    url_id = url_index[url] = len(urls)
+                    urls.append(url)
+                raw_index[raw_url] = url_id
+        except:
+            continue
+        add_url_id(url_id)
+        add_request_time(response_time)
+    return (np.frombuffer(url_ids, dtype='uint32') if url_ids else np.empty(0, dtype='uint32'),
+            np.frombuffer(request_times, dtype='float64') if request_times else np.empty(0, dtype='float64'),
+            urls, total_lines)
+
+
+def save_columns(columns, path):
+    """ Save columns into the directory `path` (replaced atomically: written into a temp directory and renamed) """
+    require_numpy()
+    temp_path = path + '.tmp'
+    if os.path.isdir(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    for name, _, dtype in COLUMN_TYPES:
+        np.save(os.path.join(temp_path, name + '.npy'), getattr(columns, name).astype(dtype, copy=False))
+    with open(os.path.join(temp_path, 'urls.json'), 'w', encoding='utf-8') as file:
+        json.dump(columns.urls, file)
+    with open(os.path.join(temp_path, 'meta.json'), 'w', encoding='utf-8') as file:
+        json.dump({"version": COLUMNS_VERSION, "rows": len(columns), "total_lines": columns.total_lines}, file)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(temp_path, path)
+
+
+def load_columns(path, mmap_mode='r'):
+    """ Load columns saved by save_columns. Arrays are memory-mapped by default """
+    require_numpy()
+    with open(os.path.join(path, 'meta.json'), encoding='utf-8') as file:
+        meta = json.load(file)
+    if meta.get("version") != COLUMNS_VERSION:
+        raise ValueError("Unsupported columns version: %s" % meta.get("version"))
+    with open(os.path.join(path, 'urls.json'), encoding='utf-8') as file:
+        urls = json.load(file)
+    arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name, _, _ in COLUMN_TYPES]
+    return Columns(*arrays, urls=urls, total_lines=meta["total_lines"])
+
+
+def normalize_urls(columns, normalizer):
+    """ Map the url dictionary by normalizer. Ids of urls which become the same are merged.
+    Only the dictionary is normalized, url_id column is remapped by one vectorized lookup
+    """
+    urls = []
+    url_index = {}
+    remap = np.empty(len(columns.urls), dtype='uint32')
+    for url_id, url in enumerate(columns.urls):
+        url = normalizer(url)
+        new_id = url_index.get(url)
+        if new_id is None:
+            new_id = url_index[url] = len(urls)
+            urls.append(url)
+        remap[url_id] = new_id
+    return Columns(remap[columns.url_id], columns.request_time, columns.status, columns.timestamp,
+                   urls, columns.total_lines)
+
+
+def sort_by_url(url_id, request_time, n_urls):
+    """ Request times sorted by (url_id, request_time). The pair is packed into one int64 key, so the whole sort
+    is one np.sort of keys instead of np.lexsort which is ~3 times slower. nginx writes $request_time with
+    millisecond resolution, so times are packed as integer milliseconds when this is exact (t * 1000 / 1000 == t),
+    otherwise as ranks among distinct times
+    """
+    milliseconds = np.rint(request_time * 1000)
+    if (len(request_time) and milliseconds.min() >= 0 and
+            n_urls * (milliseconds.max() + 1) < 2 ** 63 and np.array_equal(milliseconds / 1000, request_time)):
+        base = int(milliseconds.max()) + 1
+        ranks = milliseconds.astype('int64')
+        distinct_times = None
+    else:
+        distinct_times, ranks = np.unique(request_time, return_inverse=True)
+        base = len(distinct_times)
+        if n_urls * base >= 2 ** 63:
+            return request_time[np.lexsort((request_time, url_id))]
+    keys = url_id.astype('int64')
+    keys *= base
+    keys += ranks
+    keys.sort()
+    keys %= base
+    if distinct_times is None:
+        return keys / 1000
+    return distinct_times[keys]
+
+
+class UrlGroups(object):
+    """ Statistic of request times grouped by url_id. Arrays are indexed by url_id:
+    count, time_sum, time_max, time_med. sorted_times are request times sorted by (url_id, request_time),
+    starts are offsets of urls in sorted_times
+    """
+
+    def __init__(self, url_id, request_time, n_urls):
+        require_numpy()
+        url_id = np.asarray(url_id)
+        request_time = np.asarray(request_time, dtype='float64')
+        self.count = np.bincount(url_id, minlength=n_urls)
+        # bincount adds weights one by one in the order of rows, like the sequential sum of floats
+        self.time_sum = np.bincount(url_id, weights=request_time, minlength=n_urls)
+        self.total_sum = float(np.cumsum(request_time)[-1]) if len(request_time) else 0
+
+        self.sorted_times = sort_by_url(url_id, request_time, n_urls)
+        self.starts = np.zeros(n_urls, dtype='int64')
+        np.cumsum(self.count[:-1], out=self.starts[1:])
+        present = self.count > 0
+        ends = self.starts + self.count
+
+        self.time_max = np.full(n_urls, -np.inf)
+        self.time_max[present] = self.sorted_times[ends[present] - 1]
+        # median the same way as statistics.median: middle item or the mean of two middle items
+        self.time_med = np.full(n_urls, np.nan)
+        middle = self.starts + self.count // 2
+        odd = present & (self.count % 2 == 1)
+        even = present & (self.count % 2 == 0)
+        self.time_med[odd] = self.sorted_times[middle[odd]]
+        self.time_med[even] = (self.sorted_times[middle[even] - 1] + self.sorted_times[middle[even]]) / 2
+
+    def quantiles(self, url_id, fractions):
+        """ Nearest rank quantiles of the url's request times """
+        start, count = int(self.starts[url_id]), int(self.count[url_id])
+        times = self.sorted_times[start:start + count]
+        return [float(times[max(0, int(np.ceil(f * count)) - 1)]) for f in fractions]
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+""" Read gz files by large blocks of whole lines, decompression is overlapped with the processing of lines.
+
+The file is decompressed by an external `pigz -dc` or `gzip -dc` process if one of them is found in PATH,
+otherwise by a background thread (zlib releases the GIL while it decompresses). On a single core the file
+is decompressed inline. The consumer gets binary blocks which end at a line boundary and splits them into lines
+at once, without the per-line overhead of the gzip.open() file object.
+
+The same module is used by W1_Log_Analyzer and W12_Concurrency, keep copies identical.
+"""
+
+import os
+import gzip
+import queue
+import shutil
+import threading
+import subprocess
+
+BLOCK_SIZE = 1024 * 1024
+# number of decompressed blocks waiting for the consumer in thread mode
+QUEUE_DEPTH = 4
+DECOMPRESSORS = (('pigz', '-dc'), ('gzip', '-dc'))
+MODES = ('auto', 'subprocess', 'thread', 'inline')
+
+
+def decompress_command(path):
+    """ Command line of the first external decompressor found in PATH or None """
+    for command in DECOMPRESSORS:
+        executable = shutil.which(command[0])
+        if executable:
+            return [executable] + list(command[1:]) + [path]
+    return None
+
+
+def read_blocks(file, block_size):
+    """ Read binary file by blocks of about block_size bytes. Every block ends at the line boundary """
+    tail = b''
+    while True:
+        data = file.read(block_size)
+        if not data:
+            if tail:
+                yield tail
+            return
+        if tail:
+            data = tail + data
+        cut = data.rfind(b'\n') + 1
+        if cut:
+            tail = data[cut:]
+            yield data[:cut]
+        else:
+            tail = data
+
+
+def subprocess_blocks(path, block_size):
+    command = decompress_command(path)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=block_size)
+    try:
+        yield from read_blocks(process.stdout, block_size)
+        process.stdout.close()
+        if process.wait():
+            raise OSError("%s failed: %s" % (command[0], process.stderr.read().decode('utf-8', 'replace').strip()))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def thread_blocks(path, block_size):
+    blocks = queue.Queue(maxsize=QUEUE_DEPTH)
+    stop = threading.Event()
+
+    def put(item):
+        # the consumer may stop reading: don't block forever on the full queue
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decompress():
+        try:
+            with gzip.open(path, 'rb') as file:
+                for block in read_blocks(file, block_size):
+                    if not put(block):
+                        return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=decompress, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        thread.join()
+
+
+def inline_blocks(path, block_size):
+    with gzip.open(path, 'rb') as file:
+        yield from read_blocks(file, block_size)
+
+
+def gzip_blocks(path, block_size=BLOCK_SIZE, mode='auto'):
+    """ Yield decompressed blocks of the gz file, every block ends at the line boundary
+
+    Args:
+        path: path to the gz file
+        block_size: approximate size of a block
+        mode: 'subprocess' (pigz or gzip process), 'thread' (background thread), 'inline' (no overlap)
+        or 'auto' - subprocess if a decompressor is found in PATH, thread otherwise, inline on a single core
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown gzip reader mode: %s" % mode)
+    if mode == 'auto':
+        # there is nothing to overlap with on a single core, the pipe or the queue is just overhead
+        if (os.cpu_count() or 1) < 2:
+            mode = 'inline'
+        else:
+            mode = 'subprocess' if decompress_command(path) else 'thread'
+    if mode == 'subprocess':
+        return subprocess_blocks(path, block_size)
+    if mode == 'thread':
+        return thread_blocks(path, block_size)
+    return inline_blocks(path, block_size)
+
+
+def gzip_lines(path, block_size=BLOCK_SIZE, mode='auto', encoding=None):
+    """ Yield lines of the gz file without line endings: bytes or str if encoding is set.
+    Blocks are decoded at once, not line by line
+    """
+    for block in gzip_blocks(path, block_size, mode):
+        if encoding:
+            block = block.decode(encoding)
+            lines = block.split('\n')
+        else:
+            lines = block.split(b'\n')
+        # every block but the last one ends with the newline
+        if not lines[-1]:
+            lines.pop()
+        yield from lines
@@ -10,13 +10,32 @@
 import os
 import re
 import sys
+import math
 import argparse
 import configparser
 import gzip
-from collections import defaultdict, namedtuple
+import heapq
+import mmap
+import multiprocessing as mp
+import json
+import pickle
+from array import array
+from collections import namedtuple, deque
+from functools import partial
+from itertools import islice
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from statistics import median
 import time
 import logging
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from quantile_sketch import KLLSketch, k_for_error
+import columnar
+import gzip_reader
 
 def_config = {
     "REPORT_SIZE": 555,
@@ -24,9 +43,73 @@ def_config = {
     "LOG_DIR": "./log",
     "LOGGING": 'Noe',
     "TSFILE": "./monitoring",
-    "ERR_PARSE_RATE": 0.2
+    "ERR_PARSE_RATE": 0.2,
+    "MEDIAN_MODE": 'exact',
+    "MEDIAN_ERROR": 0.01,
+    "WORKERS": 1,
+    "REPORT_TOP": 0,
+    "URL_RULES": '',
+    "STRIP_QUERY": False,
+    "MAX_URLS": 0,
+    "ROLLING_DAYS": '',
+    "FOLLOW_LOG": '',
+    "FOLLOW_INTERVAL": 10,
+    "FOLLOW_WINDOW": 300,
+    "FOLLOW_FORMAT": 'html',
+    "COLUMNS_DIR": '',
+    "ENGINE": 'python',
+    "BACKFILL_WORKERS": 0,
+    "BREAKDOWNS": ''
     }
 
+MEDIAN_MODES = ('exact', 'approx')
+# python: streaming aggregate of UrlStat, numpy: url ids and request times in arrays and vectorized group-by
+ENGINES = ('python', 'numpy')
+# percentiles added to the report in approx median mode
+REPORT_PERCENTILES = (90, 95, 99)
+# parallel parsing: size of decompressed gz block sent to a worker and number of blocks waiting per worker
+PARALLEL_BLOCK_SIZE = 4 * 1024 * 1024
+PARALLEL_QUEUE_DEPTH = 2
+# version of the day aggregate file format (report_YYYYMMDD.agg)
+AGGREGATE_VERSION = 1
+# follow mode: active (not rotated) log name, pause when there are no new lines, max bytes read at once
+FOLLOW_LOG_NAME = 'nginx-access-ui.log'
+FOLLOW_POLL_INTERVAL = 0.5
+FOLLOW_READ_SIZE = 16 * 1024 * 1024
+FOLLOW_FORMATS = ('html', 'json')
+# rotated logs: the mask and the date in name as YYYYMMDD
+LOG_NAME_RE = re.compile(r'nginx-access-ui\.log-(\d{8})')
+# cache of find_last_log in the monitoring dir. Directory is not trusted if it was changed less than
+# LAST_LOG_CACHE_DELAY seconds ago: a file can be added within the resolution of the directory mtime
+LAST_LOG_CACHE = 'log_analyzer.last_log'
+LAST_LOG_CACHE_DELAY = 2
+
+# url cardinality cap: the bucket for folded urls, urls are folded when there are max_urls + max_urls / SLACK ones,
+# size of the raw url -> stat lookup cache of the parser
+OTHER_URL = '[other]'
+URL_FOLD_SLACK = 8
+RAW_URL_CACHE_SIZE = 100000
+# columnar cache of the parsed log: COLUMNS_DIR/<log name>.columns
+COLUMNS_SUFFIX = '.columns'
+
+# backfill mode: progress and timing of every log in the monitoring dir
+BACKFILL_STATUS = 'log_analyzer.backfill'
+
+# --profile: metrics of the run in the monitoring dir, lines read at once to time reading and parsing separately
+PROFILE_METRICS = 'log_analyzer.metrics'
+PROFILE_BATCH_SIZE = 100000
+
+# latency breakdowns of the report (strict parser fields)
+BREAKDOWN_FIELDS = ('status', 'method')
+# request times of breakdowns are added to sketches by batches of lines
+BREAKDOWN_BATCH_SIZE = 65536
+
+LastLogFeatures = namedtuple('LastLogFeatures', ['last_log', 'last_log_date'])
+# all fields of ui_short line, see parse_ui_short
+LogRecord = namedtuple('LogRecord', ['remote_addr', 'remote_user', 'real_ip', 'time_local', 'method', 'url',
+                                     'protocol', 'status', 'bytes_sent', 'referer', 'user_agent', 'forwarded_for',
+                                     'request_id', 'rb_user', 'request_time'])
+
 
 def parse_config (config, config_path):
     # update default config from file
@@ -49,39 +132,170 @@ def parse_config (config, config_path):
         raise
 
 
-def find_last_log(log_dir):
+def find_last_log(log_dir, cache_dir=None):
     """ Searching last log file. This file start with mask 'nginx-access-ui.log-' and contains the date in name.
     This date has a format YYYYMMDD.
+    If cache_dir is given, the result is saved there together with mtime of the log directory. Next time
+    the directory is not scanned if its mtime is the same (no files were added, removed or renamed)
 
     Args:
         log_dir: Directory path with log files
+        cache_dir: directory for the cache file (monitoring dir), None - no cache
 
     Returns:
         last_log: the file name with the latest date
         last_log_date: the date in the found log file (as a string and in format YYYYMMDD
     """
+    log_dir_mtime = os.stat(log_dir).st_mtime_ns
+    cache_path = os.path.join(cache_dir, LAST_LOG_CACHE) if cache_dir else None
+    cached = load_last_log_cache(cache_path, log_dir, log_dir_mtime)
+    if cached is not None:
+        return cached
 
     # find the log files by mask in name. Then select one with the last date
-    LastLogFeatures = namedtuple('LastLogFeatures', ['last_log', 'last_log_date'])
-    mask = 'nginx-access-ui.log-'
-
     last_log = None
     last_log_date = 0
 
-    for dir_file in os.listdir(log_dir):
-        if dir_file.startswith(mask):
-            log_temp = re.search(mask+'(\d{4}\d{2}\d{2})\.?', dir_file)
+    match = LOG_NAME_RE.match
+    with os.scandir(log_dir) as dir_files:
+        for dir_file in dir_files:
+            log_temp = match(dir_file.name)
             if log_temp is not None:
                 if int(log_temp.group(1)) > last_log_date:
-                    last_log = dir_file
+                    last_log = dir_file.name
                     last_log_date = int(log_temp.group(1))
     last_log_features = LastLogFeatures(last_log, last_log_date)
+
+    if cache_path and time.time() - log_dir_mtime / 1e9 > LAST_LOG_CACHE_DELAY:
+        save_last_log_cache(cache_path, log_dir, log_dir_mtime, last_log_features)
     return last_log_features
 
 
+def find_logs(log_dir):
+    """ All rotated logs in the directory as LastLogFeatures sorted by date. If there are plain and gz logs
+    of the same date, the first name in alphabetical order is taken
+    """
+    logs = {}
+    match = LOG_NAME_RE.match
+    with os.scandir(log_dir) as dir_files:
+        for dir_file in dir_files:
+            log_temp = match(dir_file.name)
+            if log_temp is not None:
+                log_date = int(log_temp.group(1))
+                if log_date not in logs or dir_file.name < logs[log_date]:
+                    logs[log_date] = dir_file.name
+    return [LastLogFeatures(logs[log_date], log_date) for log_date in sorted(logs)]
+
+
+def load_last_log_cache(cache_path, log_dir, log_dir_mtime):
+    """ Return cached LastLogFeatures if they were found for the same log directory with the same mtime """
+    if not cache_path:
+        return None
+    try:
+        with open(cache_path, encoding='utf-8') as cache_file:
+            cache = json.load(cache_file)
+        if cache['log_dir'] == os.path.abspath(log_dir) and cache['mtime_ns'] == log_dir_mtime:
+            return LastLogFeatures(cache['last_log'], cache['last_log_date'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def save_last_log_cache(cache_path, log_dir, log_dir_mtime, last_log_features):
+    cache = {"log_dir": os.path.abspath(log_dir),
+             "mtime_ns": log_dir_mtime,
+             "last_log": last_log_features.last_log,
+             "last_log_date": last_log_features.last_log_date}
+    try:
+        with open(cache_path + '.tmp', 'w', encoding='utf-8') as cache_file:
+            json.dump(cache, cache_file)
+        os.rename(cache_path + '.tmp', cache_path)
+    except OSError:
+        # the cache is an optimization only
+        logging.exception("Can't save the cache of the last log")
+
+
+def parse_line(line, urls=None):
+    """ Retrieve url (7-th column) and request time (the last column) from the raw (bytes) log line.
+    Only the first 8 columns are split and only the url is decoded. Decoded urls are interned and cached
+    in urls dict (raw column -> url), so the same url is decoded once.
+    Raise an exception if the line has a wrong format
+    """
+    raw_url = line.split(None, 7)[6]
+    response_time = float(line.rsplit(None, 1)[1])
+    url = urls.get(raw_url) if urls is not None else None
+    if url is None:
+        url = sys.intern(raw_url.strip(b'"').decode('utf-8'))
+        if urls is not None:
+            urls[raw_url] = url
+    return url, response_time
+
+
+def split_ui_short(line):
+    """ Split the raw (bytes) ui_short line into raw fields in the order of LogRecord. No regex: nginx escapes
+    quotes inside variables as \\x22, so the line is cut by quotes into exactly 13 parts and spaces inside quoted
+    fields are kept. The check is strict: the request has to be 'METHOD URL PROTOCOL', status and bytes have to be
+    numbers and all quoted fields have to be there. Raise ValueError otherwise (request time is checked by the caller)
+    """
+    parts = line.split(b'"')
+    if len(parts) != 13:
+        raise ValueError("Wrong line format")
+    head, request, middle, referer, _, user_agent, _, forwarded_for, _, request_id, _, rb_user, request_time = parts
+    addresses, time_sep, time_local = head.partition(b' [')
+    if not time_sep or time_local[-2:] != b'] ':
+        raise ValueError("Wrong time")
+    method, url, protocol = request.split(b' ')
+    status, bytes_sent = middle.split()
+    if not (status.isdigit() and bytes_sent.isdigit()):
+        raise ValueError("Wrong status or bytes")
+    remote_addr, remote_user, real_ip = addresses.split(None, 2)
+    return (remote_addr, remote_user, real_ip, time_local[:-2], method, url, protocol, status, bytes_sent,
+            referer, user_agent, forwarded_for, request_id, rb_user, request_time.strip())
+
+
+def parse_ui_short(line):
+    """ Parse the raw (bytes) ui_short line into LogRecord: status, bytes_sent are int, request_time is float,
+    other fields are str. Raise ValueError if the line has a wrong format
+    """
+    fields = split_ui_short(line)
+    return LogRecord(*[field.decode('utf-8', 'replace') for field in fields[:7]],
+                     status=int(fields[7]), bytes_sent=int(fields[8]),
+                     referer=fields[9].decode('utf-8', 'replace'), user_agent=fields[10].decode('utf-8', 'replace'),
+                     forwarded_for=fields[11].decode('utf-8', 'replace'), request_id=fields[12].decode('utf-8', 'replace'),
+                     rb_user=fields[13].decode('utf-8', 'replace'), request_time=float(fields[14]))
+
+
+def read_log_lines(last_log_with_path):
+    """ Yield raw (bytes) lines of the log. Gz file is decompressed by gzip_reader in parallel with parsing,
+    plain file is memory-mapped
+    """
+    if last_log_with_path.endswith(".gz"):
+        yield from gzip_reader.gzip_lines(last_log_with_path)
+        return
+    try:
+        last_log_file = open(last_log_with_path, 'rb')
+    except:
+        logging.error("An error occurred while opening the log file")
+        raise
+    with last_log_file:
+        # empty file can't be mapped
+        if not os.fstat(last_log_file.fileno()).st_size:
+            return
+        with mmap.mmap(last_log_file.fileno(), 0, access=mmap.ACCESS_READ) as last_log_map:
+            yield from iter(last_log_map.readline, b'')
+
+
+def check_error_rate(processed_lines, total_lines, err_parse_rate):
+    """ Compare current error rate with threshold. Stop if exceeded """
+    if total_lines and (1 - processed_lines/float(total_lines)) > float(err_parse_rate):
+        logging.error("Percentage of wrong lines in the file exceeded defined threshold. "
+                      "Script execution will be stopped ")
+        sys.exit()
+
+
 def parse_log(last_log_with_path, err_parse_rate):
     """ This func retrieve an url and its request time
-    At the first step, depending on file format, we select a function for file opening (gz or standard).
+    At the first step, depending on file format, we select a function for file opening (gz or memory-mapped).
     Then we process each line of the log and retrieve url(7-th column) and time (the last column) from the log.
     Args:
         last_log_with_path: path to logfile with the latest date in the name
@@ -89,46 +303,765 @@ def parse_log(last_log_with_path, err_parse_rate):
     Returns:
         parsed line with url and processed times as well as number of good processed lines and total processed lines
     """
-    if last_log_with_path.endswith(".gz"):
-        last_log_file = gzip.open(last_log_with_path, 'rt', encoding='utf-8')
-    else:
-        try:
-            last_log_file = open(last_log_with_path, encoding='utf-8')
-        except:
-            logging.error("An error occurred while opening the log file")
-            raise
     processed_lines = 0
     total_lines = 0
-    for line in last_log_file:
+    urls = {}
+    for line in read_log_lines(last_log_with_path):
+        total_lines += 1
         try:
-            splitted = line.split()
-            url = splitted[6]
-            url = url.strip('"')
-            response_time = splitted[-1]
-            total_lines += 1
-            processed_lines += 1
-            yield url, response_time
+            parsed = parse_line(line, urls)
         except:
+            continue
+        processed_lines += 1
+        yield parsed
+
+    # compare current error rate with threshold. Stop if exceeded
+    check_error_rate(processed_lines, total_lines, err_parse_rate)
+
+
+class UrlStat(object):
+    """ Running statistic for a single url. Count, total and max request time are updated on the fly,
+    request times are kept in a compact float64 array because they are needed for the median only.
+    In approx median mode a KLLSketch is used instead of the array, so memory per url is bounded
+    """
+    __slots__ = ('count', 'time_sum', 'time_max', 'times')
+
+    def __init__(self, times=None):
+        self.count = 0
+        self.time_sum = 0
+        self.time_max = float('-inf')
+        self.times = array('d') if times is None else times
+
+    def add(self, request_time):
+        self.count += 1
+        self.time_sum += request_time
+        if request_time > self.time_max:
+            self.time_max = request_time
+        self.times.append(request_time)
+
+    def extend(self, request_times):
+        """ Add a batch of request times (array of floats) at once """
+        if not request_times:
+            return
+        self.count += len(request_times)
+        self.time_sum += sum(request_times)
+        self.time_max = max(self.time_max, max(request_times))
+        self.times.extend(request_times)
+
+    def copy(self):
+        stat = UrlStat(self.times.copy() if isinstance(self.times, KLLSketch) else array('d', self.times))
+        stat.count = self.count
+        stat.time_sum = self.time_sum
+        stat.time_max = self.time_max
+        return stat
+
+    def median(self):
+        if isinstance(self.times, KLLSketch):
+            return self.times.quantile(0.5)
+        return median(self.times)
+
+    def quantiles(self, fractions):
+        if isinstance(self.times, KLLSketch):
+            return self.times.quantiles(fractions)
+        times = sorted(self.times)
+        return [times[max(0, int(math.ceil(f * len(times))) - 1)] for f in fractions]
+
+    def merge(self, other):
+        """ Add statistic of the same url from another aggregate. If one of them is a sketch
+        (aggregates were made in different median modes), the result is a sketch
+        """
+        self.count += other.count
+        self.time_sum += other.time_sum
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        if isinstance(self.times, KLLSketch):
+            if isinstance(other.times, KLLSketch):
+                self.times.merge(other.times)
+            else:
+                self.times.extend(other.times)
+        elif isinstance(other.times, KLLSketch):
+            times = KLLSketch(other.times.k)
+            times.extend(self.times)
+            self.times = times.merge(other.times)
+        else:
+            self.times.extend(other.times)
+
+    def to_state(self, sketch_k=None):
+        """ Statistic as a tuple of builtin types. If sketch_k is set, request times of the exact mode
+        are saved as a sketch of this size, so the state doesn't grow with the number of requests
+        """
+        if isinstance(self.times, KLLSketch):
+            times = self.times.to_state()
+        elif sketch_k:
+            sketch = KLLSketch(sketch_k)
+            sketch.extend(self.times)
+            times = sketch.to_state()
+        else:
+            times = self.times.tobytes()
+        return self.count, self.time_sum, self.time_max, times
+
+    @classmethod
+    def from_state(cls, state):
+        count, time_sum, time_max, times = state
+        stat = cls(array('d', times) if isinstance(times, bytes) else KLLSketch.from_state(times))
+        stat.count = count
+        stat.time_sum = time_sum
+        stat.time_max = time_max
+        return stat
+
+
+class UrlNormalizer(object):
+    """ Map urls with ids, hashes, query strings etc. to url templates, so they are counted as one url.
+    Rules are (regex, replacement) pairs applied by re.sub one after another, e.g.
+    ('/banner/\\d+', '/banner/{id}') maps /api/v2/banner/25019354 to /api/v2/banner/{id}
+    """
+
+    def __init__(self, rules=(), strip_query=False):
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+        self.strip_query = strip_query
+
+    def __call__(self, url):
+        if self.strip_query:
+            url = url.split('?', 1)[0]
+        for pattern, replacement in self.rules:
+            url = pattern.sub(replacement, url)
+        return url
+
+
+def parse_url_rules(url_rules):
+    """ Parse URL_RULES config value: one 'regex => replacement' rule per line """
+    rules = []
+    for rule in str(url_rules).splitlines():
+        if not rule.strip():
+            continue
+        pattern, separator, replacement = rule.partition('=>')
+        if not separator:
+            raise ValueError("Wrong url rule (has to be 'regex => replacement'): %s" % rule)
+        rules.append((pattern.strip(), replacement.strip()))
+    return rules
+
+
+def is_true(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def aggregate_settings(config):
+    """ Keyword arguments of LogAggregate (and aggregate_log) from the script config """
+    rules = parse_url_rules(config.get('URL_RULES', ''))
+    strip_query = is_true(config.get('STRIP_QUERY', False))
+    return {"median_mode": config.get('MEDIAN_MODE', 'exact'),
+            "median_error": float(config.get('MEDIAN_ERROR', 0.01)),
+            "normalizer": UrlNormalizer(rules, strip_query) if rules or strip_query else None,
+            "max_urls": int(config.get('MAX_URLS', 0)),
+            "breakdowns": parse_breakdowns(config.get('BREAKDOWNS', ''))}
+
+
+def parse_breakdowns(breakdowns):
+    """ 'status, method' -> ('status', 'method') """
+    fields = tuple(field.strip().lower() for field in str(breakdowns).split(',') if field.strip())
+    for field in fields:
+        if field not in BREAKDOWN_FIELDS:
+            raise ValueError("Unknown breakdown: %s (allowed: %s)" % (field, ', '.join(BREAKDOWN_FIELDS)))
+    return fields
+
+
+class LogAggregate(object):
+    """ Streaming aggregate of the parsed log: url -> UrlStat plus totals over all urls.
+    Memory depends on the number of distinct urls and 8 bytes per request time, strings are not stored.
+    With median_mode='approx' request times go to per url quantile sketches with the given rank error.
+
+    Urls are mapped by normalizer (if any) before they are counted. If max_urls is set, the number of urls
+    is capped by space-saving algorithm: when there are too many urls, the rarest ones are folded into
+    OTHER_URL bucket, and a url which comes after that starts with the count of the folded ones
+    (its possible overestimation), so rare urls can't push out the frequent ones.
+    OTHER_URL bucket always keeps a quantile sketch, so the memory is bounded in approx median mode.
+
+    breakdowns are fields from BREAKDOWN_FIELDS ('status', 'method'). If they are set, lines are parsed by
+    the strict ui_short parser and request times are counted by the values of these fields as well
+    (self.breakdowns: field -> value -> UrlStat). Breakdown stats always keep quantile sketches
+    """
+
+    def __init__(self, median_mode='exact', median_error=0.01, normalizer=None, max_urls=0, breakdowns=()):
+        if median_mode not in MEDIAN_MODES:
+            raise ValueError("Unknown median mode: %s" % median_mode)
+        self.median_mode = median_mode
+        self.median_error = median_error
+        self.normalizer = normalizer
+        self.max_urls = max_urls
+        self.urls = {}
+        self.total_count = 0
+        self.total_sum = 0
+        # lines read including the malformed ones, used for the error rate of parallel parsing
+        self.total_lines = 0
+        self.sketch_k = k_for_error(median_error) if median_mode == 'approx' else None
+        # space-saving state: overestimation of urls added after folding and the max count of folded urls
+        self.url_errors = {}
+        self.folded_count = 0
+        self.folds = 0
+        for field in breakdowns:
+            if field not in BREAKDOWN_FIELDS:
+                raise ValueError("Unknown breakdown: %s" % field)
+        self.breakdowns = {field: {} for field in breakdowns}
+
+    def empty_copy(self):
+        """ New aggregate with the same settings """
+        return LogAggregate(self.median_mode, self.median_error, self.normalizer, self.max_urls,
+                            tuple(self.breakdowns))
+
+    def breakdown_stat(self):
+        return UrlStat(KLLSketch(self.sketch_k or k_for_error(self.median_error)))
+
+    def breakdown_aggregate(self, field):
+        """ Breakdown by the field as an aggregate (values of the field instead of urls) for build_report """
+        aggregate = LogAggregate('approx', self.median_error)
+        aggregate.urls = self.breakdowns[field]
+        aggregate.total_count = self.total_count
+        aggregate.total_sum = self.total_sum
+        aggregate.total_lines = self.total_lines
+        return aggregate
+
+    def _stat_for(self, url):
+        """ UrlStat for the url (after normalization), a new one is created if necessary """
+        if self.normalizer is not None:
+            url = sys.intern(self.normalizer(url))
+        stat = self.urls.get(url)
+        if stat is None:
+            if self.max_urls and len(self.urls) >= self.max_urls + max(1, self.max_urls // URL_FOLD_SLACK):
+                self.fold_rare_urls()
+            stat = self.urls[url] = UrlStat(KLLSketch(self.sketch_k) if self.sketch_k else None)
+            if self.folded_count:
+                self.url_errors[url] = self.folded_count
+        return stat
+
+    def fold_rare_urls(self):
+        """ Fold the rarest urls into OTHER_URL bucket, so max_urls urls are left (including the bucket).
+        Urls are folded in a batch, so the cost of the selection is shared by many new urls
+        """
+        urls = self.urls
+        errors = self.url_errors
+        other = urls.pop(OTHER_URL, None)
+        if other is None:
+            other = UrlStat(KLLSketch(self.sketch_k or k_for_error(self.median_error)))
+        elif not isinstance(other.times, KLLSketch):
+            other.merge(UrlStat(KLLSketch(k_for_error(self.median_error))))
+        excess = len(urls) - (self.max_urls - 1)
+        if excess > 0:
+            rare = heapq.nsmallest(excess, urls.items(), key=lambda item: item[1].count + errors.get(item[0], 0))
+            for url, stat in rare:
+                self.folded_count = max(self.folded_count, stat.count + errors.pop(url, 0))
+                other.merge(stat)
+                del urls[url]
+        urls[OTHER_URL] = other
+        self.folds += 1
+
+    def add(self, url, request_time):
+        stat = self._stat_for(url)
+        stat.add(request_time)
+        self.total_count += 1
+        self.total_sum += request_time
+
+    def add_lines(self, lines):
+        """ Parse and add raw (bytes) log lines. This is the hot loop, so parse_line and add are inlined here.
+        Stats are looked up by the raw url column, so the url is decoded (and normalized) only for the first
+        its line. The lookup cache is dropped when urls are folded (cached stats may be gone) or it is too big
+        """
+        if self.breakdowns:
+            return self.add_lines_strict(lines)
+        raw_stats = {}
+        folds = self.folds
+        total_lines = total_count = 0
+        total_sum = self.total_sum
+        for line in lines:
             total_lines += 1
+            try:
+                raw_url = line.split(None, 7)[6]
+                response_time = float(line.rsplit(None, 1)[1])
+                stat = raw_stats.get(raw_url)
+                if stat is None:
+                    stat = self._stat_for(sys.intern(raw_url.strip(b'"').decode('utf-8')))
+                    if folds != self.folds or len(raw_stats) >= RAW_URL_CACHE_SIZE:
+                        folds = self.folds
+                        raw_stats.clear()
+                    raw_stats[raw_url] = stat
+            except:
+                continue
+            stat.add(response_time)
+            total_count += 1
+            total_sum += response_time
+        self.total_lines += total_lines
+        self.total_count += total_count
+        self.total_sum = total_sum
 
-    # Closes the file
-    last_log_file.close()
+    def add_lines_strict(self, lines):
+        """ add_lines with the strict ui_short parser (split_ui_short) and breakdowns by status and method
+        in the same pass. Lines rejected by the strict parser are counted as malformed. Request times of
+        breakdowns are buffered by the raw value and added to the sketches in batches (see flush_breakdowns)
+        """
+        raw_stats = {}
+        folds = self.folds
+        total_lines = total_count = 0
+        total_sum = self.total_sum
+        status_times = {} if 'status' in self.breakdowns else None
+        method_times = {} if 'method' in self.breakdowns else None
+        for line in lines:
+            total_lines += 1
+            try:
+                fields = split_ui_short(line)
+                raw_url = fields[5]
+                response_time = float(fields[14])
+                stat = raw_stats.get(raw_url)
+                if stat is None:
+                    stat = self._stat_for(sys.intern(raw_url.decode('utf-8')))
+                    if folds != self.folds or len(raw_stats) >= RAW_URL_CACHE_SIZE:
+                        folds = self.folds
+                        raw_stats.clear()
+                    raw_stats[raw_url] = stat
+            except:
+                continue
+            stat.add(response_time)
+            total_count += 1
+            total_sum += response_time
+            if status_times is not None:
+                times = status_times.get(fields[7])
+                if times is None:
+                    times = status_times[fields[7]] = array('d')
+                times.append(response_time)
+            if method_times is not None:
+                times = method_times.get(fields[4])
+                if times is None:
+                    times = method_times[fields[4]] = array('d')
+                times.append(response_time)
+            if not total_count % BREAKDOWN_BATCH_SIZE:
+                self.flush_breakdowns(status_times, method_times)
+        self.flush_breakdowns(status_times, method_times)
+        self.total_lines += total_lines
+        self.total_count += total_count
+        self.total_sum = total_sum
+
+    def flush_breakdowns(self, status_times, method_times):
+        """ Add buffered request times {raw value: array} to breakdown stats and clear buffers """
+        for field, buffers in (('status', status_times), ('method', method_times)):
+            if not buffers:
+                continue
+            stats = self.breakdowns[field]
+            for raw_value, times in buffers.items():
+                value = raw_value.decode('utf-8', 'replace')
+                stat = stats.get(value)
+                if stat is None:
+                    stat = stats[value] = self.breakdown_stat()
+                stat.extend(times)
+            buffers.clear()
+
+    def merge(self, other):
+        """ Add partial aggregate of another chunk of the log (or of another day). Urls which are new
+        for this aggregate are appended in the order of the other aggregate. The other aggregate is not changed
+        """
+        urls = self.urls
+        for url, other_stat in other.urls.items():
+            stat = urls.get(url)
+            if stat is None:
+                urls[url] = other_stat.copy()
+            else:
+                stat.merge(other_stat)
+                if self.sketch_k is None and isinstance(stat.times, KLLSketch):
+                    self.sketch_k = stat.times.k
+        if self.sketch_k is None:
+            self.sketch_k = other.sketch_k
+        for url, error in other.url_errors.items():
+            self.url_errors[url] = self.url_errors.get(url, 0) + error
+        self.folded_count = max(self.folded_count, other.folded_count)
+        for field, other_stats in other.breakdowns.items():
+            stats = self.breakdowns.setdefault(field, {})
+            for value, other_stat in other_stats.items():
+                if value in stats:
+                    stats[value].merge(other_stat)
+                else:
+                    stats[value] = other_stat.copy()
+        self.total_count += other.total_count
+        self.total_sum += other.total_sum
+        self.total_lines += other.total_lines
+        if self.max_urls and len(urls) > self.max_urls:
+            self.fold_rare_urls()
+        return self
+
+    def to_state(self, sketch_k=None):
+        """ Aggregate as a dict of builtin types, see save_aggregate. If sketch_k is set, exact request times
+        are saved as sketches of this size
+        """
+        return {"version": AGGREGATE_VERSION,
+                "sketch_k": self.sketch_k or sketch_k,
+                "total_count": self.total_count,
+                "total_sum": self.total_sum,
+                "total_lines": self.total_lines,
+                "urls": [(url, stat.to_state(sketch_k)) for url, stat in self.urls.items()],
+                "breakdowns": {field: [(value, stat.to_state(sketch_k)) for value, stat in stats.items()]
+                               for field, stats in self.breakdowns.items()}}
+
+    @classmethod
+    def from_state(cls, state):
+        if state.get("version") != AGGREGATE_VERSION:
+            raise ValueError("Unsupported aggregate version: %s" % state.get("version"))
+        aggregate = cls()
+        aggregate.sketch_k = state["sketch_k"]
+        aggregate.total_count = state["total_count"]
+        aggregate.total_sum = state["total_sum"]
+        aggregate.total_lines = state["total_lines"]
+        aggregate.urls = {url: UrlStat.from_state(stat) for url, stat in state["urls"]}
+        aggregate.breakdowns = {field: {value: UrlStat.from_state(stat) for value, stat in stats}
+                                for field, stats in state.get("breakdowns", {}).items()}
+        return aggregate
+
+
+def aggregate_log(last_log_with_path, err_parse_rate, median_mode='exact', median_error=0.01, workers=1,
+                  normalizer=None, max_urls=0, engine='python', profiler=None, breakdowns=()):
+    """ Single pass over the log. Every parsed line is converted to float once and added to the aggregate.
+    With the numpy engine lines are parsed into arrays and aggregated by aggregate_numpy
+
+    Args:
+        last_log_with_path: path to logfile with the latest date in the name
+        err_parse_rate: maximum number of wrong lines in log. If this threshold exceeds the execution will be stopped
+        median_mode: 'exact' keeps all request times, 'approx' keeps quantile sketches
+        median_error: rank error of quantile sketches (approx mode only)
+        workers: number of parser processes. The log is parsed in this process if it is 1
+        normalizer: UrlNormalizer or None
+        max_urls: cap of the number of urls, rare ones are folded into OTHER_URL (0 - no cap)
+        engine: 'python' or 'numpy' (workers, max_urls and breakdowns are not used)
+        profiler: Profiler or None. If it is set, lines are read by batches, so reading (and decompression) and
+        parsing are timed as separate phases in the single process python engine
+        breakdowns: fields from BREAKDOWN_FIELDS to break down request times by (strict parser is used)
+
+    Returns:
+        LogAggregate with the statistic for all urls
+    """
+    if engine == 'numpy':
+        return aggregate_numpy(last_log_with_path, err_parse_rate, median_mode, median_error, normalizer)
+    aggregate = LogAggregate(median_mode, median_error, normalizer, max_urls, breakdowns)
+    if workers > 1:
+        return aggregate_log_parallel(last_log_with_path, err_parse_rate, workers, aggregate)
+    if profiler is not None:
+        for batch in profiler.batches('read', read_log_lines(last_log_with_path)):
+            with profiler.phase('parse'):
+                aggregate.add_lines(batch)
+    else:
+        aggregate.add_lines(read_log_lines(last_log_with_path))
+    if max_urls and len(aggregate.urls) > max_urls:
+        aggregate.fold_rare_urls()
+    check_error_rate(aggregate.total_count, aggregate.total_lines, err_parse_rate)
+    return aggregate
+
+
+def split_file(path, parts):
+    """ Split plain file into byte ranges of about the same size. Every range ends at the line boundary
+
+    Args:
+        path: path to the file
+        parts: number of ranges
+
+    Returns:
+        list of (start, end) tuples, empty ranges are skipped
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as file:
+        for i in range(1, parts):
+            file.seek(max(size * i // parts, bounds[-1]))
+            file.readline()
+            bounds.append(min(file.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def read_range(path, start, end):
+    """ Yield raw lines of the memory-mapped file which start in [start, end) """
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+        file_map.seek(start)
+        position = start
+        for line in iter(file_map.readline, b''):
+            if position >= end:
+                break
+            position += len(line)
+            yield line
 
-    # compare current error rate with threshold. Stop if exceeded
-    if (1 - processed_lines/float(total_lines)) > err_parse_rate:
-        logging.error("Percentage of wrong lines in the file exceeded defined threshold. "
-                      "Script execution will be stopped ")
-        sys.exit()
 
+def parse_worker(tasks, results, last_log_with_path, prototype):
+    """ Parser process. Byte range task gives its own partial aggregate (index, aggregate), so ranges can be
+    merged in the file order. Gz blocks are accumulated in one aggregate which is sent when tasks are over.
+    Partial aggregates have the same settings as the prototype (empty aggregate).
+    'done' marker is sent at the end, 'error' if the worker failed (the rest of tasks is consumed anyway,
+    so the reader is not blocked on the full queue)
+    """
+    blocks_aggregate = prototype.empty_copy()
+    failed = False
+    for task in iter(tasks.get, None):
+        if failed:
+            continue
+        try:
+            if isinstance(task, tuple):
+                index, start, end = task
+                aggregate = prototype.empty_copy()
+                aggregate.add_lines(read_range(last_log_with_path, start, end))
+                results.put((index, aggregate))
+            else:
+                blocks_aggregate.add_lines(task.splitlines())
+        except Exception:
+            logging.exception("An error occurred in the parser process")
+            failed = True
+    if failed:
+        results.put('error')
+        return
+    if blocks_aggregate.total_lines:
+        results.put((-1, blocks_aggregate))
+    results.put('done')
+
+
+def aggregate_log_parallel(last_log_with_path, err_parse_rate, workers, aggregate=None):
+    """ The same as aggregate_log, but lines are parsed by the pool of worker processes.
+    Plain file is split into byte ranges, one range per worker. Gz file is decompressed by gzip_reader and
+    sent to workers by blocks through the bounded queue, so decompression and parsing are overlapped.
+    Partial aggregates are merged and the error rate is checked for the whole file
+
+    Args:
+        last_log_with_path: path to logfile with the latest date in the name
+        err_parse_rate: maximum number of wrong lines in log. If this threshold exceeds the execution will be stopped
+        workers: number of parser processes
+        aggregate: empty LogAggregate with the settings (median mode, url normalizer, etc.), partial aggregates
+        of workers are merged into it. Default - LogAggregate()
+
+    Returns:
+        LogAggregate with the statistic for all urls
+    """
+    if aggregate is None:
+        aggregate = LogAggregate()
+    tasks = mp.Queue(maxsize=workers * PARALLEL_QUEUE_DEPTH)
+    results = mp.Queue()
+    processes = [mp.Process(target=parse_worker,
+                            args=(tasks, results, last_log_with_path, aggregate.empty_copy()))
+                 for _ in range(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    try:
+        if last_log_with_path.endswith(".gz"):
+            for block in gzip_reader.gzip_blocks(last_log_with_path, PARALLEL_BLOCK_SIZE):
+                tasks.put(block)
+        else:
+            for index, (start, end) in enumerate(split_file(last_log_with_path, workers)):
+                tasks.put((index, start, end))
+        for _ in processes:
+            tasks.put(None)
+
+        partials = []
+        done = failed = 0
+        while done < workers:
+            result = results.get()
+            if result == 'done':
+                done += 1
+            elif result == 'error':
+                done += 1
+                failed += 1
+            else:
+                partials.append(result)
+        if failed:
+            raise RuntimeError("%s parser processes failed" % failed)
+    except:
+        logging.error("An error occurred while parsing the log file")
+        for process in processes:
+            process.terminate()
+        raise
+    for process in processes:
+        process.join()
+
+    for _, partial in sorted(partials, key=lambda p: p[0]):
+        aggregate.merge(partial)
+    check_error_rate(aggregate.total_count, aggregate.total_lines, err_parse_rate)
+    return aggregate
+
+
+class ColumnStat(object):
+    """ Statistic of a url calculated by the vectorized group-by over columns (see ColumnsAggregate).
+    It has the interface of UrlStat used by build_report and save_aggregate
+    """
+    __slots__ = ('groups', 'url_id', 'count', 'time_sum', 'time_max', 'time_med')
+
+    def __init__(self, groups, url_id, count, time_sum, time_max, time_med):
+        self.groups = groups
+        self.url_id = url_id
+        self.count = count
+        self.time_sum = time_sum
+        self.time_max = time_max
+        self.time_med = time_med
+
+    def median(self):
+        return self.time_med
+
+    def quantiles(self, fractions):
+        return self.groups.quantiles(self.url_id, fractions)
+
+    def to_state(self, sketch_k=None):
+        """ The same state as UrlStat.to_state: request times as float64 bytes or as a sketch of sketch_k """
+        start = int(self.groups.starts[self.url_id])
+        times = self.groups.sorted_times[start:start + self.count].tobytes()
+        if sketch_k:
+            sketch = KLLSketch(sketch_k)
+            sketch.extend(array('d', times))
+            times = sketch.to_state()
+        return self.count, self.time_sum, self.time_max, times
+
+
+class ColumnsAggregate(object):
+    """ Aggregate of the log built from its columnar cache. Counts, sums, max and medians of all urls are
+    calculated at once by columnar.UrlGroups, so a report with another REPORT_SIZE or REPORT_TOP is a group-by
+    over memory-mapped arrays instead of parsing the log again. Values are the same as in LogAggregate
+    of the exact median mode. In approx median mode percentiles are added to the report as well,
+    but they are exact too. MAX_URLS is not applied
+    """
+
+    def __init__(self, columns, median_mode='exact', median_error=0.01, normalizer=None):
+        if normalizer is not None:
+            columns = columnar.normalize_urls(columns, normalizer)
+        groups = columnar.UrlGroups(columns.url_id, columns.request_time, len(columns.urls))
+        self.median_error = median_error
+        self.sketch_k = k_for_error(median_error) if median_mode == 'approx' else None
+        self.total_count = len(columns)
+        self.total_sum = groups.total_sum
+        self.total_lines = columns.total_lines
+        # breakdowns are made by the strict parser of the python engine only
+        self.breakdowns = {}
+        self.urls = {}
+        for url_id, (url, count, time_sum, time_max, time_med) in enumerate(zip(
+                columns.urls, groups.count.tolist(), groups.time_sum.tolist(),
+                groups.time_max.tolist(), groups.time_med.tolist())):
+            if count:
+                self.urls[url] = ColumnStat(groups, url_id, count, time_sum, time_max, time_med)
+
+    def to_state(self, sketch_k=None):
+        """ The same state as LogAggregate.to_state, so the aggregate can be saved for rolling reports """
+        return {"version": AGGREGATE_VERSION,
+                "sketch_k": sketch_k,
+                "total_count": self.total_count,
+                "total_sum": self.total_sum,
+                "total_lines": self.total_lines,
+                "urls": [(url, stat.to_state(sketch_k)) for url, stat in self.urls.items()]}
 
-def create_report(last_log_with_path,err_parse_rate, report_size):
+
+def aggregate_columns(last_log_with_path, err_parse_rate, columns_dir, median_mode='exact', median_error=0.01,
+                      normalizer=None):
+    """ Aggregate the log through its columnar cache. The log is parsed into columns (url_id, request_time,
+    status, timestamp and the url dictionary) and saved as .npy files in columns_dir at the first run,
+    the next runs load the saved columns
+
+    Args:
+        last_log_with_path: path to logfile with the latest date in the name
+        err_parse_rate: maximum number of wrong lines in log. If this threshold exceeds the execution will be stopped
+        columns_dir: directory of columnar caches
+        median_mode: 'exact' or 'approx' (adds percentile columns)
+        median_error: rank error of quantile sketches, it is kept in the aggregate only
+        normalizer: UrlNormalizer or None. Urls are normalized after loading, the cache keeps raw urls
+
+    Returns:
+        ColumnsAggregate
+    """
+    columns_path = os.path.join(columns_dir, os.path.basename(last_log_with_path) + COLUMNS_SUFFIX)
+    if os.path.isdir(columns_path):
+        columns = columnar.load_columns(columns_path)
+        check_error_rate(len(columns), columns.total_lines, err_parse_rate)
+    else:
+        columns = columnar.parse_columns(read_log_lines(last_log_with_path))
+        check_error_rate(len(columns), columns.total_lines, err_parse_rate)
+        try:
+            os.makedirs(columns_dir, exist_ok=True)
+            columnar.save_columns(columns, columns_path)
+        except:
+            logging.error("An error occurred while saving the columnar cache of the log")
+            raise
+    return ColumnsAggregate(columns, median_mode, median_error, normalizer)
+
+
+def aggregate_numpy(last_log_with_path, err_parse_rate, median_mode='exact', median_error=0.01, normalizer=None):
+    """ Numpy engine: urls are mapped to integer ids, request times are stored in one float64 array and
+    the statistic of all urls is calculated by the vectorized group-by (see ColumnsAggregate).
+    The report is the same as the report of the exact python engine
+
+    Args:
+        last_log_with_path: path to logfile with the latest date in the name
+        err_parse_rate: maximum number of wrong lines in log. If this threshold exceeds the execution will be stopped
+        median_mode: 'exact' or 'approx' (adds percentile columns)
+        median_error: rank error of quantile sketches, it is kept in the aggregate only
+        normalizer: UrlNormalizer or None
+
+    Returns:
+        ColumnsAggregate
+    """
+    url_id, request_time, urls, total_lines = columnar.parse_url_times(read_log_lines(last_log_with_path))
+    check_error_rate(len(request_time), total_lines, err_parse_rate)
+    columns = columnar.Columns(url_id, request_time, None, None, urls, total_lines)
+    return ColumnsAggregate(columns, median_mode, median_error, normalizer)
+
+
+def build_report(aggregate, report_size, report_top=0):
+    """ Calculate report rows from the aggregate. See create_report for the description of the columns.
+    Urls are selected and sorted by total time first, so medians are calculated for the report rows only
+
+    Args:
+        aggregate: LogAggregate with the statistic for all urls
+        report_size: parameter to filter report data.
+        Only urls with total request time > report_size are selected
+        report_top: if > 0, only this number of urls with the largest total time are selected (heapq.nlargest,
+        all urls are not sorted)
+
+    Returns:
+        filtered_report: data which have to be placed in html report
+    """
+    total_count = aggregate.total_count
+    total_sum = aggregate.total_sum
+    report_size = int(report_size)
+    report_top = int(report_top)
+
+    # Filter rows
+    selected = [(round(stat.time_sum, 3), log, stat) for log, stat in aggregate.urls.items()]
+    selected = [item for item in selected if item[0] >= report_size]
+    if report_top > 0:
+        selected = heapq.nlargest(report_top, selected, key=lambda item: item[0])
+    else:
+        selected.sort(key=lambda item: item[0], reverse=True)
+
+    filtered_report = []
+    for _, log, stat in selected:
+        time_sum = stat.time_sum
+        count = stat.count
+        count_perc = (count / total_count) * 100
+        time_avg = time_sum / count
+        time_med = stat.median()
+        time_perc = (time_sum / total_sum) * 100
+        sample = {"count": count,
+                  "time_avg": round(time_avg, 3),
+                  "time_max": round(stat.time_max, 3),
+                  "time_sum": round(time_sum, 3),
+                  "url": log,
+                  "time_med": round(time_med, 3),
+                  "time_perc": round(time_perc, 3),
+                  "count_perc": round(count_perc, 3)
+                  }
+        if aggregate.sketch_k:
+            percentiles = stat.quantiles([p / 100.0 for p in REPORT_PERCENTILES])
+            for p, value in zip(REPORT_PERCENTILES, percentiles):
+                sample["time_p%d" % p] = round(value, 3)
+        filtered_report.append(sample)
+
+    return filtered_report
+
+
+def create_report(last_log_with_path, err_parse_rate, report_size, median_mode='exact', median_error=0.01,
+                  workers=1, report_top=0, normalizer=None, max_urls=0, engine='python'):
 
     """ This function generates the data which have to placed in html report
-    At the first step we calculate the aggregated statistic for all urls and form dict with url as a key
-    and list of values as a time:
-        total number of pages' visits
-        total time to process requests for all pages
-    Then, line by line we calculate necessary statistic by every url:
+    At the first step we stream the log into the aggregate: for every url we keep
+        total number of url's visits
+        total and max time to process requests for this url
+        request times as a float array (for the median)
+    as well as total number of pages' visits and total time to process requests for all pages.
+    Then, url by url we calculate necessary statistic:
         total time to process requests for this url
         total number of url's visits
         % of number url's visits to number of all pages' visits
@@ -137,58 +1070,46 @@ def create_report(last_log_with_path,err_parse_rate, report_size):
     After, we apply the filter by report_size parameter. Only urls with total request time > report_size are selected.
     For this column we apply descending sorting as well.
     Finally we save report data in the format which is suitable for placing in html template
+    In approx median mode medians are taken from quantile sketches and p90, p95, p99 columns are added
 
     Args:
         last_log_with_path: path to logfile with the latest date in the name
         report_size: parameter to filter report data.
         Only urls with total request time > report_size are selected
         err_parse_rate: maximum number of wrong lines in log. If this threshold exceeds the execution will be stopped
+        median_mode: 'exact' or 'approx'
+        median_error: rank error of quantile sketches in approx mode
+        workers: number of parser processes. The log is parsed in this process if it is 1
+        report_top: if > 0, only this number of urls with the largest total time are selected
+        normalizer: UrlNormalizer or None
+        max_urls: cap of the number of urls, rare ones are folded into OTHER_URL (0 - no cap)
+        engine: 'python' or 'numpy' (vectorized statistic, see aggregate_numpy)
 
 
     Returns:
         filtered_report: data which have to be placed in html report
     """
 
-    # calculate the statistic for all urls
-    total_count = total_sum = 0
-    parsed_lines = parse_log(last_log_with_path,err_parse_rate)
-    time_log = defaultdict(list)
-    for url, response_time in parsed_lines:
-        time_log[url].append(response_time)
-        total_count += 1
-        total_sum += float(response_time)
-
-    # create report as a dict. The key is an url, values is the target statistic for the report
-    report = []
-    for log, times in time_log.items():
-        time_sum = sum([float(x) for x in times])
-        count = len(times)
-        count_perc = (count / total_count) * 100
-        time_avg = time_sum / count
-        time_max = max([float(x) for x in times])
-        time_med = median([float(x) for x in times])
-        time_perc = (time_sum / total_sum) * 100
-        if round(time_sum, 3) >= int(report_size):
-            sample = {"count": count,
-                      "time_avg": round(time_avg, 3),
-                      "time_max": round(time_max, 3),
-                      "time_sum": round(time_sum, 3),
-                      "url": log,
-                      "time_med": round(time_med, 3),
-                      "time_perc": round(time_perc, 3),
-                      "count_perc": round(count_perc, 3)
-                      }
-            report.append(sample)
+    aggregate = aggregate_log(last_log_with_path, err_parse_rate, median_mode, median_error, workers,
+                              normalizer, max_urls, engine)
+    return build_report(aggregate, report_size, report_top)
 
-    # Filter rows
-    filtered_report = sorted(report, key=lambda k: k['time_sum'], reverse=True)
 
-    return filtered_report
+def write_json_rows(file, rows):
+    """ Write rows as json list row by row, the whole json text is not built in memory """
+    dumps = json.dumps
+    file.write('[')
+    for i, row in enumerate(rows):
+        if i:
+            file.write(', ')
+        file.write(dumps(row))
+    file.write(']')
 
 
 def generate_html_report(filtered_report, report_dir,  last_report_name):
 
-    """ Function to generate html report
+    """ Function to generate html report. The report is streamed into the file: the part of the template
+    before '$table_json' placeholder, json rows of the report one by one and the rest of the template
 
     Args:
         report_dir: - directory where reports are stored
@@ -207,12 +1128,14 @@ def generate_html_report(filtered_report, report_dir,  last_report_name):
         logging.error("Report template not found")
         raise
     try:
-        # replace '$table_json' placeholder by the data from filtered_report variable
-        newdata = html_data.replace('$table_json', str(filtered_report))
+        # '$table_json' placeholder is replaced by the data from filtered_report variable
+        prefix, _, suffix = html_data.partition('$table_json')
 
         # create temporary html file and inject report data
         with open(os.path.join(report_dir, str('temp_') + last_report_name), 'w', encoding='utf-8') as html_report:
-            html_report.write(newdata)
+            html_report.write(prefix)
+            write_json_rows(html_report, filtered_report)
+            html_report.write(suffix)
 
         # if all was ok, remove temp_ mask from report's filename
         os.rename(os.path.join(report_dir, str('temp_') + last_report_name),
@@ -224,6 +1147,230 @@ def generate_html_report(filtered_report, report_dir,  last_report_name):
         raise
 
 
+def aggregate_file_name(log_date):
+    return 'report_' + str(log_date) + '.agg'
+
+
+def save_aggregate(aggregate, report_dir, log_date):
+    """ Save the aggregate of the day next to its report (report_YYYYMMDD.agg). The file is a gzipped pickle
+    of builtin types: counters per url and request times as sketch compactors. Request times of the exact
+    median mode are saved as sketches of the aggregate's median_error as well, so the file size doesn't grow
+    with the traffic and medians of rolling reports are approximate (rank error within MEDIAN_ERROR).
+    Rolling reports merge these files instead of parsing old logs again
+
+    Args:
+        aggregate: LogAggregate of the day
+        report_dir: directory where reports are stored
+        log_date: date of the log as YYYYMMDD
+
+    Returns:
+        path to the saved file
+    """
+    path = os.path.join(report_dir, aggregate_file_name(log_date))
+    temp_path = os.path.join(report_dir, 'temp_' + aggregate_file_name(log_date))
+    try:
+        with gzip.open(temp_path, 'wb', compresslevel=1) as file:
+            pickle.dump(aggregate.to_state(aggregate.sketch_k or k_for_error(aggregate.median_error)), file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+    except:
+        logging.error("An error occurred while saving the aggregate of the day")
+        raise
+    return path
+
+
+def load_aggregate(report_dir, log_date):
+    """ Load the aggregate saved by save_aggregate. Returns None if there is no file for this date """
+    path = os.path.join(report_dir, aggregate_file_name(log_date))
+    if not os.path.isfile(path):
+        return None
+    with gzip.open(path, 'rb') as file:
+        return LogAggregate.from_state(pickle.load(file))
+
+
+def rolling_aggregate(report_dir, log_date, days):
+    """ Merge saved aggregates of `days` days which end with log_date (inclusive). Missing days are skipped
+
+    Args:
+        report_dir: directory where reports and aggregates are stored
+        log_date: the last date of the period as YYYYMMDD
+        days: length of the period
+
+    Returns:
+        merged LogAggregate and number of days found
+    """
+    last_date = datetime.strptime(str(log_date), '%Y%m%d')
+    aggregate = LogAggregate()
+    found = 0
+    for shift in range(days - 1, -1, -1):
+        day_aggregate = load_aggregate(report_dir, (last_date - timedelta(days=shift)).strftime('%Y%m%d'))
+        if day_aggregate is not None:
+            aggregate.merge(day_aggregate)
+            found += 1
+    return aggregate, found
+
+
+def parse_rolling_days(rolling_days):
+    """ '7,30' -> [7, 30] """
+    return [int(days) for days in str(rolling_days).split(',') if days.strip()]
+
+
+def generate_rolling_reports(aggregate, config, log_date):
+    """ Save the aggregate of the day and generate report_<N>d_YYYYMMDD.html for every period from ROLLING_DAYS
+
+    Args:
+        aggregate: LogAggregate of the day
+        config: script config
+        log_date: date of the log as YYYYMMDD
+    """
+    save_aggregate(aggregate, config['REPORT_DIR'], log_date)
+    generate_period_reports(config, log_date)
+
+
+def generate_period_reports(config, log_date):
+    """ Generate report_<N>d_YYYYMMDD.html for every period from ROLLING_DAYS from saved aggregates """
+    for days in parse_rolling_days(config.get('ROLLING_DAYS', '')):
+        period_aggregate, found = rolling_aggregate(config['REPORT_DIR'], log_date, days)
+        if found < days:
+            logging.info("%s-day report: aggregates for %s days were not found" % (days, days - found))
+        generate_html_report(build_report(period_aggregate, config['REPORT_SIZE'], config.get('REPORT_TOP', 0)),
+                             config['REPORT_DIR'],
+                             'report_%sd_%s.html' % (days, log_date))
+
+
+def generate_json_report(filtered_report, report_dir, last_report_name):
+    """ Write report data as json list of rows. The file is replaced atomically (temp_ file and rename) """
+    temp_path = os.path.join(report_dir, 'temp_' + last_report_name)
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as json_report:
+            write_json_rows(json_report, filtered_report)
+        os.rename(temp_path, os.path.join(report_dir, last_report_name))
+    except:
+        logging.error("An error occurred while creating the json-report")
+        raise
+
+
+class LogFollower(object):
+    """ Read lines appended to the growing log, like tail -F. Rotation is detected by the change of inode
+    (the file was renamed and the new one was created) or by the shrink of the file (copytruncate).
+    The rest of the rotated file is read before switching to the new one
+    """
+
+    def __init__(self, path, from_end=True):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.tail = b''
+        self._open(from_end)
+
+    def _open(self, from_end=False):
+        try:
+            self.file = open(self.path, 'rb')
+        except FileNotFoundError:
+            self.file = None
+            return
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        if from_end:
+            self.file.seek(0, os.SEEK_END)
+
+    def _read(self):
+        lines = []
+        while True:
+            chunk = self.file.read(FOLLOW_READ_SIZE)
+            if not chunk:
+                return lines
+            data = self.tail + chunk
+            cut = data.rfind(b'\n') + 1
+            self.tail = data[cut:]
+            lines.extend(data[:cut].splitlines())
+            if len(chunk) < FOLLOW_READ_SIZE:
+                return lines
+
+    def read_lines(self):
+        """ Return list of new complete raw lines (the last line without newline waits for the next call) """
+        if self.file is None:
+            # log doesn't exist yet (or was rotated and the new one is not created), read it from the beginning
+            self._open()
+            if self.file is None:
+                return []
+        lines = self._read()
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return lines
+        if stat.st_ino != self.inode:
+            # rotated: the old file is read till the end, its last line is complete
+            if self.tail:
+                lines.append(self.tail)
+                self.tail = b''
+            self.file.close()
+            self._open()
+            lines.extend(self._read())
+        elif stat.st_size < self.file.tell():
+            # truncated in place
+            self.file.seek(0)
+            self.tail = b''
+            lines.extend(self._read())
+        return lines
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def follow_log(config, max_snapshots=None):
+    """ Live analysis of the active log. New lines are added to the aggregate of the current interval,
+    every FOLLOW_INTERVAL seconds the aggregates of the last FOLLOW_WINDOW seconds are merged and
+    report_live.html (or report_live.json) is regenerated in the report directory
+
+    Args:
+        config: script config
+        max_snapshots: stop after this number of reports (None - follow forever)
+    """
+    path = config.get('FOLLOW_LOG') or os.path.join(config['LOG_DIR'], FOLLOW_LOG_NAME)
+    interval = float(config.get('FOLLOW_INTERVAL', 10))
+    window = float(config.get('FOLLOW_WINDOW', 300))
+    report_format = config.get('FOLLOW_FORMAT', 'html')
+    if report_format not in FOLLOW_FORMATS:
+        raise ValueError("Unknown report format: %s" % report_format)
+    prototype = LogAggregate(**aggregate_settings(config))
+
+    logging.info("Following %s, report every %s sec for the last %s sec" % (path, interval, window))
+    follower = LogFollower(path)
+    buckets = deque(maxlen=max(1, int(math.ceil(window / interval))))
+    bucket = prototype.empty_copy()
+    next_snapshot = time.time() + interval
+    snapshots = 0
+    try:
+        while max_snapshots is None or snapshots < max_snapshots:
+            lines = follower.read_lines()
+            if lines:
+                bucket.add_lines(lines)
+            else:
+                time.sleep(min(FOLLOW_POLL_INTERVAL, max(0, next_snapshot - time.time())))
+            if time.time() < next_snapshot:
+                continue
+
+            buckets.append(bucket)
+            bucket = prototype.empty_copy()
+            snapshot = prototype.empty_copy()
+            for window_bucket in buckets:
+                snapshot.merge(window_bucket)
+            filtered_report = build_report(snapshot, config['REPORT_SIZE'], config.get('REPORT_TOP', 0))
+            if report_format == 'json':
+                generate_json_report(filtered_report, config['REPORT_DIR'], 'report_live.json')
+            else:
+                generate_html_report(filtered_report, config['REPORT_DIR'], 'report_live.html')
+            generate_ts_file(config['TSFILE'])
+            snapshots += 1
+            next_snapshot += interval
+            if next_snapshot < time.time():
+                # the report took longer than the interval, don't try to catch up
+                next_snapshot = time.time() + interval
+    finally:
+        follower.close()
+
+
 def generate_ts_file(ts_file_dir):
     """ function to create ts-file with the timestamp when last html report was generated.
 
@@ -244,33 +1391,249 @@ def generate_ts_file(ts_file_dir):
         raise
 
 
-def main(config):
+class Profiler(object):
+    """ Wall and CPU time of the phases of the run for --profile mode. Phases with the same name are summed.
+    Metrics are saved next to log_analyzer.ts, so slow runs can be compared with previous ones
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextmanager
+    def phase(self, name):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0})
+            phase["wall_seconds"] += time.perf_counter() - start_wall
+            phase["cpu_seconds"] += time.process_time() - start_cpu
+
+    def batches(self, name, iterable, size=PROFILE_BATCH_SIZE):
+        """ Yield lists of `size` items of iterable, time to get them is the phase `name` """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                batch = list(islice(iterator, size))
+            if not batch:
+                return
+            yield batch
+
+    def metrics(self, log=None, aggregate=None):
+        """ Metrics of the run as a dict: per-phase and total time, lines/sec, malformed lines and peak RSS """
+        wall_seconds = time.perf_counter() - self.start_wall
+        metrics = {"timestamp": time.asctime(),
+                   "log": log,
+                   "wall_seconds": round(wall_seconds, 3),
+                   "cpu_seconds": round(time.process_time() - self.start_cpu, 3),
+                   "phases": {name: {key: round(value, 3) for key, value in phase.items()}
+                              for name, phase in self.phases.items()}}
+        if aggregate is not None:
+            metrics.update(lines=aggregate.total_lines,
+                           malformed_lines=aggregate.total_lines - aggregate.total_count,
+                           lines_per_sec=round(aggregate.total_lines / wall_seconds) if wall_seconds else 0)
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux. Parser processes (WORKERS > 1) are children
+            metrics.update(peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                           children_peak_rss_kb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                           children_cpu_seconds=round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_utime +
+                                                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_stime, 3))
+        return metrics
+
+
+@contextmanager
+def no_phase(name):
+    """ Phase of the run when it is not profiled """
+    yield
+
+
+def save_metrics(metrics, ts_file_dir):
+    """ Write metrics of the run to log_analyzer.metrics (json) in the monitoring dir (temp_ file and rename) """
+    path = os.path.join(ts_file_dir, PROFILE_METRICS)
+    temp_path = os.path.join(ts_file_dir, 'temp_' + PROFILE_METRICS)
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(metrics, file, indent=1)
+        os.rename(temp_path, path)
+        logging.info("Metrics of the run have been saved to %s" % path)
+    except:
+        logging.error("An error occurred while saving metrics of the run")
+        raise
+
+
+def report_name(log_date):
+    return 'report_' + str(log_date) + '.html'
+
+
+def process_log(config, last_log_features, profiler=None):
+    """ Parse the log and generate its html report (written to temp_ file and renamed)
+
+    Args:
+        config: script config
+        last_log_features: LastLogFeatures of the log
+        profiler: Profiler to time the phases or None
+
+    Returns:
+        the aggregate of the log
+    """
+    last_report_name = report_name(last_log_features.last_log_date)
+
+    # Generate report data
+    last_log_with_path = os.path.join(config['LOG_DIR'], last_log_features.last_log)
+    settings = aggregate_settings(config)
+    phase = profiler.phase if profiler is not None else no_phase
+    if config.get('COLUMNS_DIR'):
+        with phase('aggregate'):
+            aggregate = aggregate_columns(last_log_with_path, config['ERR_PARSE_RATE'], config['COLUMNS_DIR'],
+                                          settings['median_mode'], settings['median_error'], settings['normalizer'])
+    else:
+        with phase('aggregate'):
+            aggregate = aggregate_log(last_log_with_path, config['ERR_PARSE_RATE'],
+                                      workers=int(config.get('WORKERS', 1)), engine=config.get('ENGINE', 'python'),
+                                      profiler=profiler, **settings)
+    with phase('report'):
+        filtered_report = build_report(aggregate, config['REPORT_SIZE'], config.get('REPORT_TOP', 0))
+    logging.info("Reports' data has been generated")
+
+    # Get html template, copy the report data and generate the html-report
+    with phase('html'):
+        generate_html_report(filtered_report, config['REPORT_DIR'], last_report_name)
+
+    # latency breakdowns (report_status_YYYYMMDD.html, report_method_YYYYMMDD.html) made in the same pass
+    for field in aggregate.breakdowns:
+        with phase('breakdowns'):
+            generate_html_report(build_report(aggregate.breakdown_aggregate(field), 0),
+                                 config['REPORT_DIR'],
+                                 'report_%s_%s.html' % (field, last_log_features.last_log_date))
+    return aggregate
+
+
+def backfill_worker(config, log_features):
+    """ Process one log in the backfill pool. Errors (and the exit on the high error rate) are returned
+    as the failed status, so other logs are processed anyway
+    """
+    start_time = time.time()
+    start_cpu = time.process_time()
+    status = {"log": log_features.last_log, "date": log_features.last_log_date}
+    try:
+        aggregate = process_log(config, log_features)
+        if parse_rolling_days(config.get('ROLLING_DAYS', '')):
+            save_aggregate(aggregate, config['REPORT_DIR'], log_features.last_log_date)
+        status.update(status='done', lines=aggregate.total_lines)
+    except (Exception, SystemExit) as e:
+        logging.exception("Report for %s was not generated" % log_features.last_log)
+        status.update(status='failed', error=str(e) or e.__class__.__name__)
+    status.update(seconds=round(time.time() - start_time, 3), cpu_seconds=round(time.process_time() - start_cpu, 3))
+    return status
+
+
+def save_backfill_status(ts_file_dir, backfill_status):
+    """ Write the progress of backfill into the monitoring dir (temp_ file and rename) """
+    path = os.path.join(ts_file_dir, BACKFILL_STATUS)
+    temp_path = os.path.join(ts_file_dir, 'temp_' + BACKFILL_STATUS)
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(backfill_status, file, indent=1)
+        os.rename(temp_path, path)
+    except:
+        logging.error("An error occurred while saving the backfill status")
+        raise
+
+
+def backfill(config):
+    """ Generate reports for all logs which don't have them yet. Logs are processed by the pool of
+    BACKFILL_WORKERS processes (number of CPUs by default), every log is parsed by one process.
+    After every processed log the progress with timing of processed logs is saved to TSFILE/log_analyzer.backfill.
+    Rolling reports are generated when all day aggregates are saved
+
+    Args:
+        config: script config
+
+    Returns:
+        list of statuses of processed logs
+    """
+    logs = [log_features for log_features in find_logs(config['LOG_DIR'])
+            if not os.path.isfile(os.path.join(config['REPORT_DIR'], report_name(log_features.last_log_date)))]
+    if not logs:
+        logging.info("All logs have reports, nothing to backfill")
+        return []
+    workers = min(len(logs), int(config.get('BACKFILL_WORKERS', 0)) or os.cpu_count() or 1)
+    logging.info("Backfill of %s reports with %s processes" % (len(logs), workers))
+
+    # pool processes are daemons and can't start parsers of their own
+    worker_config = dict(config, WORKERS=1)
+    backfill_status = {"started": time.asctime(), "total": len(logs), "done": 0, "failed": 0, "logs": []}
+    start_time = time.time()
+    with mp.Pool(workers, maxtasksperchild=1) as pool:
+        for status in pool.imap_unordered(partial(backfill_worker, worker_config), logs):
+            backfill_status[status['status']] += 1
+            backfill_status["logs"].append(status)
+            backfill_status["seconds"] = round(time.time() - start_time, 3)
+            save_backfill_status(config['TSFILE'], backfill_status)
+            logging.info("Backfill %s/%s: %s %s in %s s" % (len(backfill_status["logs"]), len(logs),
+                                                             status['log'], status['status'], status['seconds']))
+
+    done_dates = sorted(status['date'] for status in backfill_status["logs"] if status['status'] == 'done')
+    if parse_rolling_days(config.get('ROLLING_DAYS', '')):
+        for log_date in done_dates:
+            generate_period_reports(config, log_date)
+    backfill_status["finished"] = time.asctime()
+    save_backfill_status(config['TSFILE'], backfill_status)
+    if done_dates:
+        generate_ts_file(config['TSFILE'])
+    return backfill_status["logs"]
+
+
+def main(config, profiler=None):
+
+    phase = profiler.phase if profiler is not None else no_phase
 
     # Find the last log file. if file wasn't found, handle this situation
-    last_log_features = find_last_log(config['LOG_DIR'])
+    with phase('find_log'):
+        last_log_features = find_last_log(config['LOG_DIR'], config.get('TSFILE'))
 
     if not last_log_features.last_log:
         return logging.info("Any logfile wasn't found in log directory")
 
     # check does html report already exist and handle these situations
-    last_report_name = 'report_' + str(last_log_features.last_log_date) + '.html'
-
-    if os.path.isfile(os.path.join(config['REPORT_DIR'], last_report_name)):
+    if os.path.isfile(os.path.join(config['REPORT_DIR'], report_name(last_log_features.last_log_date))):
         return logging.info("Last log report already exists. Script execution will be stopped")
     else:
         logging.info("The last log has been found. Report creation process will be initiated")
 
-    # Generate report data
-    filtered_report = create_report(os.path.join(config['LOG_DIR'], last_log_features.last_log),
-                                    config['ERR_PARSE_RATE'], config['REPORT_SIZE'])
-    logging.info("Reports' data has been generated")
+    aggregate = process_log(config, last_log_features, profiler)
 
-    # Get html template, copy the report data and generate the html-report
-    generate_html_report(filtered_report, config['REPORT_DIR'], last_report_name)
+    # save the aggregate of the day and merge saved aggregates into rolling reports
+    if parse_rolling_days(config.get('ROLLING_DAYS', '')):
+        with phase('rolling'):
+            generate_rolling_reports(aggregate, config, last_log_features.last_log_date)
 
     # ts-file generation
     generate_ts_file(config['TSFILE'])
 
+    # metrics of the run next to the ts-file
+    if profiler is not None:
+        save_metrics(profiler.metrics(last_log_features.last_log, aggregate), config['TSFILE'])
+
+
+def run_profiled(config, cprofile_path=None):
+    """ main with the Profiler. If cprofile_path is set, the run is profiled by cProfile too,
+    its stats are dumped to this file
+    """
+    profiler = Profiler()
+    if not cprofile_path:
+        return main(config, profiler)
+    import cProfile
+    code_profiler = cProfile.Profile()
+    try:
+        return code_profiler.runcall(main, config, profiler)
+    finally:
+        code_profiler.dump_stats(cprofile_path)
+        logging.info("cProfile stats have been saved to %s" % cprofile_path)
+
 
 if __name__ == "__main__":
 
@@ -279,11 +1642,31 @@ if __name__ == "__main__":
     parser.add_argument('--config',
                         help='Path to configuration file. Please use path+filename notation',
                         default=os.path.abspath('log_analyzer.conf'))
+    parser.add_argument('--median-mode', choices=MEDIAN_MODES,
+                        help='exact median or approximate one from quantile sketches (adds p90/p95/p99 columns)')
+    parser.add_argument('--workers', type=int,
+                        help='number of processes to parse the log')
+    parser.add_argument('--engine', choices=ENGINES,
+                        help='python (streaming aggregate) or numpy (vectorized statistic)')
+    parser.add_argument('--follow', action='store_true',
+                        help='follow the active log and regenerate live report every FOLLOW_INTERVAL seconds')
+    parser.add_argument('--backfill', action='store_true',
+                        help='generate reports for all logs without them by BACKFILL_WORKERS processes')
+    parser.add_argument('--profile', action='store_true',
+                        help='save time of phases, lines/sec, peak RSS and malformed lines to TSFILE/log_analyzer.metrics')
+    parser.add_argument('--cprofile',
+                        help='with --profile: path to save cProfile stats of the run (open by pstats or snakeviz)')
 
     # parse config file
     args = parser.parse_args()
     config_path = args.config
     config = parse_config(def_config, config_path)
+    if args.median_mode:
+        config['MEDIAN_MODE'] = args.median_mode
+    if args.workers:
+        config['WORKERS'] = args.workers
+    if args.engine:
+        config['ENGINE'] = args.engine
 
     # set up logging. If directory for logging is not defined, use stdout
     logging.basicConfig(filename=config['LOGGING'] if len(str(config['LOGGING'])) > 4 else None,
@@ -291,7 +1674,14 @@ if __name__ == "__main__":
                         format='[%(asctime)s] %(levelname).1s %(message)s',
                         datefmt='%Y.%m.%d %H:%M:%S')
     try:
-        main(config)
+        if args.follow:
+            follow_log(config)
+        elif args.backfill:
+            backfill(config)
+        elif args.profile:
+            run_profiled(config, args.cprofile)
+        else:
+            main(config)
     except Exception:
         logging.exception("Unexpected error occurred")
         raise
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+""" Mergeable quantile sketch (KLL) used by log_analyzer for approximate medians and percentiles.
+
+The sketch is a stack of compactors. Level h keeps items with the weight 2**h. When the sketch is full,
+the first over-capacity level is sorted and every second item (random offset) is promoted to the next level.
+Memory is O(k) floats per sketch whatever the number of items, normalized rank error is about 2.3 / k**0.97
+(Karnin, Lang, Liberty. Optimal Quantile Approximation in Streams, 2016).
+"""
+
+import math
+import random
+from array import array
+
+KLL_C = 2.0 / 3.0
+KLL_MIN_K = 8
+
+
+def k_for_error(rank_error):
+    """ Sketch size which gives the requested normalized rank error (empirical formula of DataSketches KLL).
+
+    Args:
+        rank_error: acceptable rank error as a fraction of the number of items, e.g. 0.01
+
+    Returns:
+        k parameter of KLLSketch
+    """
+    rank_error = float(rank_error)
+    if not 0 < rank_error < 1:
+        raise ValueError("Rank error has to be in (0, 1), got %s" % rank_error)
+    return max(KLL_MIN_K, int(math.ceil((2.296 / rank_error) ** (1 / 0.9723))))
+
+
+class KLLSketch(object):
+    """ KLL quantile sketch over floats. Supports append, merge and quantile queries """
+    __slots__ = ('k', 'n', 'size', 'max_size', 'compactors')
+
+    def __init__(self, k=200):
+        self.k = k
+        self.n = 0
+        self.size = 0
+        self.compactors = [array('d')]
+        self.max_size = self._capacity(0)
+
+    def __len__(self):
+        return self.n
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * KLL_C ** depth)) + 1
+
+    def _update_max_size(self):
+        self.max_size = sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def append(self, value):
+        self.compactors[0].append(value)
+        self.n += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def extend(self, values):
+        """ Append values in slices which fill level 0 up to the capacity of the sketch. Compactions happen
+        at the same points as with append of every value, but without the per-item call
+        """
+        values = values if isinstance(values, array) else array('d', values)
+        start = 0
+        while start < len(values):
+            end = start + self.max_size - self.size
+            chunk = values[start:end]
+            self.compactors[0].extend(chunk)
+            self.n += len(chunk)
+            self.size += len(chunk)
+            start = end
+            if self.size >= self.max_size:
+                self._compress()
+
+    def _compress(self):
+        for height in range(len(self.compactors)):
+            if len(self.compactors[height]) >= self._capacity(height):
+                if height + 1 == len(self.compactors):
+                    self.compactors.append(array('d'))
+                    self._update_max_size()
+                items = sorted(self.compactors[height])
+                # odd item stays on the current level, the rest is halved into the next one
+                rest = array('d', items[-1:]) if len(items) % 2 else array('d')
+                if rest:
+                    items = items[:-1]
+                promoted = items[random.getrandbits(1)::2]
+                self.compactors[height + 1].extend(promoted)
+                self.compactors[height] = rest
+                self.size -= len(items) - len(promoted)
+                if self.size < self.max_size:
+                    break
+
+    def to_state(self):
+        """ Sketch as a tuple of builtin types, so it can be saved without the reference to this class """
+        return self.k, self.n, [compactor.tobytes() for compactor in self.compactors]
+
+    @classmethod
+    def from_state(cls, state):
+        k, n, compactors = state
+        sketch = cls(k)
+        sketch.n = n
+        sketch.compactors = [array('d', compactor) for compactor in compactors]
+        sketch.size = sum(len(c) for c in sketch.compactors)
+        sketch._update_max_size()
+        return sketch
+
+    def copy(self):
+        return KLLSketch.from_state(self.to_state())
+
+    def merge(self, other):
+        """ Add all items of the other sketch into this one. Other sketch is not changed """
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(array('d'))
+        self._update_max_size()
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height].extend(compactor)
+        self.n += other.n
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self._compress()
+        return self
+
+    def quantiles(self, fractions):
+        """ Items with the nearest rank ceil(q * n) for every q in fractions
+
+        Args:
+            fractions: iterable with quantiles in [0, 1], e.g. (0.5, 0.9)
+
+        Returns:
+            list of values in the order of fractions
+        """
+        weighted = []
+        for height, compactor in enumerate(self.compactors):
+            weight = 1 << height
+            weighted.extend((value, weight) for value in compactor)
+        if not weighted:
+            raise ValueError("Quantile of empty sketch")
+        weighted.sort()
+        total = sum(weight for _, weight in weighted)
+
+        result = []
+        for fraction in fractions:
+            rank = max(1, int(math.ceil(fraction * total)))
+            cumulative = 0
+            for value, weight in weighted:
+                cumulative += weight
+                if cumulative >= rank:
+                    break
+            result.append(value)
+        return result
+
+    def quantile(self, fraction):
+        return self.quantiles((fraction,))[0]
@@ -0,0 +1,92 @@
+import unittest
+from .context import log_analyzer
+import os
+import logging
+import random
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from statistics import median
+
+from quantile_sketch import KLLSketch, k_for_error
+
+logging.disable(logging.CRITICAL)
+
+
+def rank_distance(sorted_times, value, fraction):
+    # distance (as a fraction of all items) between the rank of value and the requested rank
+    n = len(sorted_times)
+    target = fraction * n
+    low, high = bisect_left(sorted_times, value), bisect_right(sorted_times, value)
+    if low <= target <= high:
+        return 0.0
+    return min(abs(low - target), abs(high - target)) / float(n)
+
+
+class TestApproxMedian(unittest.TestCase):
+
+    """ Procedure:
+        1. Generate synthetic log in './test_folder': skewed url popularity and log-normal request times
+        2. Run create_report in exact and approx median modes
+        ---------
+        Verification:
+        3. Counts and sums are the same in both modes
+        4. Approx median and p90/p95/p99 are within the configured rank error of the exact values
+    """
+
+    error = 0.02
+
+    def setUp(self):
+        random.seed(42)
+        self.log_file_path = os.path.join(os.path.abspath('./test_folder'), 'nginx-access-ui.log-20171205')
+        self.time_log = defaultdict(list)
+        with open(self.log_file_path, 'w') as file:
+            for i in range(60000):
+                url = '/api/v2/item/%d' % min(int(random.paretovariate(1.1)), 30)
+                response_time = '%.3f' % random.lognormvariate(-1, 1)
+                self.time_log[url].append(float(response_time))
+                file.write('1.19.32 -  - [29/Jun +0300] "GET %s HTTP/1.1" 200 927 "-" "Lynx/2" "-" "149" "dc" %s\n'
+                           % (url, response_time))
+
+    def test_approx_vs_exact(self):
+        exact = log_analyzer.create_report(self.log_file_path, 0.2, 0)
+        approx = log_analyzer.create_report(self.log_file_path, 0.2, 0, 'approx', self.error)
+        self.assertEqual([row['url'] for row in exact], [row['url'] for row in approx])
+
+        for exact_row, approx_row in zip(exact, approx):
+            for column in ('count', 'time_sum', 'time_max', 'time_avg', 'time_perc', 'count_perc'):
+                self.assertEqual(exact_row[column], approx_row[column])
+            self.assertNotIn('time_p90', exact_row)
+
+            times = sorted(self.time_log[approx_row['url']])
+            self.assertEqual(round(median(times), 3), exact_row['time_med'])
+            # values in the report are rounded, so compare against rounded times
+            rounded = [round(t, 3) for t in times]
+            self.assertLessEqual(rank_distance(rounded, approx_row['time_med'], 0.5), self.error)
+            for p in log_analyzer.REPORT_PERCENTILES:
+                self.assertLessEqual(rank_distance(rounded, approx_row['time_p%d' % p], p / 100.0), self.error)
+
+    def test_sketch_merge(self):
+        # two sketches merged together have the same error bound as the sketch built over all data
+        data = [random.expovariate(1) for _ in range(50000)]
+        left, right = KLLSketch(k_for_error(self.error)), KLLSketch(k_for_error(self.error))
+        left.extend(data[:20000])
+        right.extend(data[20000:])
+        merged = left.merge(right)
+        self.assertEqual(len(data), len(merged))
+        data.sort()
+        for fraction in (0.1, 0.5, 0.9, 0.99):
+            self.assertLessEqual(rank_distance(data, merged.quantile(fraction), fraction), self.error)
+
+    def test_small_sketch_is_exact(self):
+        sketch = KLLSketch(k_for_error(self.error))
+        sketch.extend([5.0, 1.0, 3.0, 2.0, 4.0])
+        self.assertEqual(3.0, sketch.quantile(0.5))
+        self.assertEqual(5.0, sketch.quantile(0.99))
+
+    def tearDown(self):
+        # Remove test logfile after the test
+        os.remove(self.log_file_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from .context import log_analyzer
+import os
+import json
+import shutil
+import logging
+
+logging.disable(logging.CRITICAL)
+
+LINE = ('1.19.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/%d HTTP/1.1" 200 927 "-" "Lynx/2" "-" '
+        '"149" "dc" 0.%d\n')
+
+
+class TestBackfill(unittest.TestCase):
+
+    """ Procedure:
+        1. Create log directory in './test_folder' with logs of 5 days: one of them has the report already,
+        one has only wrong lines
+        2. Run backfill by 2 processes with rolling reports
+        ---------
+        Verification:
+        3. Reports are generated for all logs without them, the existing report is not touched
+        4. The broken log is reported as failed and doesn't stop others
+        5. Progress file in the monitoring dir has statuses and timing of all processed logs, ts-file is updated
+    """
+
+    def setUp(self):
+        self.dir = os.path.abspath('./test_folder')
+        self.log_dir = os.path.join(self.dir, 'backfill')
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.config = dict(log_analyzer.def_config, LOG_DIR=self.log_dir, REPORT_DIR=self.log_dir,
+                           TSFILE=self.log_dir, REPORT_SIZE=0, BACKFILL_WORKERS=2, ROLLING_DAYS='2')
+        for day in range(1, 6):
+            with open(os.path.join(self.log_dir, 'nginx-access-ui.log-2017070%d' % day), 'w') as file:
+                for i in range(100):
+                    file.write('wrong line\n' if day == 4 else LINE % (i % 7, i))
+        self.existing_report = os.path.join(self.log_dir, 'report_20170702.html')
+        open(self.existing_report, 'w').close()
+
+    def test_backfill(self):
+        statuses = log_analyzer.backfill(self.config)
+        self.assertEqual([20170701, 20170703, 20170704, 20170705], sorted(status['date'] for status in statuses))
+
+        files = set(os.listdir(self.log_dir))
+        for day in (1, 3, 5):
+            self.assertIn('report_2017070%d.html' % day, files)
+            self.assertIn('report_2d_2017070%d.html' % day, files)
+        self.assertNotIn('report_20170704.html', files)
+        self.assertEqual(0, os.path.getsize(self.existing_report))
+        self.assertFalse([name for name in files if name.startswith('temp_')])
+        self.assertIn('log_analyzer.ts', files)
+
+        with open(os.path.join(self.log_dir, log_analyzer.BACKFILL_STATUS)) as file:
+            backfill_status = json.load(file)
+        self.assertEqual((4, 3, 1), (backfill_status['total'], backfill_status['done'], backfill_status['failed']))
+        for status in backfill_status['logs']:
+            self.assertEqual('failed' if status['date'] == 20170704 else 'done', status['status'])
+            self.assertGreaterEqual(status['seconds'], 0)
+
+        # nothing left to backfill except the broken log
+        self.assertEqual(['failed'], [status['status'] for status in log_analyzer.backfill(self.config)])
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
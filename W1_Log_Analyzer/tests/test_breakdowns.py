@@ -0,0 +1,106 @@
+import unittest
+from .context import log_analyzer
+import os
+import shutil
+import logging
+from collections import Counter
+
+logging.disable(logging.CRITICAL)
+
+LINE = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "%s /api/v2/banner/%d HTTP/1.1" %d 927 "-" '
+        '"Lynx/2.8.8dev.9 libwww-FM/2.14" "-" "1498697422-2190034393-4708-%d" "dc7161be3" 0.%03d\n')
+METHODS = ('GET', 'POST')
+STATUSES = (200, 200, 404, 500)
+
+
+class TestBreakdowns(unittest.TestCase):
+
+    """ Procedure:
+        1. Create log with 2000 lines in './test_folder': methods and statuses vary, some lines are broken
+        in the way only the strict parser notices (no protocol, quoted fields are missing, status is not a number)
+        2. Parse lines by parse_ui_short, aggregate the log with breakdowns by status and method, run the script
+        ---------
+        Verification:
+        3. All fields of the line are extracted, wrong lines raise ValueError
+        4. Broken lines are counted as malformed, counts of breakdowns are exact, sequential and parallel results
+        agree (medians within the sketch error), the aggregate survives to_state / from_state
+        5. The script writes report_status_YYYYMMDD.html and report_method_YYYYMMDD.html next to the main report
+    """
+
+    def setUp(self):
+        self.dir = os.path.join(os.path.abspath('./test_folder'), 'breakdowns')
+        os.makedirs(self.dir, exist_ok=True)
+        self.log_file_path = os.path.join(self.dir, 'nginx-access-ui.log-20171215')
+        self.statuses = Counter()
+        self.methods = Counter()
+        self.malformed = 0
+        with open(self.log_file_path, 'w') as file:
+            for i in range(2000):
+                method, status = METHODS[i % 2], STATUSES[i % 4]
+                line = LINE % (method, i % 13, status, i, i % 1000)
+                if i % 97 == 0:
+                    self.malformed += 1
+                    line = (line.replace(' HTTP/1.1"', '"'), line.replace(' "dc7161be3"', ''),
+                            line.replace('" %d ' % status, '" OK '))[i % 3]
+                else:
+                    self.statuses[str(status)] += 1
+                    self.methods[method] += 1
+                file.write(line)
+
+    def test_parse_ui_short(self):
+        record = log_analyzer.parse_ui_short((LINE % ('POST', 7, 499, 5, 123)).encode('utf-8'))
+        self.assertEqual(('1.196.116.32', '-', '-', '29/Jun/2017:03:50:22 +0300'),
+                         (record.remote_addr, record.remote_user, record.real_ip, record.time_local))
+        self.assertEqual(('POST', '/api/v2/banner/7', 'HTTP/1.1', 499, 927),
+                         (record.method, record.url, record.protocol, record.status, record.bytes_sent))
+        self.assertEqual(('-', 'Lynx/2.8.8dev.9 libwww-FM/2.14', '-', '1498697422-2190034393-4708-5', 'dc7161be3'),
+                         (record.referer, record.user_agent, record.forwarded_for, record.request_id, record.rb_user))
+        self.assertEqual(0.123, record.request_time)
+
+        for line in ('wrong line', LINE % ('GET', 1, 200, 1, 1) + ' "extra"', '1.1.1.1 "GET / HTTP/1.1" 200',
+                     (LINE % ('GET', 1, 200, 1, 1)).replace('200 927', '200 -')):
+            with self.assertRaises(ValueError):
+                log_analyzer.parse_ui_short(line.encode('utf-8'))
+
+    def test_aggregate(self):
+        aggregates = [log_analyzer.aggregate_log(self.log_file_path, 0.1, workers=workers,
+                                                 breakdowns=('status', 'method'))
+                      for workers in (1, 3)]
+        for aggregate in aggregates:
+            self.assertEqual(2000 - self.malformed, aggregate.total_count)
+            self.assertEqual(2000, aggregate.total_lines)
+            self.assertEqual(dict(self.statuses),
+                             {value: stat.count for value, stat in aggregate.breakdowns['status'].items()})
+            self.assertEqual(dict(self.methods),
+                             {value: stat.count for value, stat in aggregate.breakdowns['method'].items()})
+        # medians of breakdowns are approximate (sketches), the rest is exact
+        sequential, parallel = (log_analyzer.build_report(aggregate.breakdown_aggregate('status'), 0)
+                                for aggregate in aggregates)
+        for seq_row, par_row in zip(sequential, parallel):
+            self.assertEqual((seq_row['url'], seq_row['count'], seq_row['time_sum'], seq_row['time_max']),
+                             (par_row['url'], par_row['count'], par_row['time_sum'], par_row['time_max']))
+            self.assertAlmostEqual(seq_row['time_med'], par_row['time_med'], delta=0.05)
+
+        restored = log_analyzer.LogAggregate.from_state(aggregates[0].to_state())
+        self.assertEqual(log_analyzer.build_report(aggregates[0].breakdown_aggregate('method'), 0),
+                         log_analyzer.build_report(restored.breakdown_aggregate('method'), 0))
+        with self.assertRaises(ValueError):
+            log_analyzer.parse_breakdowns('status, referer')
+
+    def test_main(self):
+        config = dict(log_analyzer.def_config, LOG_DIR=self.dir, REPORT_DIR=self.dir, TSFILE=self.dir,
+                      REPORT_SIZE=0, BREAKDOWNS='status,method')
+        log_analyzer.main(config)
+        for name in ('report_20171215.html', 'report_status_20171215.html', 'report_method_20171215.html'):
+            self.assertTrue(os.path.isfile(os.path.join(self.dir, name)))
+        with open(os.path.join(self.dir, 'report_status_20171215.html'), encoding='utf-8') as file:
+            report = file.read()
+        for status in self.statuses:
+            self.assertIn('"url": "%s"' % status, report)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+from .context import log_analyzer
+import os
+import json
+import random
+import shutil
+import logging
+
+logging.disable(logging.CRITICAL)
+
+columnar = log_analyzer.columnar
+
+
+@unittest.skipIf(columnar.np is None, "numpy is not installed")
+class TestColumnar(unittest.TestCase):
+
+    """ Procedure:
+        1. Generate log in './test_folder' with random urls, statuses, request times and a few wrong lines
+        2. Aggregate it through the columnar cache in './test_folder', then once more from the saved cache
+        ---------
+        Verification:
+        3. Columns contain url ids, request times, statuses and timestamps of the parsed lines
+        4. Reports from columns (parsed and loaded) are the same as the report of the log parser
+        5. Url normalization and percentile columns work over the cache
+    """
+
+    def setUp(self):
+        random.seed(5)
+        self.dir = os.path.abspath('./test_folder')
+        self.log_file_path = os.path.join(self.dir, 'nginx-access-ui.log-20171210')
+        self.columns_dir = os.path.join(self.dir, 'columns')
+        self.rows = []
+        with open(self.log_file_path, 'w') as file:
+            for i in range(5000):
+                if i % 100 == 0:
+                    file.write('wrong line\n')
+                    continue
+                url = '/api/v2/banner/%d' % int(random.paretovariate(1))
+                status = random.choice([200, 200, 404, 500])
+                request_time = round(random.uniform(0, 2), 3)
+                self.rows.append((url, status, request_time))
+                file.write('1.19.32 -  - [29/Jun/2017:03:50:%02d +0300] "GET %s HTTP/1.1" %d 927 "-" "Lynx/2" "-" '
+                           '"149" "dc" %s\n' % (i % 60, url, status, request_time))
+
+    def test_parse_columns(self):
+        columns = columnar.parse_columns(log_analyzer.read_log_lines(self.log_file_path))
+        self.assertEqual(5000, columns.total_lines)
+        self.assertEqual(len(self.rows), len(columns))
+        self.assertEqual([url for url, _, _ in self.rows], [columns.urls[i] for i in columns.url_id.tolist()])
+        self.assertEqual([status for _, status, _ in self.rows], columns.status.tolist())
+        self.assertEqual([t for _, _, t in self.rows], columns.request_time.tolist())
+        self.assertEqual(1498697401, columns.timestamp[0])
+
+    def test_report_from_columns(self):
+        expected = log_analyzer.create_report(self.log_file_path, 0.2, 0)
+        for _ in range(2):
+            aggregate = log_analyzer.aggregate_columns(self.log_file_path, 0.2, self.columns_dir)
+            self.assertEqual(expected, log_analyzer.build_report(aggregate, 0))
+            self.assertEqual(expected[:5], log_analyzer.build_report(aggregate, 0, 5))
+        columns_path = os.path.join(self.columns_dir, os.path.basename(self.log_file_path) + '.columns')
+        with open(os.path.join(columns_path, 'meta.json')) as file:
+            self.assertEqual(len(self.rows), json.load(file)['rows'])
+
+        # the saved aggregate is the same as the aggregate of the parser
+        state = log_analyzer.LogAggregate.from_state(aggregate.to_state())
+        self.assertEqual(expected, log_analyzer.build_report(state, 0))
+
+    def test_normalizer_and_percentiles(self):
+        normalizer = log_analyzer.UrlNormalizer([('/banner/\\d+', '/banner/{id}')])
+        aggregate = log_analyzer.aggregate_columns(self.log_file_path, 0.2, self.columns_dir, 'approx',
+                                                   normalizer=normalizer)
+        report = log_analyzer.build_report(aggregate, 0)
+        self.assertEqual(['/api/v2/banner/{id}'], [row['url'] for row in report])
+        self.assertEqual(len(self.rows), report[0]['count'])
+        times = sorted(t for _, _, t in self.rows)
+        self.assertEqual(times[int(len(times) * 0.9) - 1], report[0]['time_p90'])
+
+    def tearDown(self):
+        os.remove(self.log_file_path)
+        shutil.rmtree(self.columns_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
 import unittest
 from .context import log_analyzer
+import os
 import logging
+import random
 from collections import defaultdict
+from statistics import median
 
 
 logging.disable(logging.CRITICAL)
@@ -9,7 +12,7 @@ logging.disable(logging.CRITICAL)
 class TestCreateReport(unittest.TestCase):
 
     """ Procedure:
-        1. Create test dict with url and time
+        1. Create test dict with url and time and write it as a log file into './test_folder'
         2. initiate control tuple - this tuple should be as a result of create_report func
         3. Run create_report function and get tuple created by this function
         3.
@@ -50,11 +53,44 @@ class TestCreateReport(unittest.TestCase):
                   }
         self.control_tuple.append(sample)
 
+        self.log_file_path = os.path.join(os.path.abspath('./test_folder'), 'nginx-access-ui.log-20171204')
+        self.write_log(self.test_time_log)
+
+    def write_log(self, time_log):
+        with open(self.log_file_path, 'w') as file:
+            for url, times in time_log.items():
+                for response_time in times:
+                    file.write('1.19.32 -  - [29/Jun +0300] "GET %s HTTP/1.1" 200 927 "-" "Lynx/2" "-" "149" "dc" %s\n'
+                               % (url, response_time))
 
     def test_create_report(self):
-        self.tuple_from_func = log_analyzer.create_report(self.test_time_log, self.test_report_size)
+        self.tuple_from_func = log_analyzer.create_report(self.log_file_path, 0.2, self.test_report_size)
         self.assertEqual(self.control_tuple, self.tuple_from_func)
 
+    def test_same_as_list_statistic(self):
+        # streaming aggregate has to give the same numbers as the statistic calculated over the full lists of times
+        random.seed(0)
+        time_log = defaultdict(list)
+        for i in range(5000):
+            time_log['/url/%d' % random.randint(0, 50)].append('%.3f' % random.uniform(0, 5))
+        self.write_log(time_log)
+
+        total_sum = sum(float(t) for times in time_log.values() for t in times)
+        report = log_analyzer.create_report(self.log_file_path, 0.2, 0)
+        self.assertEqual(len(time_log), len(report))
+        for row in report:
+            times = [float(t) for t in time_log[row['url']]]
+            self.assertEqual(len(times), row['count'])
+            self.assertEqual(round(sum(times), 3), row['time_sum'])
+            self.assertEqual(round(max(times), 3), row['time_max'])
+            self.assertEqual(round(median(times), 3), row['time_med'])
+            self.assertAlmostEqual(sum(times) / total_sum * 100, row['time_perc'], places=3)
+
+    def tearDown(self):
+        # Remove test logfile after the test
+        if os.path.isfile(self.log_file_path):
+            os.remove(self.log_file_path)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from .context import log_analyzer
+import os
+import json
+import time
+import shutil
+import logging
+
+logging.disable(logging.CRITICAL)
+
+
+class TestFindLastLog(unittest.TestCase):
+
+    """ Procedure:
+        1. Create log directory in './test_folder' with rotated logs and files which don't match the mask
+        2. Run find_last_log with the cache in './test_folder'
+        ---------
+        Verification:
+        3. The log with the latest date is found
+        4. The cache is used while the directory is not changed and is ignored after a new log was added
+    """
+
+    def setUp(self):
+        self.dir = os.path.abspath('./test_folder')
+        self.log_dir = os.path.join(self.dir, 'find_last_log')
+        os.makedirs(self.log_dir, exist_ok=True)
+        for name in ['nginx-access-ui.log-20170630.gz', 'nginx-access-ui.log-20170701', 'nginx-access-ui.log',
+                     'nginx-access-ui.log-2017070', 'nginx-access-api.log-20171231', 'report_20180101.html']:
+            open(os.path.join(self.log_dir, name), 'w').close()
+        self.cache_path = os.path.join(self.dir, log_analyzer.LAST_LOG_CACHE)
+        self.make_dir_old()
+
+    def make_dir_old(self):
+        # the cache is not saved for the directory which was changed just now
+        past = time.time() - 60
+        os.utime(self.log_dir, (past, past))
+
+    def test_find_last_log(self):
+        self.assertEqual(('nginx-access-ui.log-20170701', 20170701), log_analyzer.find_last_log(self.log_dir))
+        self.assertFalse(os.path.isfile(self.cache_path))
+
+    def test_cache(self):
+        self.assertEqual(('nginx-access-ui.log-20170701', 20170701),
+                         log_analyzer.find_last_log(self.log_dir, self.dir))
+        self.assertTrue(os.path.isfile(self.cache_path))
+
+        # the directory is not scanned while its mtime is the same: the cached value is returned
+        with open(self.cache_path) as file:
+            cache = json.load(file)
+        cache['last_log'] = 'cached'
+        with open(self.cache_path, 'w') as file:
+            json.dump(cache, file)
+        self.assertEqual(('cached', 20170701), log_analyzer.find_last_log(self.log_dir, self.dir))
+
+        # new log changes mtime of the directory
+        open(os.path.join(self.log_dir, 'nginx-access-ui.log-20170702'), 'w').close()
+        self.make_dir_old()
+        self.assertEqual(('nginx-access-ui.log-20170702', 20170702),
+                         log_analyzer.find_last_log(self.log_dir, self.dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+        if os.path.isfile(self.cache_path):
+            os.remove(self.cache_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+from .context import log_analyzer
+import os
+import json
+import time
+import logging
+import threading
+
+logging.disable(logging.CRITICAL)
+
+LINE = '1.19.32 -  - [29/Jun +0300] "GET %s HTTP/1.1" 200 927 "-" "Lynx/2" "-" "149" "dc" %s\n'
+
+
+class TestFollowLog(unittest.TestCase):
+
+    """ Procedure:
+        1. Create active log 'nginx-access-ui.log' in './test_folder' and follow it
+        2. Append lines, rotate the log (rename + new file) and truncate it
+        ---------
+        Verification:
+        3. Follower returns only new complete lines, lines of the rotated file are not lost
+        4. follow_log writes json snapshots of the lines appended during the window
+    """
+
+    def setUp(self):
+        self.dir = os.path.abspath('./test_folder')
+        self.log_file_path = os.path.join(self.dir, 'nginx-access-ui.log')
+        self.rotated_path = os.path.join(self.dir, 'nginx-access-ui.log-20171207')
+        with open(self.log_file_path, 'w') as file:
+            file.write(LINE % ('/old', '1.0'))
+
+    def append(self, text, path=None):
+        with open(path or self.log_file_path, 'a') as file:
+            file.write(text)
+
+    def test_follower(self):
+        follower = log_analyzer.LogFollower(self.log_file_path)
+        # lines written before start are skipped
+        self.assertEqual([], follower.read_lines())
+
+        self.append(LINE % ('/a', '0.1') + (LINE % ('/b', '0.2'))[:20])
+        self.assertEqual([b'/a'], [line.split()[6] for line in follower.read_lines()])
+        self.append((LINE % ('/b', '0.2'))[20:])
+        self.assertEqual([b'/b'], [line.split()[6] for line in follower.read_lines()])
+
+        # rotation: the rest of the old file is read and the new one from its beginning
+        self.append(LINE % ('/c', '0.3'))
+        os.rename(self.log_file_path, self.rotated_path)
+        self.append(LINE % ('/d', '0.4'))
+        self.assertEqual([b'/c', b'/d'], [line.split()[6] for line in follower.read_lines()])
+
+        # copytruncate
+        open(self.log_file_path, 'w').close()
+        self.assertEqual([], follower.read_lines())
+        self.append(LINE % ('/e', '0.5'))
+        self.assertEqual([b'/e'], [line.split()[6] for line in follower.read_lines()])
+        follower.close()
+
+    def test_follow_log_snapshots(self):
+        config = {
+            "REPORT_SIZE": 0,
+            "REPORT_DIR": self.dir,
+            "LOG_DIR": self.dir,
+            "TSFILE": self.dir,
+            "FOLLOW_INTERVAL": 0.3,
+            "FOLLOW_WINDOW": 10,
+            "FOLLOW_FORMAT": 'json'
+            }
+        follower = threading.Thread(target=log_analyzer.follow_log, args=(config, 2))
+        follower.start()
+        time.sleep(0.1)
+        self.append(LINE % ('/live', '0.5') * 3)
+        follower.join()
+
+        with open(os.path.join(self.dir, 'report_live.json')) as file:
+            report = json.load(file)
+        self.assertEqual([('/live', 3, 1.5)], [(row['url'], row['count'], row['time_sum']) for row in report])
+
+    def tearDown(self):
+        for path in (self.log_file_path, self.rotated_path, os.path.join(self.dir, 'report_live.json'),
+                     os.path.join(self.dir, 'log_analyzer.ts')):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
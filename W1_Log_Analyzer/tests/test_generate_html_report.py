@@ -0,0 +1,59 @@
+import unittest
+from .context import log_analyzer
+import os
+import json
+import random
+import logging
+
+logging.disable(logging.CRITICAL)
+
+
+class TestGenerateHtmlReport(unittest.TestCase):
+
+    """ Procedure:
+        1. Create aggregate with random urls (some of them with quotes and non-ascii chars)
+        2. Build full report and top-N report, generate html and json reports in './test_folder'
+        ---------
+        Verification:
+        3. Report data in html is valid json and equals the report rows
+        4. Top-N report is the beginning of the full report
+    """
+
+    def setUp(self):
+        random.seed(11)
+        self.dir = os.path.abspath('./test_folder')
+        self.aggregate = log_analyzer.LogAggregate()
+        for i in range(3000):
+            url = random.choice(['/api/%d' % random.randint(0, 300), '/search?q="x"', '/пример'])
+            self.aggregate.add(url, round(random.uniform(0, 3), 3))
+        self.report = log_analyzer.build_report(self.aggregate, 0)
+        self.names = ['report_20171208.html', 'report_live.json']
+
+    def test_html_contains_json(self):
+        log_analyzer.generate_html_report(self.report, self.dir, self.names[0])
+        with open(os.path.join(self.dir, self.names[0]), encoding='utf-8') as file:
+            html_data = file.read()
+        self.assertNotIn('$table_json', html_data)
+        table_json = html_data.split('var table = ', 1)[1].split(';\n', 1)[0]
+        self.assertEqual(self.report, json.loads(table_json))
+
+    def test_json_report(self):
+        log_analyzer.generate_json_report(self.report, self.dir, self.names[1])
+        with open(os.path.join(self.dir, self.names[1]), encoding='utf-8') as file:
+            self.assertEqual(self.report, json.load(file))
+
+    def test_top_report(self):
+        for top in (1, 10, 100, 10000):
+            self.assertEqual(self.report[:top], log_analyzer.build_report(self.aggregate, 0, top))
+        self.assertEqual([row for row in self.report if row['time_sum'] >= 50],
+                         log_analyzer.build_report(self.aggregate, 50, 10000))
+
+    def tearDown(self):
+        for name in self.names:
+            path = os.path.join(self.dir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
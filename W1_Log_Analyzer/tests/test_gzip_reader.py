@@ -0,0 +1,65 @@
+import unittest
+from .context import log_analyzer
+import os
+import gzip
+import random
+import logging
+
+logging.disable(logging.CRITICAL)
+
+gzip_reader = log_analyzer.gzip_reader
+
+
+class TestGzipReader(unittest.TestCase):
+
+    """ Procedure:
+        1. Create gz file in './test_folder' with lines of random length, an empty line and no newline at the end
+        2. Read it by gzip_reader in every mode with small blocks
+        ---------
+        Verification:
+        3. Blocks end at line boundaries, lines are the same as lines of gzip.open
+        4. Reading can be stopped in the middle, broken gz file raises an error
+    """
+
+    def setUp(self):
+        random.seed(12)
+        self.dir = os.path.abspath('./test_folder')
+        self.path = os.path.join(self.dir, 'nginx-access-ui.log-20171213.gz')
+        self.broken_path = os.path.join(self.dir, 'broken.gz')
+        self.lines = ['%d %s' % (i, 'x' * random.randint(0, 300)) for i in range(20000)]
+        self.lines[100] = ''
+        self.lines[200] = 'пример'
+        with gzip.open(self.path, 'wt', encoding='utf-8') as file:
+            file.write('\n'.join(self.lines))
+        with open(self.path, 'rb') as file, open(self.broken_path, 'wb') as broken:
+            broken.write(file.read()[:5000])
+
+    def modes(self):
+        return [mode for mode in gzip_reader.MODES
+                if mode != 'subprocess' or gzip_reader.decompress_command(self.path)]
+
+    def test_lines(self):
+        for mode in self.modes():
+            blocks = list(gzip_reader.gzip_blocks(self.path, 4096, mode))
+            self.assertTrue(all(block.endswith(b'\n') for block in blocks[:-1]))
+            self.assertEqual(self.lines, list(gzip_reader.gzip_lines(self.path, 4096, mode, 'utf-8')))
+            self.assertEqual([line.encode('utf-8') for line in self.lines],
+                             list(gzip_reader.gzip_lines(self.path, 4096, mode)))
+
+    def test_stop_and_errors(self):
+        for mode in self.modes():
+            lines = gzip_reader.gzip_lines(self.path, 4096, mode)
+            self.assertEqual(b'0 ', next(lines)[:2])
+            lines.close()
+            with self.assertRaises((OSError, EOFError)):
+                list(gzip_reader.gzip_lines(self.broken_path, 4096, mode))
+        with self.assertRaises(ValueError):
+            gzip_reader.gzip_blocks(self.path, mode='zip')
+
+    def tearDown(self):
+        os.remove(self.path)
+        os.remove(self.broken_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+from .context import log_analyzer
+import os
+import random
+import logging
+
+logging.disable(logging.CRITICAL)
+
+columnar = log_analyzer.columnar
+
+
+@unittest.skipIf(columnar.np is None, "numpy is not installed")
+class TestNumpyEngine(unittest.TestCase):
+
+    """ Procedure:
+        1. Generate logs in './test_folder' with skewed urls: request times with millisecond resolution
+        and with arbitrary precision
+        2. Create reports with python and numpy engines
+        ---------
+        Verification:
+        3. Reports are identical, including top-N, url normalization and percentile columns
+        4. Sort by (url, request time) is the same as np.lexsort for both ways of packing the sort key
+    """
+
+    def setUp(self):
+        random.seed(8)
+        self.dir = os.path.abspath('./test_folder')
+        self.log_file_paths = []
+        for name, time_format in (('nginx-access-ui.log-20171211', '%.3f'), ('nginx-access-ui.log-20171212', '%r')):
+            path = os.path.join(self.dir, name)
+            with open(path, 'w') as file:
+                for i in range(8000):
+                    if i % 500 == 0:
+                        file.write('wrong line\n')
+                        continue
+                    url = '/api/v2/banner/%d' % int(random.paretovariate(0.8))
+                    file.write('1.19.32 -  - [29/Jun/2017:03:50:22 +0300] "GET %s HTTP/1.1" 200 927 "-" "Lynx/2" "-" '
+                               '"149" "dc" %s\n' % (url, time_format % random.expovariate(3)))
+            self.log_file_paths.append(path)
+
+    def test_same_report(self):
+        normalizer = log_analyzer.UrlNormalizer([('/banner/[1-5]\\d+$', '/banner/{id}')])
+        for path in self.log_file_paths:
+            for kwargs in ({}, {"report_top": 10}, {"normalizer": normalizer}):
+                self.assertEqual(log_analyzer.create_report(path, 0.2, 0, **kwargs),
+                                 log_analyzer.create_report(path, 0.2, 0, engine='numpy', **kwargs))
+            report = log_analyzer.create_report(path, 0.2, 0, 'approx', engine='numpy')
+            self.assertIn('time_p99', report[0])
+
+    def test_sort_by_url(self):
+        np = columnar.np
+        for path in self.log_file_paths:
+            url_id, request_time, urls, _ = columnar.parse_url_times(log_analyzer.read_log_lines(path))
+            self.assertEqual(request_time[np.lexsort((request_time, url_id))].tolist(),
+                             columnar.sort_by_url(url_id, request_time, len(urls)).tolist())
+
+    def tearDown(self):
+        for path in self.log_file_paths:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+from .context import log_analyzer
+import os
+import gzip
+import logging
+import random
+
+logging.disable(logging.CRITICAL)
+
+
+class TestParallelParse(unittest.TestCase):
+
+    """ Procedure:
+        1. Generate log with some malformed lines in './test_folder' as plain and gz files
+        2. Run create_report with one process and with several processes
+        ---------
+        Verification:
+        3. Reports are the same, counters of lines are the same
+        4. Error rate threshold is checked over all chunks: the script is stopped if malformed lines exceed it
+    """
+
+    def setUp(self):
+        random.seed(7)
+        self.dir = os.path.abspath('./test_folder')
+        self.log_file_path = os.path.join(self.dir, 'nginx-access-ui.log-20171206')
+        self.gz_file_path = self.log_file_path + '.gz'
+        self.write_log(malformed_rate=0.05)
+
+    def write_log(self, malformed_rate):
+        lines = []
+        for i in range(20000):
+            if random.random() < malformed_rate:
+                lines.append('malformed line %d' % i)
+                continue
+            lines.append('1.19.32 -  - [29/Jun +0300] "GET /api/v2/banner/%d HTTP/1.1" 200 927 "-" "Lynx/2" "-" '
+                         '"149" "dc" %.3f' % (random.randint(0, 300), random.uniform(0, 2)))
+        data = '\n'.join(lines) + '\n'
+        with open(self.log_file_path, 'w') as file:
+            file.write(data)
+        with gzip.open(self.gz_file_path, 'wt') as file:
+            file.write(data)
+
+    def assertSameReport(self, first, second):
+        self.assertEqual(len(first), len(second))
+        # sums of chunks are added in other order, so floats can differ in the last bits only
+        key = lambda row: row['url']
+        for row, other in zip(sorted(first, key=key), sorted(second, key=key)):
+            self.assertEqual(set(row), set(other))
+            for column in row:
+                if isinstance(row[column], float):
+                    self.assertAlmostEqual(row[column], other[column], places=2)
+                else:
+                    self.assertEqual(row[column], other[column])
+
+    def test_plain_file(self):
+        serial = log_analyzer.create_report(self.log_file_path, 0.2, 0)
+        for workers in (2, 3, 8):
+            self.assertSameReport(serial, log_analyzer.create_report(self.log_file_path, 0.2, 0, workers=workers))
+
+    def test_gz_file(self):
+        serial = log_analyzer.create_report(self.gz_file_path, 0.2, 0)
+        self.assertSameReport(serial, log_analyzer.create_report(self.gz_file_path, 0.2, 0, workers=3))
+
+    def test_ranges_cover_file(self):
+        ranges = log_analyzer.split_file(self.log_file_path, 7)
+        lines = [line for start, end in ranges for line in log_analyzer.read_range(self.log_file_path, start, end)]
+        with open(self.log_file_path, 'rb') as file:
+            self.assertEqual(file.readlines(), lines)
+
+    def test_line_counters(self):
+        aggregate = log_analyzer.aggregate_log_parallel(self.log_file_path, 0.2, 4)
+        with open(self.log_file_path) as file:
+            lines = file.read().splitlines()
+        self.assertEqual(len(lines), aggregate.total_lines)
+        self.assertEqual(len([line for line in lines if not line.startswith('malformed')]), aggregate.total_count)
+
+    def test_error_rate_over_chunks(self):
+        self.write_log(malformed_rate=0.3)
+        with self.assertRaises(SystemExit):
+            log_analyzer.aggregate_log_parallel(self.log_file_path, 0.2, 4)
+        with self.assertRaises(SystemExit):
+            log_analyzer.aggregate_log_parallel(self.gz_file_path, 0.2, 4)
+
+    def tearDown(self):
+        os.remove(self.log_file_path)
+        os.remove(self.gz_file_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,13 +30,29 @@ class TestParseLog(unittest.TestCase):
             for line in self.test_lines:
                 file.write(line+'\n')
         self.control_dict = defaultdict(list)
-        self.control_dict['/api/v2/'].append('0.390')
-        self.control_dict['/api/1/'].append('0.133')
+        self.control_dict['/api/v2/'].append(0.390)
+        self.control_dict['/api/1/'].append(0.133)
 
     def test_parse_log(self):
-        self.dict_from_func = log_analyzer.parse_log(self.log_file_path)
+        self.dict_from_func = defaultdict(list)
+        for url, response_time in log_analyzer.parse_log(self.log_file_path, 0.2):
+            self.dict_from_func[url].append(response_time)
         self.assertDictEqual(self.control_dict, self.dict_from_func)
 
+    def test_same_as_split(self):
+        # bytes parser has to take the same columns as str.split() of the whole line
+        lines = self.test_lines + ['1.2.3.4 - - [29/Jun +0300] "GET  /api/x?a=b%20c  HTTP/1.1" 200 1 "-" "x" 1.5',
+                                   '1.2.3.4 - - [29/Jun +0300] "0" 400 1 "-" "-" "-" "-" "-" 0.001']
+        for line in lines:
+            splitted = line.split()
+            self.assertEqual((splitted[6].strip('"'), float(splitted[-1])),
+                             log_analyzer.parse_line(line.encode('utf-8'), {}))
+
+    def test_malformed_lines(self):
+        for line in [b'', b'1.2.3.4 - - [29/Jun +0300] "GET', b'1 2 3 4 5 6 7 8 9 time', b'1 2 3 4 5 6 \xff 8 0.1']:
+            with self.assertRaises(Exception):
+                log_analyzer.parse_line(line, {})
+
     def tearDown(self):
             # Remove test logfile after the test
             os.remove(self.log_file_path)
@@ -0,0 +1,60 @@
+import unittest
+from .context import log_analyzer
+import os
+import json
+import pstats
+import shutil
+import logging
+
+logging.disable(logging.CRITICAL)
+
+LINE = ('1.19.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/%d HTTP/1.1" 200 927 "-" "Lynx/2" "-" '
+        '"149" "dc" 0.%d\n')
+
+
+class TestProfile(unittest.TestCase):
+
+    """ Procedure:
+        1. Create log with 1000 lines (10 of them are wrong) in './test_folder'
+        2. Run the script in profile mode with cProfile
+        ---------
+        Verification:
+        3. Metrics file next to log_analyzer.ts has time of all phases, lines, malformed lines, lines/sec and peak RSS
+        4. cProfile stats are saved and can be loaded by pstats
+    """
+
+    def setUp(self):
+        self.dir = os.path.join(os.path.abspath('./test_folder'), 'profile')
+        os.makedirs(self.dir, exist_ok=True)
+        self.config = dict(log_analyzer.def_config, LOG_DIR=self.dir, REPORT_DIR=self.dir, TSFILE=self.dir,
+                           REPORT_SIZE=0)
+        with open(os.path.join(self.dir, 'nginx-access-ui.log-20171214'), 'w') as file:
+            for i in range(1000):
+                file.write('wrong line\n' if i % 100 == 0 else LINE % (i % 7, i))
+        self.cprofile_path = os.path.join(self.dir, 'log_analyzer.prof')
+
+    def test_metrics(self):
+        log_analyzer.run_profiled(self.config, self.cprofile_path)
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, 'report_20171214.html')))
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, 'log_analyzer.ts')))
+
+        with open(os.path.join(self.dir, log_analyzer.PROFILE_METRICS)) as file:
+            metrics = json.load(file)
+        self.assertEqual('nginx-access-ui.log-20171214', metrics['log'])
+        self.assertEqual((1000, 10), (metrics['lines'], metrics['malformed_lines']))
+        self.assertEqual({'find_log', 'aggregate', 'read', 'parse', 'report', 'html'}, set(metrics['phases']))
+        for phase in metrics['phases'].values():
+            self.assertGreaterEqual(phase['wall_seconds'], 0)
+            self.assertGreaterEqual(phase['cpu_seconds'], 0)
+        self.assertGreater(metrics['lines_per_sec'], 0)
+        self.assertGreater(metrics['peak_rss_kb'], 0)
+
+        stats = pstats.Stats(self.cprofile_path)
+        self.assertTrue(any(name == 'add_lines' for _, _, name in stats.stats))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
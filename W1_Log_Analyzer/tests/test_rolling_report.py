@@ -0,0 +1,111 @@
+import unittest
+from .context import log_analyzer
+import os
+import logging
+import random
+import shutil
+
+logging.disable(logging.CRITICAL)
+
+
+class TestRollingReport(unittest.TestCase):
+
+    """ Procedure:
+        1. Create logs for three days in './test_folder' and run main() after every new log
+        (the same way as a daily cron job). ROLLING_DAYS is set, so aggregates of days are saved
+        2. Merge saved aggregates for 2 and 3 days
+        ---------
+        Verification:
+        3. Aggregate survives save/load, exact request times are saved as sketches: the file of 200000 requests
+        is much smaller than their float64 array, the median is within MEDIAN_ERROR by rank
+        4. Merged aggregates give the same report as the approx median mode over all lines of these days
+        5. Rolling reports are generated by the python and numpy engines and from columnar caches
+    """
+
+    dates = ['20171201', '20171202', '20171203']
+
+    def setUp(self):
+        random.seed(5)
+        self.dir = os.path.abspath('./test_folder')
+        self.test_config = {
+            "REPORT_SIZE": 0,
+            "REPORT_DIR": self.dir,
+            "LOG_DIR": self.dir,
+            "TSFILE": self.dir,
+            "ERR_PARSE_RATE": 0.2,
+            "ROLLING_DAYS": '2,3'
+            }
+        self.lines = {}
+        for date in self.dates:
+            self.lines[date] = ['1.19.32 -  - [29/Jun +0300] "GET /api/%d HTTP/1.1" 200 927 "-" "Lynx" "-" "1" "dc" %.3f'
+                                % (random.randint(0, 20), random.uniform(0, 2)) for _ in range(500)]
+
+    def write_log(self, name, lines):
+        with open(os.path.join(self.dir, name), 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+
+    def test_save_load_aggregate(self):
+        self.write_log('nginx-access-ui.log-20171201', self.lines['20171201'])
+        path = os.path.join(self.dir, 'nginx-access-ui.log-20171201')
+        # urls have fewer requests than the sketch size, so saved sketches give the medians of the approx mode
+        control_report = log_analyzer.build_report(log_analyzer.aggregate_log(path, 0.2, 'approx'), 0)
+        for median_mode in log_analyzer.MEDIAN_MODES:
+            aggregate = log_analyzer.aggregate_log(path, 0.2, median_mode)
+            log_analyzer.save_aggregate(aggregate, self.dir, '20171201')
+            loaded = log_analyzer.load_aggregate(self.dir, '20171201')
+            self.assertEqual(control_report, log_analyzer.build_report(loaded, 0))
+        self.assertIsNone(log_analyzer.load_aggregate(self.dir, '20171130'))
+
+    def test_aggregate_size(self):
+        aggregate = log_analyzer.LogAggregate('exact', 0.01)
+        times = [random.random() for _ in range(200000)]
+        for request_time in times:
+            aggregate.add('/api/1', request_time)
+        path = log_analyzer.save_aggregate(aggregate, self.dir, '20171201')
+        self.assertLess(os.path.getsize(path), 8 * len(times) // 20)
+        loaded = log_analyzer.load_aggregate(self.dir, '20171201')
+        self.assertIsInstance(loaded.urls['/api/1'].times, log_analyzer.KLLSketch)
+        rank = sum(1 for request_time in times if request_time < loaded.urls['/api/1'].median()) / len(times)
+        self.assertLess(abs(rank - 0.5), 0.01)
+        self.assertEqual((len(times), max(times)), (loaded.urls['/api/1'].count, loaded.urls['/api/1'].time_max))
+
+    def check_rolling_reports(self):
+        for date in self.dates:
+            self.write_log('nginx-access-ui.log-' + date, self.lines[date])
+            log_analyzer.main(self.test_config)
+            self.assertTrue(os.path.isfile(os.path.join(self.dir, 'report_%s.agg' % date)))
+        self.assertTrue(os.path.isfile(os.path.join(self.dir, 'log_analyzer.ts')))
+
+        for days in (2, 3):
+            self.write_log('all_days.log', sum([self.lines[date] for date in self.dates[-days:]], []))
+            control_report = log_analyzer.build_report(
+                log_analyzer.aggregate_log(os.path.join(self.dir, 'all_days.log'), 0.2, 'approx'), 0)
+            aggregate, found = log_analyzer.rolling_aggregate(self.dir, '20171203', days)
+            self.assertEqual(days, found)
+            report = log_analyzer.build_report(aggregate, 0)
+            self.assertEqual([(row['url'], row['count'], row['time_max'], row['time_med']) for row in control_report],
+                             [(row['url'], row['count'], row['time_max'], row['time_med']) for row in report])
+            self.assertTrue(os.path.isfile(os.path.join(self.dir, 'report_%sd_20171203.html' % days)))
+
+    def test_rolling_reports(self):
+        self.check_rolling_reports()
+
+    @unittest.skipIf(log_analyzer.columnar.np is None, "numpy is not installed")
+    def test_rolling_reports_numpy(self):
+        self.test_config["ENGINE"] = 'numpy'
+        self.check_rolling_reports()
+
+    @unittest.skipIf(log_analyzer.columnar.np is None, "numpy is not installed")
+    def test_rolling_reports_columns(self):
+        self.test_config["COLUMNS_DIR"] = os.path.join(self.dir, 'columns')
+        self.check_rolling_reports()
+
+    def tearDown(self):
+        for file in os.listdir(self.dir):
+            if file.startswith(('nginx-access-ui.log-', 'report_', 'all_days', 'log_analyzer.ts')):
+                os.remove(os.path.join(self.dir, file))
+        shutil.rmtree(os.path.join(self.dir, 'columns'), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+from .context import log_analyzer
+import os
+import random
+import logging
+from collections import Counter
+
+logging.disable(logging.CRITICAL)
+
+
+class TestUrlNormalization(unittest.TestCase):
+
+    """ Procedure:
+        1. Generate log in './test_folder' with a few frequent urls, ids in paths and many rare urls
+        2. Run create_report with url rules, query stripping and the cap of the number of urls
+        ---------
+        Verification:
+        3. Urls are mapped to templates by rules
+        4. The number of urls is capped, frequent urls are kept with exact counts, the rest is in OTHER_URL
+        5. Nothing is lost: counts of all rows give the number of lines
+    """
+
+    def setUp(self):
+        random.seed(3)
+        self.log_file_path = os.path.join(os.path.abspath('./test_folder'), 'nginx-access-ui.log-20171209')
+        self.counts = Counter()
+        with open(self.log_file_path, 'w') as file:
+            for i in range(30000):
+                if random.random() < 0.5:
+                    url = '/api/hot/%d' % random.randint(0, 9)
+                else:
+                    url = '/api/v2/banner/%d?ts=%d' % (random.randint(0, 10 ** 6), i)
+                self.counts[url] += 1
+                file.write('1.19.32 -  - [29/Jun +0300] "GET %s HTTP/1.1" 200 927 "-" "Lynx/2" "-" "149" "dc" 0.1\n'
+                           % url)
+
+    def test_normalizer(self):
+        rules = log_analyzer.parse_url_rules('/banner/\\d+ => /banner/{id}\n'
+                                             '  /(\\d+)$ => /{num}  ')
+        normalizer = log_analyzer.UrlNormalizer(rules, strip_query=True)
+        self.assertEqual('/api/v2/banner/{id}', normalizer('/api/v2/banner/25019354?ts=1'))
+        self.assertEqual('/api/hot/{num}', normalizer('/api/hot/7'))
+        self.assertEqual('/api/v2/slot/4705/groups', normalizer('/api/v2/slot/4705/groups'))
+        with self.assertRaises(ValueError):
+            log_analyzer.parse_url_rules('/banner/\\d+')
+
+        report = log_analyzer.create_report(self.log_file_path, 0.2, 0, normalizer=normalizer)
+        self.assertEqual(['/api/hot/{num}', '/api/v2/banner/{id}'], sorted(row['url'] for row in report))
+        self.assertEqual(sum(c for url, c in self.counts.items() if 'banner' in url),
+                         [row['count'] for row in report if row['url'] == '/api/v2/banner/{id}'][0])
+
+    def test_settings_from_config(self):
+        settings = log_analyzer.aggregate_settings({"URL_RULES": '/banner/\\d+ => /banner/{id}',
+                                                    "STRIP_QUERY": 'yes', "MAX_URLS": '100'})
+        self.assertEqual('/api/v2/banner/{id}', settings['normalizer']('/api/v2/banner/1?a=b'))
+        self.assertEqual(100, settings['max_urls'])
+        self.assertIsNone(log_analyzer.aggregate_settings({})['normalizer'])
+
+    def test_max_urls(self):
+        # every hot url is 5% of lines, space-saving keeps urls with frequency > 1 / max_urls
+        for workers in (1, 3):
+            report = log_analyzer.create_report(self.log_file_path, 0.2, 0, workers=workers, max_urls=50)
+            self.assertLessEqual(len(report), 50)
+            self.assertEqual(sum(self.counts.values()), sum(row['count'] for row in report))
+
+            rows = {row['url']: row for row in report}
+            self.assertIn(log_analyzer.OTHER_URL, rows)
+            for i in range(10):
+                url = '/api/hot/%d' % i
+                self.assertEqual(self.counts[url], rows[url]['count'])
+
+    def test_aggregate_is_bounded(self):
+        aggregate = log_analyzer.LogAggregate('approx', max_urls=50)
+        for i in range(20000):
+            aggregate.add('/rare/%d' % i if i % 2 else '/hot/%d' % (i % 10), 0.5)
+            self.assertLessEqual(len(aggregate.urls), 50 + 50 // log_analyzer.URL_FOLD_SLACK)
+
+    def tearDown(self):
+        os.remove(self.log_file_path)
+
+
+if __name__ == '__main__':
+    unittest.main()